@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the retention engine of ``Cleaner``.
+
+Classifies synthetic histories of hourly backups of growing size and prints
+the time per entry, which should stay roughly constant if the engine scales
+linearly. Optionally scans a directory with ``--scan N`` files.
+
+Usage:
+    $ python benchmarks/bench_cleaner.py
+    $ python benchmarks/bench_cleaner.py --sizes 10000,100000,1000000 --scan 100000
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+import calendar
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from esbckp.cleaner import Cleaner
+
+
+def make_cleaner():
+    cleaner = Cleaner()
+    cleaner.days_to_keep = 7
+    cleaner.weeks_to_keep = 4
+    cleaner.months_to_keep = 12
+    cleaner.day_of_week_to_keep = 5
+    cleaner.day_of_month_to_keep = 1
+    cleaner.compare_time = datetime.datetime(2014, 11, 11, 0, 0, 0)
+    return cleaner
+
+
+def hourly_history(cleaner, size):
+    """Returns ``size`` timestamps of hourly backups before compare_time."""
+    now = calendar.timegm(cleaner.compare_time.timetuple())
+    return [now - x * 3600 for x in range(size)]
+
+
+def bench_classify(size):
+    cleaner = make_cleaner()
+    file_dates = hourly_history(cleaner, size)
+
+    start = time.time()
+    to_remove = cleaner._get_file_indexes_to_delete(file_dates)
+    duration = time.time() - start
+
+    return {'entries': size, 'seconds': duration, 'deleted': len(to_remove),
+            'us_per_entry': duration / size * 1e6}
+
+
+def bench_scan(size):
+    cleaner = make_cleaner()
+    cleaner.storage_dir = tempfile.mkdtemp()
+    try:
+        for x in range(size):
+            open(os.path.join(cleaner.storage_dir, str(x)), 'w').close()
+
+        start = time.time()
+        files = cleaner._get_files_and_dates()
+        duration = time.time() - start
+    finally:
+        shutil.rmtree(cleaner.storage_dir)
+
+    return {'entries': len(files), 'seconds': duration,
+            'us_per_entry': duration / size * 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--scan', type=int, default=0)
+    args = parser.parse_args()
+
+    print('{:>10} {:>10} {:>12}'.format('entries', 'seconds', 'us/entry'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        result = bench_classify(size)
+        print('{entries:>10} {seconds:>10.3f} {us_per_entry:>12.3f}'.format(
+            **result))
+
+    if args.scan:
+        result = bench_scan(args.scan)
+        print('scan {entries:>5} {seconds:>10.3f} {us_per_entry:>12.3f}'.format(
+            **result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Compares two result files of ``suite.py``.
+
+Prints the change of time and peak RSS per benchmark and exits with status
+1 if any benchmark got slower or bigger by more than ``--threshold``
+percent, so it can gate CI runs.
+
+Usage:
+    $ python benchmarks/compare.py baseline.json results.json
+    $ python benchmarks/compare.py baseline.json results.json --threshold 20
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+import json
+import sys
+
+# Result fields to compare, lower is better for all of them.
+FIELDS = ('seconds', 'peak_rss_kb', 'peak_child_rss_kb')
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold):
+    """Returns rows of benchmark, field, old, new, change in percent and
+    whether the change exceeds ``threshold``.
+    """
+    rows = list()
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        old, new = baseline['results'][name], current['results'][name]
+        for field in FIELDS:
+            if not old.get(field) or new.get(field) is None:
+                continue
+            change = (new[field] - old[field]) * 100.0 / old[field]
+            rows.append((name, field, old[field], new[field], change,
+                         change > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Allowed regression in percent.')
+    args = parser.parse_args()
+
+    baseline, current = load(args.baseline), load(args.current)
+    if baseline.get('quick') != current.get('quick'):
+        print('Warning: comparing a --quick run with a full run.')
+
+    print('{:<28} {:<18} {:>12} {:>12} {:>8}'.format(
+        'benchmark', 'field', 'baseline', 'current', 'change'))
+
+    rows = compare(baseline, current, args.threshold)
+    for name, field, old, new, change, regressed in rows:
+        print('{:<28} {:<18} {:>12.3f} {:>12.3f} {:>+7.1f}%{}'.format(
+            name, field, old, new, change, '  REGRESSION' if regressed else ''))
+
+    regressions = [row for row in rows if row[-1]]
+    if regressions:
+        print('{} regression(s) above {}%'.format(len(regressions),
+                                                 args.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
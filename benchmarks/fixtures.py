@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic data and stand-in executables for the benchmark suite.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import os
+import random
+import resource
+import stat
+import time
+
+BLOCK_SIZE = 1024 * 1024
+
+FAKE_PG_DUMP = """#!/bin/sh
+# Stand-in for pg_dump: writes ESBCKP_BENCH_DUMP_MB MB of random data.
+head -c $((${ESBCKP_BENCH_DUMP_MB:-64} * 1024 * 1024)) /dev/urandom
+"""
+
+FAKE_RSYNC = """#!/bin/sh
+# Stand-in for rsync: copies the files listed in --files-from to the local
+# path of the user@host:path target in one tar pipe.
+files_from=""
+for a in "$@"; do
+    case "$a" in --files-from=*) files_from="${a#--files-from=}";; esac
+    src="$dest"
+    dest="$a"
+done
+dest="${dest#*:}"
+mkdir -p "$dest"
+(cd "$src" && tar cf - -T "$files_from") | (cd "$dest" && tar xf -)
+"""
+
+
+def install_fake_tools(bin_dir):
+    """Writes fake ``pg_dump`` and ``rsync`` to ``bin_dir`` and puts it
+    first on ``PATH``.
+    """
+    if not os.path.exists(bin_dir):
+        os.makedirs(bin_dir)
+
+    for name, script in (('pg_dump', FAKE_PG_DUMP), ('rsync', FAKE_RSYNC)):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, stat.S_IRWXU)
+
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+
+def write_file(path, size, rnd):
+    """Writes ``size`` bytes that compress about 2:1, like typical data."""
+    with open(path, 'wb') as f:
+        while size > 0:
+            n = min(size, BLOCK_SIZE)
+            half = bytearray(rnd.getrandbits(8) for _ in range(min(n, 4096)))
+            block = (bytes(half) + b'\0' * len(half)) * (n // (2 * len(half)) + 1)
+            f.write(block[:n])
+            size -= n
+
+
+def make_small_files_tree(path, num_files, size=1024, per_dir=500):
+    """Creates ``num_files`` files of ``size`` bytes, ``per_dir`` per dir."""
+    rnd = random.Random(1)
+    for x in range(num_files):
+        d = os.path.join(path, 'd{:05d}'.format(x // per_dir))
+        if not os.path.exists(d):
+            os.makedirs(d)
+        write_file(os.path.join(d, 'f{:07d}'.format(x)), size, rnd)
+    return num_files, num_files * size
+
+
+def make_huge_files_tree(path, num_files, size):
+    """Creates ``num_files`` files of ``size`` bytes."""
+    rnd = random.Random(2)
+    os.makedirs(path)
+    for x in range(num_files):
+        write_file(os.path.join(path, 'huge{}'.format(x)), size, rnd)
+    return num_files, num_files * size
+
+
+def make_deep_tree(path, depth, files_per_level=4, size=4096):
+    """Creates a chain of ``depth`` nested dirs with a few files in each."""
+    rnd = random.Random(3)
+    d = path
+    for level in range(depth):
+        d = os.path.join(d, 'level{}'.format(level))
+        os.makedirs(d)
+        for x in range(files_per_level):
+            write_file(os.path.join(d, 'f{}'.format(x)), size, rnd)
+    return depth * files_per_level, depth * files_per_level * size
+
+
+def backup_history(num_entries, postfixes=10, hours=1):
+    """Returns ``(name, timestamp)`` of a history of backups taken every
+    ``hours`` hours for ``postfixes`` items, newest first.
+    """
+    now = int(time.time())
+    history = list()
+    for x in range(num_entries):
+        timestamp = now - (x // postfixes) * hours * 3600
+        prefix = time.strftime('%Y-%m-%d--%H-%M-%S', time.localtime(timestamp))
+        history.append(('{}__#srv#item{}.tar.gz'.format(prefix, x % postfixes),
+                        timestamp))
+    return history
+
+
+def peak_rss_kb():
+    """Returns the peak RSS in KB of this process and of its largest child."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own, children
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of the archive, dump, ship and clean paths.
+
+Every benchmark runs in its own process on synthetic data, so the reported
+peak RSS belongs to that benchmark only. ``pg_dump`` and ``rsync`` are
+replaced by stand-in scripts, which makes the suite runnable without a
+database or a remote host.
+
+Results are printed as table and saved as JSON with ``--output``, see
+``compare.py`` to compare two result files.
+
+Usage:
+    $ python benchmarks/suite.py --quick
+    $ python benchmarks/suite.py --output results.json
+    $ python benchmarks/suite.py --only archive_small_files,clean_plan
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import esbckp
+import fixtures
+from esbckp.backups import BackupGroup
+from esbckp.catalog import Catalog
+from esbckp.cleaner import Cleaner
+from esbckp.compression import Compression
+from esbckp.config import load_config
+from esbckp.encryption import import_cryptography
+from esbckp.restore import restore_chain
+from esbckp.shipper import Shipper
+from esbckp.utils import do_file_backup, do_database_backup
+
+MB = 1024 * 1024
+
+# Sizes of the synthetic data for full and --quick runs.
+SIZES = {
+    'small_files': (100000, 10000),
+    'huge_files': (3 * 512 * MB, 3 * 32 * MB),
+    'deep_levels': (500, 100),
+    'dump_mb': (512, 32),
+    'ship_files': (20000, 2000),
+    'history': (1000000, 10000),
+    'delete_files': (100000, 5000),
+    'groups': (5000, 500),
+}
+
+
+def make_group(workdir, codec='gzip', threads=1, key=None):
+    group = BackupGroup()
+    group.group_title = 'bench'
+    group.backup_storage_dir = os.path.join(workdir, 'storage')
+    group.base_path = os.path.join(group.backup_storage_dir, 'bench')
+    group.filename_prefix = datetime.datetime.now().strftime(
+        '%Y-%m-%d--%H-%M-%S')
+    group.compression = Compression(codec, threads=threads)
+    group.encryption_key = key
+    group.check_or_create_base_path()
+    return group
+
+
+def archive(workdir, make_tree, codec='gzip', threads=1, key=None):
+    source = os.path.join(workdir, 'source')
+    num_files, num_bytes = make_tree(source)
+    item = esbckp.FileBackupItem()
+    item.dir = source
+    group = make_group(workdir, codec, threads, key)
+
+    start = time.time()
+    do_file_backup(group, item, progress=False)
+    return {'seconds': time.time() - start, 'files': num_files,
+            'bytes': num_bytes}
+
+
+def bench_archive_small_files(workdir, quick):
+    num = SIZES['small_files'][quick]
+    return archive(workdir, lambda p: fixtures.make_small_files_tree(p, num))
+
+
+def bench_archive_huge_files(workdir, quick):
+    size = SIZES['huge_files'][quick] // 3
+    return archive(workdir, lambda p: fixtures.make_huge_files_tree(p, 3, size))
+
+
+def bench_archive_huge_files_parallel(workdir, quick):
+    size = SIZES['huge_files'][quick] // 3
+    return archive(workdir, lambda p: fixtures.make_huge_files_tree(p, 3, size),
+                   threads=4)
+
+
+def bench_archive_huge_files_encrypted(workdir, quick):
+    """Same as archive_huge_files_parallel, encrypted with AES-GCM."""
+    # Loading the key imports cryptography before a run starts.
+    import_cryptography()
+    size = SIZES['huge_files'][quick] // 3
+    return archive(workdir, lambda p: fixtures.make_huge_files_tree(p, 3, size),
+                   threads=4, key=os.urandom(32))
+
+
+def bench_archive_deep_tree(workdir, quick):
+    depth = SIZES['deep_levels'][quick]
+    return archive(workdir, lambda p: fixtures.make_deep_tree(p, depth))
+
+
+def bench_restore_one_file(workdir, quick):
+    """Restores the last file of an archive of huge files."""
+    source = os.path.join(workdir, 'source')
+    size = SIZES['huge_files'][quick] // 3
+    fixtures.make_huge_files_tree(source, 3, size)
+    item = esbckp.FileBackupItem()
+    item.dir = source
+    group = make_group(workdir)
+    path = do_file_backup(group, item, progress=False)
+
+    start = time.time()
+    restore_chain(group, [path], os.path.join(workdir, 'target'), source,
+                  'huge2')
+    return {'seconds': time.time() - start, 'files': 1, 'bytes': size}
+
+
+def bench_dump(workdir, quick):
+    os.environ['ESBCKP_BENCH_DUMP_MB'] = str(SIZES['dump_mb'][quick])
+    group = make_group(workdir)
+
+    start = time.time()
+    path = do_database_backup(group, esbckp.DatabaseBackupItem(
+        'postgres:bench:bench'))
+    return {'seconds': time.time() - start, 'files': 1,
+            'bytes': os.path.getsize(path)}
+
+
+def bench_ship(workdir, quick):
+    group = make_group(workdir)
+    names = [n for n, _ in fixtures.backup_history(SIZES['ship_files'][quick])]
+    for name in names:
+        with open(os.path.join(group.base_path, name), 'wb') as f:
+            f.write(b'x' * 4096)
+
+    shipper = Shipper()
+    shipper.user = 'bench'
+    shipper.host = 'localhost'
+    shipper.source_dir = group.base_path
+    shipper.target_dir = os.path.join(workdir, 'remote')
+    shipper.catalog = Catalog(group.backup_storage_dir)
+    shipper.group_title = group.group_title
+
+    start = time.time()
+    shipped = shipper.ship()
+    return {'seconds': time.time() - start, 'files': len(shipped),
+            'bytes': len(shipped) * 4096}
+
+
+def make_cleaner(group, catalog=None):
+    cleaner = Cleaner()
+    cleaner.days_to_keep = 7
+    cleaner.weeks_to_keep = 4
+    cleaner.months_to_keep = 12
+    cleaner.day_of_week_to_keep = 5
+    cleaner.day_of_month_to_keep = 1
+    cleaner.catalog = catalog
+    cleaner.group_title = group.group_title
+    return cleaner
+
+
+def bench_clean_plan(workdir, quick):
+    """Plans a cleanup of a catalog history without files on disk."""
+    group = make_group(workdir)
+    catalog = Catalog(group.backup_storage_dir)
+    history = fixtures.backup_history(SIZES['history'][quick])
+    with catalog.connect() as conn:
+        conn.executemany(
+            'INSERT INTO backups (group_title, prefix, created_at, name) '
+            'VALUES (?, ?, ?, ?)',
+            [(group.group_title, n[:20], t, n) for n, t in history])
+        conn.execute('INSERT INTO imported_groups VALUES (?, ?)',
+                     (group.group_title, time.time()))
+
+    cleaner = make_cleaner(group, catalog)
+    start = time.time()
+    cleaner.plan(group.base_path)
+    return {'seconds': time.time() - start, 'files': len(history), 'bytes': 0}
+
+
+def bench_clean_delete(workdir, quick):
+    """Scans, plans and deletes files of a history on disk."""
+    group = make_group(workdir)
+    for name, timestamp in fixtures.backup_history(
+            SIZES['delete_files'][quick], hours=6):
+        path = os.path.join(group.base_path, name)
+        open(path, 'w').close()
+        os.utime(path, (timestamp, timestamp))
+
+    cleaner = make_cleaner(group)
+    start = time.time()
+    cleaner.plan(group.base_path)
+    cleaner.delete(dry_run=False)
+    return {'seconds': time.time() - start,
+            'files': len(cleaner.file_index_to_delete), 'bytes': 0}
+
+
+def write_config(workdir, num):
+    """Writes an INI file of ``num`` groups with a few options each."""
+    path = os.path.join(workdir, 'conf.ini')
+    with open(path, 'w') as f:
+        f.write('[DEFAULT]\nbackup_storage_dir: {}\n'.format(workdir))
+        for x in range(num):
+            f.write('[group{0}]\ndir: ~/srv/project{0}/data, ~/srv/etc{0}\n'
+                    'db: postgres:db{0}:user\nexclude: *.log, re:tmp/.*\n'
+                    'compression: zstd\nvolume_size: 4G\n'.format(x))
+    return path
+
+
+def bench_load_config(workdir, quick):
+    """Parses and validates a config of many groups without a cache."""
+    num = SIZES['groups'][quick]
+    path = write_config(workdir, num)
+
+    start = time.time()
+    load_config(path, cache_dir='')
+    return {'seconds': time.time() - start, 'files': num, 'bytes': 0}
+
+
+def bench_load_config_cached(workdir, quick):
+    """Loads the same config from the cache of an earlier run."""
+    num = SIZES['groups'][quick]
+    path = write_config(workdir, num)
+    load_config(path, cache_dir=workdir)
+
+    start = time.time()
+    load_config(path, cache_dir=workdir)
+    return {'seconds': time.time() - start, 'files': num, 'bytes': 0}
+
+
+def bench_startup(workdir, quick):
+    """Best of five runs of ``esbckp --help`` in a fresh interpreter."""
+    cmd = [sys.executable, '-c', 'from esbckp.commands import cli; cli()',
+           '--help']
+    runs = list()
+    for _ in range(5):
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(cmd, stdout=devnull, stderr=devnull,
+                                  cwd=ROOT)
+        runs.append(time.time() - start)
+    return {'seconds': min(runs), 'files': 0, 'bytes': 0}
+
+
+def bench_startup_ship(workdir, quick):
+    """Best of five runs of ``esbckp ship`` of one group of a big config,
+    which is cached after the first run.
+    """
+    path = write_config(workdir, SIZES['groups'][quick])
+    cmd = [sys.executable, '-c', 'from esbckp.commands import cli; cli()',
+           'ship', '--conf', path, '--groups', 'group7']
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(workdir, 'cache'))
+    runs = list()
+    for _ in range(6):
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(cmd, stdout=devnull, stderr=devnull,
+                                  cwd=ROOT, env=env)
+        runs.append(time.time() - start)
+    return {'seconds': min(runs[1:]), 'files': 0, 'bytes': 0}
+
+
+BENCHMARKS = [
+    ('archive_small_files', bench_archive_small_files),
+    ('archive_huge_files', bench_archive_huge_files),
+    ('archive_huge_files_parallel', bench_archive_huge_files_parallel),
+    ('archive_huge_files_encrypted', bench_archive_huge_files_encrypted),
+    ('archive_deep_tree', bench_archive_deep_tree),
+    ('restore_one_file', bench_restore_one_file),
+    ('dump', bench_dump),
+    ('ship', bench_ship),
+    ('clean_plan', bench_clean_plan),
+    ('clean_delete', bench_clean_delete),
+    ('load_config', bench_load_config),
+    ('load_config_cached', bench_load_config_cached),
+    ('startup', bench_startup),
+    ('startup_ship', bench_startup_ship),
+]
+
+
+def run_one(name, quick):
+    """Runs one benchmark in this process and returns its result."""
+    workdir = tempfile.mkdtemp(prefix='esbckp-bench-')
+    try:
+        fixtures.install_fake_tools(os.path.join(workdir, 'bin'))
+        result = dict(BENCHMARKS)[name](workdir, quick)
+    finally:
+        shutil.rmtree(workdir)
+
+    seconds = result['seconds']
+    own_rss, child_rss = fixtures.peak_rss_kb()
+    result.update({
+        'mb_per_s': result['bytes'] / MB / seconds if result['bytes'] else None,
+        'files_per_s': result['files'] / seconds if result['files'] else None,
+        'peak_rss_kb': own_rss,
+        'peak_child_rss_kb': child_rss,
+    })
+    return result
+
+
+def run_isolated(name, quick):
+    """Runs one benchmark in a fresh interpreter for a clean peak RSS."""
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-one', name]
+    if quick:
+        cmd.append('--quick')
+    return json.loads(subprocess.check_output(cmd).splitlines()[-1])
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                stderr=devnull).strip().decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quick', action='store_true',
+                        help='Use small data sets, e.g. for CI.')
+    parser.add_argument('--only', default=None,
+                        help='Comma separated names of benchmarks to run.')
+    parser.add_argument('--output', default=None,
+                        help='Path of the JSON file to save results to.')
+    parser.add_argument('--run-one', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, args.quick)))
+        return
+
+    names = [name for name, _ in BENCHMARKS]
+    if args.only:
+        names = [n for n in names if n in args.only.split(',')]
+
+    print('{:<28} {:>9} {:>9} {:>11} {:>10}'.format(
+        'benchmark', 'seconds', 'MB/s', 'files/s', 'RSS MB'))
+
+    results = dict()
+    for name in names:
+        result = results[name] = run_isolated(name, args.quick)
+        print('{:<28} {:>9.3f} {:>9} {:>11} {:>10.1f}'.format(
+            name, result['seconds'],
+            '{:.1f}'.format(result['mb_per_s']) if result['mb_per_s'] else '-',
+            '{:.0f}'.format(result['files_per_s'])
+            if result['files_per_s'] else '-',
+            max(result['peak_rss_kb'], result['peak_child_rss_kb']) / 1024.0))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'quick': args.quick,
+                'time': int(time.time()),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@
              $ esbckp start --help
              $ esbckp ship --help
              $ esbckp clean --help
+             $ esbckp daemon --help
   Platforms: Developed on MacOS X and Cent OS
 
 Description:
@@ -17,7 +18,8 @@ Description:
 
     Type ``esbckp --help`` to learn about command line options.
 
-    The tool is not daemonized and can be scheduled with cron jobs.
+    The tool can be scheduled with cron jobs or run the schedules of the
+    config file itself with ``esbckp daemon``.
 
 Dependencies:
     * Click
@@ -36,9 +38,4 @@ from .cleaner import Cleaner
 # >>>>> Global Todos <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 # TODO(sthzg) Add option to encrypt backups.
 # TODO(sthzg) Decide about refactoring utils into classes.
-# TODO(sthzg) Make backup actions pluggable and extendable.
 # TODO(sthzg) Add logging.
-
-
-total_num_files = 0
-current_file_number = 0
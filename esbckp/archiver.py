@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import errno
+import os
+import stat
+import time
+from .metrics import Timings, TimedFile, timed
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def walk_tree(top, path_filter=None, start_after=None):
+    """Yields ``(path, is_dir)`` for ``top`` and everything below it.
+
+    The tree is walked once, depth first and in sorted order. Only the
+    entries of the directories on the current path are held in memory, so
+    memory stays bounded by the depth and width of the tree instead of the
+    total number of files. Symlinks to directories are not followed.
+
+    :param path_filter: Optional ``filters.PathFilter``. Excluded entries
+        are not yielded and excluded directories are never listed.
+    :param start_after: Optional path yielded by an earlier walk of ``top``.
+        Only entries after it are yielded, directories that were walked
+        completely before it are not listed again.
+    """
+    is_dir = os.path.isdir(top) and not os.path.islink(top)
+    if start_after is None:
+        yield top, is_dir
+
+    if not is_dir:
+        return
+
+    if path_filter:
+        path_filter.start(top)
+
+    # The walk order is the order of the paths split into components.
+    resume_key = walk_key(top, start_after) if start_after else None
+
+    stack = [iter(_list_dir(top))]
+    while stack:
+        try:
+            path, is_dir = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+
+        if path_filter and not path_filter(path, is_dir):
+            continue
+
+        if resume_key:
+            key = walk_key(top, path)
+            if key <= resume_key:
+                # Walked before, only directories on the path to the
+                # resume point have entries left.
+                if is_dir and resume_key[:len(key)] == key and \
+                        (not path_filter or path_filter.descend(path)):
+                    stack.append(iter(_list_dir(path)))
+                continue
+            resume_key = None
+
+        yield path, is_dir
+
+        if is_dir and (not path_filter or path_filter.descend(path)):
+            stack.append(iter(_list_dir(path)))
+
+
+def walk_key(top, path):
+    """Returns a key of ``path`` below ``top`` that sorts in walk order."""
+    rel = path[len(top.rstrip(os.sep)) + 1:]
+    return tuple(rel.split(os.sep)) if rel else ()
+
+
+def _list_dir(path):
+    """Returns sorted ``(path, is_dir)`` tuples of the entries in ``path``."""
+    try:
+        if scandir is not None:
+            entries = [(e.path, e.is_dir(follow_symlinks=False))
+                       for e in scandir(path)]
+        else:
+            entries = [(p, stat.S_ISDIR(os.lstat(p).st_mode))
+                       for p in (os.path.join(path, n) for n in os.listdir(path))]
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+    entries.sort()
+    return entries
+
+
+def add_tree(tar, top, on_add=None, select=None, timings=None,
+             path_filter=None, start_after=None):
+    """Adds ``top`` recursively to ``tar`` in a single pass.
+
+    Unlike ``TarFile.add`` this streams entries from ``walk_tree`` and
+    tolerates files that vanish between listing and reading.
+
+    :param tar: ``TarFile`` opened for writing.
+    :param top: Path of the directory or file to add.
+    :param on_add: Optional callable invoked with each added ``TarInfo``.
+    :param select: Optional callable invoked with path and ``TarInfo`` of
+        each entry, entries for which it returns False are skipped.
+    :param timings: Optional ``metrics.Timings`` that receives the time
+        spent walking and stating (``walk``) and reading files (``read``).
+    :param path_filter: Optional ``filters.PathFilter`` applied during the
+        walk. Files larger than its ``max_file_size`` are skipped.
+    :param start_after: Optional path to resume an interrupted archive
+        after, see ``walk_tree``.
+    :return: Tuple of number of files and bytes added.
+    """
+    num_files = 0
+    num_bytes = 0
+    timings = Timings() if timings is None else timings
+
+    for path, is_dir in timed(walk_tree(top, path_filter, start_after),
+                                timings, 'walk'):
+        try:
+            start = time.time()
+            tarinfo = tar.gettarinfo(path)
+            timings.add('walk', time.time() - start)
+            if tarinfo is None:
+                continue
+
+            if path_filter and tarinfo.isreg() and \
+                    not path_filter.allows_size(tarinfo.size):
+                continue
+
+            if select and not select(path, tarinfo):
+                continue
+
+            if tarinfo.isreg():
+                with open(path, 'rb') as f:
+                    tar.addfile(tarinfo, TimedFile(f, timings, 'read'))
+                num_files += 1
+                num_bytes += tarinfo.size
+            else:
+                tar.addfile(tarinfo)
+
+        except (IOError, OSError), e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+
+        if on_add:
+            on_add(tarinfo)
+
+    return num_files, num_bytes
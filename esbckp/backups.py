@@ -2,57 +2,91 @@
 from __future__ import absolute_import, unicode_literals
 import click
 import os
-from ConfigParser import ConfigParser, NoOptionError
+import re
 from datetime import datetime
+from contextlib import contextmanager
 from .constants import *
-from .utils import extract_dirs, extract_databases
+from .compression import Compression
+from .config import load_config, split_values
 from .shipper import Shipper
 from .cleaner import Cleaner
 
+# Names of database items become part of file names.
+DB_NAME_RE = re.compile(r'^[\w.-]+$', re.UNICODE)
+
 
 class Backup(object):
     """Main application class for backups.
 
     Builds the main backup object which all subcommands access to retrieve
-    information about ``BackupGroups``.
+    information about ``BackupGroups``. Only the groups named in ``groups``
+    are built, see ``config.Config.select``.
     """
     def __init__(self, conf, groups, routines=None):
-        if not os.path.exists(os.path.expanduser(conf)):
-            raise click.ClickException(ERR_CONFIG_FILE_DOES_NOT_EXIST)
-
-        cfg = os.path.expanduser(conf)
-
-        parser = ConfigParser()
-        parser.read([cfg])
+        from .catalog import Catalog
+        from .metrics import Metrics
 
-        bsd = os.path.expanduser(parser.defaults().get('backup_storage_dir'))
+        config = load_config(conf)
+        bsd = os.path.expanduser(config.backup_storage_dir)
 
+        self.config = config
         self.backup_groups = list()
         self.backup_storage_dir = bsd
 
         if not os.path.exists(bsd):
             raise click.ClickException(ERR_BACK_STORAGE_DOES_NOT_EXIST.format(bsd))
 
-        for section in parser.sections():
-            if groups and section not in groups:
-                continue
-
-            group = BackupGroup()
-            group.group_title = section
-            group.base_path = os.path.join(bsd, group.group_title)
-            group.filename_prefix = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
-            group.backup_storage_dir = bsd
-
-            if not routines or 'dir' in routines:
-                group.dirs = extract_dirs(parser.get(section, 'dir'))
-
-            if not routines or 'db' in routines:
-                group.dbs = extract_databases(parser.get(section, 'db'))
-
-            group.shipper = group.populate_shipper(parser, section)
-            group.cleaner = group.populate_cleaner(parser, section)
-
-            self.backup_groups.append(group)
+        self.catalog = Catalog(bsd)
+
+        textfile_dir = config.metrics_textfile_dir
+        self.metrics = Metrics(
+            os.path.expanduser(config.metrics_file or
+                               os.path.join(bsd, '.metrics.jsonl')),
+            os.path.expanduser(textfile_dir) if textfile_dir else None)
+
+        routines = split_values(routines) if routines else None
+        for title in config.select(groups):
+            self.backup_groups.append(
+                self.build_group(config.group(title), routines))
+
+    def build_group(self, config, routines=None):
+        """Returns the ``BackupGroup`` of a ``config.GroupConfig``."""
+        bsd = self.backup_storage_dir
+        group = BackupGroup()
+        group.group_title = config.title
+        group.base_path = os.path.join(bsd, group.group_title)
+        group.filename_prefix = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
+        group.backup_storage_dir = bsd
+        group.catalog = self.catalog
+        group.metrics = self.metrics
+
+        if not routines or 'dir' in routines:
+            group.dirs = [FileBackupItem(d) for d in config.dirs]
+
+        if not routines or 'db' in routines:
+            group.dbs = extract_databases(config.dbs)
+
+        group.compression = group.populate_compression(config)
+        group.mode = config.mode
+        group.full_every = config.full_every
+        group.unchanged = config.unchanged
+        group.exclude = config.exclude
+        group.include = config.include
+        group.max_file_size = config.max_file_size
+        group.one_file_system = config.one_file_system
+        group.storage = config.storage
+        group.volume_size = config.volume_size
+        group.db_format = config.db_format
+        group.db_jobs = config.db_jobs
+        group.verify = config.verify
+        group.encryption_key_file = config.encryption_key_file
+        group.schedule = config.schedule
+        group.pipeline = config.pipeline
+
+        group.shippers = group.populate_shippers(config)
+        group.shipper = group.shippers[0] if group.shippers else None
+        group.cleaner = group.populate_cleaner(config)
+        return group
 
 
 class BackupGroup(object):
@@ -76,87 +110,323 @@ class BackupGroup(object):
         self.base_name = None
         self.dirs = []
         self.dbs = []
+        self.catalog = None
+        self.metrics = None
         self.shipper = None
+        self.shippers = []
         self.cleaner = None
+        self.compression = Compression()
+        self.mode = 'full'
+        self.full_every = 7
+        self.unchanged = 'backup'
+        self.exclude = []
+        self.include = []
+        self.max_file_size = 0
+        self.one_file_system = False
+        self.storage = 'archive'
+        self.volume_size = 0
+        self.db_format = 'custom'
+        self.db_jobs = 1
+        self.encryption_key_file = None
+        self._encryption_key = None
+        self.verify = False
+        self.schedule = None
+        self.pipeline = list(STAGES)
         self.filename_prefix = None
 
+    @property
+    def encryption_key(self):
+        """Key read from ``encryption_key_file`` on first use, so commands
+        that don't touch archives neither read it nor import cryptography.
+        """
+        if self._encryption_key is None and self.encryption_key_file:
+            from .encryption import load_key
+            self._encryption_key = load_key(self.encryption_key_file)
+        return self._encryption_key
+
+    @encryption_key.setter
+    def encryption_key(self, key):
+        self._encryption_key = key
+
+    def make_path_filter(self):
+        """Returns a new ``PathFilter`` for one walk of a directory."""
+        from .filters import PathFilter
+        return PathFilter(self.exclude, self.include, self.max_file_size,
+                          self.one_file_system)
+
     def check_or_create_base_path(self):
         """Creates ``base_path`` on file system if it does not exist."""
         if self.base_path and not os.path.exists(self.base_path):
             os.makedirs(self.base_path)
 
-    def populate_shipper(self, parser, section):
-        """Returns ``Shipper`` object from ``section`` or leaves it at None."""
+    @property
+    def index_path(self):
+        """Directory for bookkeeping files of this group."""
+        return os.path.join(self.base_path, '.index')
+
+    @property
+    def chunk_store(self):
+        """``ChunkStore`` shared by all groups of the storage dir."""
+        from .chunkstore import ChunkStore
+        return ChunkStore(os.path.join(self.backup_storage_dir, '.chunks'))
+
+    @property
+    def extension(self):
+        """File extension of directory backups of this group."""
+        from .chunkstore import MANIFEST_EXTENSION
+        from .volumes import VOLUMES_EXTENSION
+        if self.storage == 'chunked':
+            return MANIFEST_EXTENSION
+        if self.uses_volumes:
+            return VOLUMES_EXTENSION
+        return self.archive_extension
+
+    @property
+    def archive_extension(self):
+        """File extension of archives and volumes of this group."""
+        from .encryption import ENCRYPTED_EXTENSION
+        if self.encryption_key:
+            return self.compression.extension + ENCRYPTED_EXTENSION
+        return self.compression.extension
+
+    @property
+    def archive_codec(self):
+        """Codec of archives of this group as recorded in the catalog."""
+        from .encryption import CODEC_SUFFIX
+        if self.encryption_key:
+            return self.compression.codec + CODEC_SUFFIX
+        return self.compression.codec
+
+    @property
+    def uses_volumes(self):
+        """True if directory backups are split into volumes.
+
+        Only archive groups in full mode are split, the file index of
+        incremental groups can not be resumed.
+        """
+        return bool(self.volume_size and self.storage == 'archive' and
+                    self.mode == 'full')
+
+    @contextmanager
+    def open_backup(self, target_path, meta=None, result=None, timings=None):
+        """Yields a file object for the tar stream of a directory backup.
+
+        Depending on ``storage`` the stream is compressed into
+        ``target_path`` or split into the chunk store with ``target_path``
+        as manifest.
+
+        With an ``encryption_key`` the compressed stream is encrypted on
+        its way to the file, see ``encryption.EncryptingWriter``.
+
+        :param result: Optional dict that receives ``codec`` and ``sha256``
+            of the written file, which is hashed while it is written. The
+            output of external compressors is copied to the file for that.
+            gzip adds the ``seek_points`` of its members. Seek points are
+            offsets of the compressed stream, not of the encrypted file.
+        :param timings: Optional ``metrics.Timings`` that receives the time
+            spent compressing, encrypting and writing. Chunking counts as
+            ``compress``.
+        """
+        from .checksums import HashingWriter, file_sha256
+        from .chunkstore import ChunkWriter
+        from .encryption import EncryptingWriter
+        from .locks import chunk_lock
+        from .metrics import Timings, TimedFile
+
+        result = result if result is not None else dict()
+        timings = timings if timings is not None else Timings()
+
+        if self.storage == 'chunked':
+            # Keeps clean_chunks from removing chunks before the manifest
+            # references them.
+            lock = chunk_lock(self.backup_storage_dir, shared=True)
+            lock.acquire(blocking=True)
+            try:
+                writer = ChunkWriter(self.chunk_store, target_path, meta)
+                yield TimedFile(writer, timings, 'compress')
+                writer.close()
+            finally:
+                lock.release()
+            result['codec'] = 'chunked'
+            result['sha256'] = file_sha256(target_path)
+            return
+
+        seek_points = None
+        encryptor = None
+        with open(target_path, 'wb') as f:
+            out = hashing = HashingWriter(TimedFile(f, timings, 'write'))
+            if self.encryption_key:
+                encryptor = EncryptingWriter(hashing, self.encryption_key)
+                out = TimedFile(encryptor, timings, 'encrypt')
+            if not self.compression.get_cmd():
+                seek_points = list()
+            with self.compression.open(out, seek_points) as stream:
+                yield TimedFile(stream, timings, 'compress')
+            if encryptor:
+                encryptor.close()
+
+        result['codec'] = self.compression.codec
+        result['seek_points'] = seek_points
+        result['sha256'] = hashing.hexdigest()
+
+    def get_file_count(self, postfix):
+        """Returns the file count of the last backup of an item or None."""
+        return self.get_totals(postfix)[0]
+
+    def get_totals(self, postfix):
+        """Returns file count and bytes of the last full backup of an item.
+
+        Either value is None if it is not known.
+        """
         try:
-            source_dir = os.path.join(self.backup_storage_dir, self.group_title)
-            target_dir = parser.get(section, 'shipper_dir')
-
-            self.shipper = Shipper()
-            self.shipper.ssh_port = parser.get(section, 'shipper_ssh_port')
-            self.shipper.user = parser.get(section, 'shipper_user')
-            self.shipper.host = parser.get(section, 'shipper_host')
-            self.shipper.source_dir = source_dir
-            self.shipper.target_dir = target_dir
-
-            return self.shipper
+            with open(os.path.join(self.index_path, postfix + '.count')) as f:
+                values = [int(v) for v in f.read().split()]
+        except (IOError, ValueError):
+            return None, None
+        return tuple((values + [None, None])[:2])
+
+    def set_file_count(self, postfix, count, num_bytes=None):
+        """Stores the file count and bytes of an item as estimate for the
+        next run.
+        """
+        if not os.path.exists(self.index_path):
+            os.makedirs(self.index_path)
+        with open(os.path.join(self.index_path, postfix + '.count'), 'w') as f:
+            f.write(str(count) if num_bytes is None else
+                    '{} {}'.format(count, num_bytes))
 
-        except NoOptionError:
-            return None
+    def populate_compression(self, config):
+        """Returns ``Compression`` object from a ``config.GroupConfig``.
 
-    def populate_cleaner(self, parser, section):
-        """Returns ``Cleaner`` object from ``section`` or leaves it at None."""
-        try:
-            cl = Cleaner()
-            cl.days_to_keep = int(parser.get(section, 'cleaner_days_to_keep'))
-            cl.weeks_to_keep = int(parser.get(section, 'cleaner_weeks_to_keep'))
-            cl.months_to_keep = int(parser.get(section, 'cleaner_months_to_keep'))
-            cl.day_of_week_to_keep = int(parser.get(section, 'cleaner_day_of_week_to_keep'))  # NOQA
-            cl.day_of_month_to_keep = int(parser.get(section, 'cleaner_day_of_month_to_keep'))  # NOQA
+        Falls back to single threaded gzip when nothing is configured.
+        """
+        return Compression(codec=config.compression,
+                           level=config.compression_level,
+                           threads=config.compression_threads)
 
-            self.cleaner = cl
-            return self.cleaner
+    def populate_shippers(self, config):
+        """Returns a list of ``Shipper`` objects from a
+        ``config.GroupConfig``.
 
-        except NoOptionError:
+        ``shipper_host`` may list several hosts separated by commas, which
+        all share the other shipper settings. Returns an empty list if
+        shipper settings are missing.
+        """
+        if config.shipper is None:
+            return []
+
+        source_dir = os.path.join(self.backup_storage_dir, self.group_title)
+        shippers = list()
+        for host in config.shipper.hosts:
+            shipper = Shipper()
+            shipper.ssh_port = config.shipper.ssh_port
+            shipper.user = config.shipper.user
+            shipper.host = host
+            shipper.source_dir = source_dir
+            shipper.target_dir = config.shipper.target_dir
+            shipper.catalog = self.catalog
+            shipper.group_title = self.group_title
+            shipper.metrics = self.metrics
+            shipper.bwlimit = config.shipper.bwlimit
+            shipper.retries = config.shipper.retries
+            shipper.volume_jobs = config.shipper.volume_jobs
+
+            if self.storage == 'chunked':
+                shipper.chunk_dir = self.chunk_store.path
+
+            shippers.append(shipper)
+
+        return shippers
+
+    def populate_cleaner(self, config):
+        """Returns ``Cleaner`` object from a ``config.GroupConfig`` or leaves
+        it at None.
+        """
+        if config.cleaner is None:
             return None
 
+        cl = Cleaner()
+        cl.days_to_keep = config.cleaner.days_to_keep
+        cl.weeks_to_keep = config.cleaner.weeks_to_keep
+        cl.months_to_keep = config.cleaner.months_to_keep
+        cl.day_of_week_to_keep = config.cleaner.day_of_week_to_keep
+        cl.day_of_month_to_keep = config.cleaner.day_of_month_to_keep
+        cl.threads = config.cleaner.threads
+        cl.catalog = self.catalog
+        cl.group_title = self.group_title
+        cl.metrics = self.metrics
+        cl.keep_latest = (self.unchanged == 'skip' or
+                          (self.unchanged == 'link' and self.mode != 'full'))
+
+        self.cleaner = cl
+        return self.cleaner
+
     def ship(self):
-        """Starts shipping via rsync."""
-        self.shipper.ship()
+        """Starts shipping via rsync to all targets one after another."""
+        for shipper in self.shippers:
+            shipper.ship()
 
     def clean(self, dry_run=True):
+        """Removes outdated backups and returns the number of bytes freed."""
         storage_dir = os.path.join(self.backup_storage_dir, self.group_title)
-        self.cleaner.clean(storage_dir, dry_run)
+        return self.cleaner.clean(storage_dir, dry_run)
 
 
 class FileBackupItem(object):
     """Data object for file backups."""
-    def __init__(self):
-        self.dir = None
+    def __init__(self, dir=None):
+        self.dir = dir
+
+
+def extract_databases(dbs):
+    """Returns ``DatabaseBackupItem`` objects of valid db strings and skips
+    the others with a message.
+    """
+    items = list()
+    for db in dbs:
+        try:
+            items.append(DatabaseBackupItem(db))
+        except ValueError, e:
+            click.echo(click.style(e.message, fg='blue'))
+
+    return items
 
 
 class DatabaseBackupItem(object):
     """Data object for database backups.
 
-    The app currently only supports postgres.
+    Db strings look like ``<db_type>:<spec>``, the driver registered for
+    ``db_type`` parses ``spec`` and dumps the item, see ``sources``.
     """
     def __init__(self, db_string):
         self.db_string = db_string
         self.db_type = None
         self.db_user = None
         self.db_name = None
+        self.params = {}
 
         self._extract_db_string()
 
+    @property
+    def source(self):
+        """Driver of ``db_type``, see ``sources.get_source``."""
+        from .sources import get_source
+        return get_source(self.db_type)
+
     def _extract_db_string(self):
         """Validates and extracts the configured database string.
 
-        Database strings look like <db_system>:<db_name>:<db_user>.
-
         :raises: ValueError
         """
-        tokens = self.db_string.split(':')
-
-        if len(tokens) != 3:
-            raise ValueError(ERR_DB_STRING_LENGTH.format(self.db_string))
-        else:
-            self.db_type, self.db_name, self.db_user = tokens
+        self.db_type, _, spec = self.db_string.partition(':')
+        source = self.source
+        try:
+            self.params = source.parse(spec)
+        except ValueError:
+            raise ValueError(ERR_DB_STRING.format(self.db_string,
+                                                  source.example))
+
+        self.db_name = self.params['name']
+        self.db_user = self.params.get('user')
+        if not DB_NAME_RE.match(self.db_name):
+            raise ValueError(ERR_DB_NAME.format(self.db_name, self.db_string))
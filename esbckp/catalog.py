@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from .dumps import path_size
+from .names import parse_backup_name
+
+PREFIX_FORMAT = '%Y-%m-%d--%H-%M-%S'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    group_title TEXT NOT NULL,
+    item TEXT,
+    prefix TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    sha256 TEXT,
+    codec TEXT,
+    duration REAL,
+    deleted_at REAL,
+    UNIQUE (group_title, name)
+);
+CREATE INDEX IF NOT EXISTS backups_group_created
+    ON backups (group_title, deleted_at, created_at);
+CREATE TABLE IF NOT EXISTS imported_groups (
+    group_title TEXT PRIMARY KEY,
+    imported_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shipments (
+    backup_id INTEGER NOT NULL REFERENCES backups (id),
+    target TEXT NOT NULL,
+    shipped_at REAL NOT NULL,
+    PRIMARY KEY (backup_id, target)
+);
+"""
+
+
+class Catalog(object):
+    """SQLite catalog of all backups in a ``backup_storage_dir``.
+
+    Every backup is recorded when it is written, with the creation time
+    taken from its filename prefix. ``clean``, ``ship`` and ``list`` query
+    the catalog instead of scanning group directories and relying on mtimes.
+
+    Connections are opened per call, which keeps the catalog usable from
+    worker threads and processes.
+    """
+    def __init__(self, backup_storage_dir):
+        self.path = os.path.join(backup_storage_dir, '.catalog.sqlite')
+        self._has_schema = False
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            if not self._has_schema:
+                conn.executescript(SCHEMA)
+                self._has_schema = True
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add_backup(self, group_title, item, path, sha256=None, codec=None,
+                   duration=None):
+        """Records a backup written to ``path``."""
+        name = os.path.basename(path)
+        prefix = parse_backup_name(name)['prefix']
+        with self.connect() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO backups (group_title, prefix, '
+                'created_at, name) VALUES (?, ?, ?, ?)',
+                (group_title, prefix, prefix_to_timestamp(prefix), name))
+            conn.execute(
+                'UPDATE backups SET item = ?, size = ?, sha256 = ?, codec = ?, '
+                'duration = ?, deleted_at = NULL WHERE group_title = ? AND '
+                'name = ?', (item, path_size(path), sha256, codec, duration,
+                             group_title, name))
+
+    def backups(self, group_title):
+        """Returns dicts of existing backups of a group, oldest first."""
+        with self.connect() as conn:
+            conn.row_factory = dict_factory
+            return conn.execute(
+                'SELECT * FROM backups WHERE group_title = ? AND '
+                'deleted_at IS NULL ORDER BY created_at, name',
+                (group_title,)).fetchall()
+
+    def find(self, group_title, name):
+        """Returns the dict of a backup or None."""
+        with self.connect() as conn:
+            conn.row_factory = dict_factory
+            return conn.execute(
+                'SELECT * FROM backups WHERE group_title = ? AND name = ?',
+                (group_title, name)).fetchone()
+
+    def mark_deleted(self, group_title, names):
+        with self.connect() as conn:
+            conn.executemany(
+                'UPDATE backups SET deleted_at = ? WHERE group_title = ? AND '
+                'name = ?', [(time.time(), group_title, n) for n in names])
+
+    def unshipped(self, group_title, target):
+        """Returns names of existing backups not shipped to ``target``."""
+        with self.connect() as conn:
+            return [row[0] for row in conn.execute(
+                'SELECT name FROM backups b WHERE group_title = ? AND '
+                'deleted_at IS NULL AND NOT EXISTS (SELECT 1 FROM shipments s '
+                'WHERE s.backup_id = b.id AND s.target = ?) ORDER BY name',
+                (group_title, target))]
+
+    def record_shipment(self, group_title, target, names):
+        with self.connect() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO shipments (backup_id, target, '
+                'shipped_at) SELECT id, ?, ? FROM backups WHERE '
+                'group_title = ? AND name = ?',
+                [(target, time.time(), group_title, n) for n in names])
+
+    def shipments(self, group_title):
+        """Returns a dict of backup name -> list of targets."""
+        with self.connect() as conn:
+            shipped = dict()
+            for name, target in conn.execute(
+                    'SELECT b.name, s.target FROM shipments s JOIN backups b '
+                    'ON b.id = s.backup_id WHERE b.group_title = ?',
+                    (group_title,)):
+                shipped.setdefault(name, []).append(target)
+            return shipped
+
+    def ensure_imported(self, group_title, group_dir):
+        """Imports ``group_dir`` once, see ``import_group``."""
+        with self.connect() as conn:
+            if conn.execute('SELECT 1 FROM imported_groups WHERE '
+                            'group_title = ?', (group_title,)).fetchone():
+                return
+
+        self.import_group(group_title, group_dir)
+
+        with self.connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO imported_groups VALUES (?, ?)',
+                         (group_title, time.time()))
+
+    def import_group(self, group_title, group_dir):
+        """Records backups that exist in ``group_dir`` but not in the catalog.
+
+        Used for groups created before the catalog existed. Shipments from
+        an old ``.index/shipped.log`` are imported as well.
+        """
+        if not os.path.exists(group_dir):
+            return
+
+        rows = list()
+        for fname in os.listdir(group_dir):
+            name = parse_backup_name(fname)
+            if name is not None:
+                rows.append((group_title, name['postfix'], name['prefix'],
+                             prefix_to_timestamp(name['prefix']), fname,
+                             path_size(os.path.join(group_dir, fname))))
+
+        with self.connect() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO backups (group_title, item, prefix, '
+                'created_at, name, size) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+        log_path = os.path.join(group_dir, '.index', 'shipped.log')
+        if os.path.exists(log_path):
+            with open(log_path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.record_shipment(group_title, entry['target'],
+                                         [entry['name']])
+
+
+def dict_factory(cursor, row):
+    return dict((col[0], value) for col, value in zip(cursor.description, row))
+
+
+def prefix_to_timestamp(prefix):
+    """Converts a filename prefix in local time to a unix timestamp."""
+    return time.mktime(datetime.strptime(prefix, PREFIX_FORMAT).timetuple())
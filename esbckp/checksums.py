@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import hashlib
+import os
+
+CHECKSUM_SUFFIX = '.sha256'
+
+# Bytes read from a file at once.
+READ_SIZE = 1024 * 1024
+
+
+def file_sha256(path, block_size=READ_SIZE):
+    """Returns the hex sha256 digest of the file at ``path``."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class HashingWriter(object):
+    """File-like object that hashes everything it writes to ``fileobj``."""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+class HashingReader(object):
+    """Seekable file object that hashes ``fileobj`` while it is read.
+
+    Data is hashed as long as it is read in order. Readers that jump
+    around, like ``gzip`` at the end of a member, may do so, ``hexdigest``
+    reads whatever was not hashed yet.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        pos = self.fileobj.tell()
+        data = self.fileobj.read(size)
+        if pos <= self.size < pos + len(data):
+            self.sha256.update(data[self.size - pos:])
+            self.size = pos + len(data)
+        return data
+
+    def seek(self, pos, whence=0):
+        self.fileobj.seek(pos, whence)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def close(self):
+        self.fileobj.close()
+
+    def hexdigest(self):
+        self.fileobj.seek(self.size)
+        while self.read(READ_SIZE):
+            pass
+        return self.sha256.hexdigest()
+
+
+def checksum_path(path):
+    """Returns the path of the checksums of the backup at ``path``."""
+    head, tail = os.path.split(path)
+    return os.path.join(head, '.{}{}'.format(tail, CHECKSUM_SUFFIX))
+
+
+def write_checksums(path, checksums):
+    """Writes the checksums of the files of the backup at ``path``.
+
+    The file has the format of ``sha256sum`` with paths relative to the
+    group directory, so ``sha256sum -c`` checks a copy without esbckp.
+
+    :param checksums: List of relative path and hex digest tuples.
+    """
+    with open(checksum_path(path) + '.tmp', 'w') as f:
+        f.write(checksums_text(checksums))
+    os.rename(checksum_path(path) + '.tmp', checksum_path(path))
+
+
+def read_checksums(path):
+    """Returns the checksums of the backup at ``path`` or None."""
+    try:
+        with open(checksum_path(path)) as f:
+            lines = f.read().decode('utf-8').splitlines()
+    except IOError:
+        return None
+    return [tuple(reversed(line.split('  ', 1))) for line in lines if line]
+
+
+def checksums_text(checksums):
+    return ''.join('{}  {}\n'.format(digest, name)
+                   for name, digest in checksums).encode('utf-8')
+
+
+def checksums_digest(checksums):
+    """Returns the digest the catalog records for a backup of several
+    files, the digest of its checksum file.
+    """
+    return hashlib.sha256(checksums_text(checksums)).hexdigest()
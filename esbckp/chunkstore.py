@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import click
+import hashlib
+import json
+import os
+import struct
+import zlib
+from .constants import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MANIFEST_EXTENSION = '.manifest'
+
+# Chunk sizes of the content defined chunker. The average chunk size is
+# about MIN_CHUNK_SIZE plus 2^CUT_BITS bytes.
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+CUT_BITS = 20
+CUT_MASK = ((1 << CUT_BITS) - 1) << (32 - CUT_BITS)
+
+# Gear table with one pseudo random 32 bit value per byte value. It is
+# derived from sha256 so chunk boundaries are stable across versions.
+GEAR = [struct.unpack(b'>I', hashlib.sha256(bytearray([i])).digest()[:4])[0]
+        for i in range(256)]
+
+# Bytes that make up the gear hash, older ones are shifted out of its 32
+# bits. From this many bytes after MIN_CHUNK_SIZE on, the hash only
+# depends on the last HASH_WINDOW bytes and can be computed for a whole
+# buffer at once.
+HASH_WINDOW = 32
+
+
+class ChunkStore(object):
+    """Content addressed store of zlib compressed chunks.
+
+    Each chunk is stored once under ``<path>/<hash[:2]>/<hash>`` where hash
+    is the sha256 of the uncompressed data. The store is shared by all
+    groups of a ``backup_storage_dir``, so identical data is only kept once
+    across runs and groups.
+    """
+    def __init__(self, path, level=6):
+        self.path = path
+        self.level = level
+
+    def chunk_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def put(self, data):
+        """Stores ``data`` if it is not stored yet and returns its hash.
+
+        :return: Tuple of hash and number of bytes written to disk.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+
+        if os.path.exists(path):
+            return digest, 0
+
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Created concurrently by another worker.
+                pass
+
+        compressed = zlib.compress(data, self.level)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(compressed)
+        os.rename(tmp_path, path)
+
+        return digest, len(compressed)
+
+    def get(self, digest):
+        """Returns the uncompressed data of a chunk.
+
+        :raises: ClickException if the data does not match ``digest``.
+        """
+        with open(self.chunk_path(digest), 'rb') as f:
+            data = zlib.decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise click.ClickException(ERR_CHUNK_DAMAGED.format(digest))
+        return data
+
+    def gc(self, manifest_paths, dry_run=True):
+        """Removes chunks not referenced by any of ``manifest_paths``.
+
+        :return: List of paths of unreferenced chunks.
+        """
+        referenced = set()
+        for manifest_path in manifest_paths:
+            chunks = read_manifest(manifest_path)['chunks']
+            referenced.update(digest for digest, _ in chunks)
+
+        unreferenced = list()
+        if not os.path.exists(self.path):
+            return unreferenced
+
+        for sub in os.listdir(self.path):
+            for digest in os.listdir(os.path.join(self.path, sub)):
+                if digest not in referenced:
+                    unreferenced.append(os.path.join(self.path, sub, digest))
+
+        if not dry_run:
+            for path in unreferenced:
+                os.remove(path)
+
+        return unreferenced
+
+
+class ChunkWriter(object):
+    """File-like object that splits a stream into content defined chunks.
+
+    Boundaries are found with a gear rolling hash, so an insertion or
+    deletion in the stream only changes the chunks around it. Chunks are
+    put into a ``ChunkStore``, ``close`` writes the manifest.
+
+    The first MIN_CHUNK_SIZE bytes of a chunk are not hashed. The hash of
+    the rest runs in Python at a few MB/s unless numpy is installed, which
+    computes the same boundaries vectorised, see ``_find_cut_numpy``.
+    """
+    def __init__(self, store, manifest_path, meta=None):
+        self.store = store
+        self.manifest_path = manifest_path
+        self.meta = meta or {}
+        self.chunks = []
+        self.bytes_in = 0
+        self.bytes_stored = 0
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._hash = 0
+
+    def write(self, data):
+        self._buffer.extend(data)
+        self.bytes_in += len(data)
+
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                return
+            self._emit(cut)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._buffer:
+            self._emit(len(self._buffer))
+
+        manifest = dict(self.meta)
+        manifest['version'] = 1
+        manifest['size'] = self.bytes_in
+        manifest['chunks'] = self.chunks
+
+        head, tail = os.path.split(self.manifest_path)
+        tmp_path = os.path.join(head, '.{}.tmp'.format(tail))
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp_path, self.manifest_path)
+
+    def _find_cut(self):
+        """Returns the end of the next chunk in the buffer or None."""
+        buf = self._buffer
+        end = min(len(buf), MAX_CHUNK_SIZE)
+        pos = max(self._scanned, MIN_CHUNK_SIZE)
+        h = self._hash
+
+        if numpy is not None:
+            warm_up = min(end, MIN_CHUNK_SIZE + HASH_WINDOW)
+        else:
+            warm_up = end
+
+        gear = GEAR
+        while pos < warm_up:
+            h = ((h << 1) + gear[buf[pos]]) & 0xffffffff
+            pos += 1
+            if not h & CUT_MASK:
+                return pos
+
+        if pos < end:
+            cut, h = _find_cut_numpy(buf, pos, end)
+            if cut is not None:
+                return cut
+            pos = end
+
+        if end == MAX_CHUNK_SIZE:
+            return end
+
+        self._scanned = pos
+        self._hash = h
+        return None
+
+    def _emit(self, cut):
+        data = bytes(self._buffer[:cut])
+        del self._buffer[:cut]
+        self._scanned = 0
+        self._hash = 0
+
+        digest, stored = self.store.put(data)
+        self.chunks.append([digest, len(data)])
+        self.bytes_stored += stored
+
+
+def _find_cut_numpy(buf, pos, end):
+    """Returns the first boundary between ``pos`` and ``end`` and the hash
+    after ``end``, at least HASH_WINDOW bytes after the hash started.
+
+    The hash of each byte is the sum of the gear values of the window
+    ending there, shifted by their distance, in uint32 which wraps like
+    the rolling hash. Windows are doubled from one byte on, so the hash
+    of the window of ``2w`` bytes ending at ``p`` is the one of ``w``
+    bytes plus the one ending at ``p - w`` shifted by ``w``.
+    """
+    start = pos - (HASH_WINDOW - 1)
+    hashes = GEAR_ARRAY[numpy.frombuffer(bytes(buf[start:end]), numpy.uint8)]
+    width = 1
+    while width < HASH_WINDOW:
+        hashes = hashes[width:] + (hashes[:-width] << numpy.uint32(width))
+        width *= 2
+
+    hits = numpy.flatnonzero(hashes & numpy.uint32(CUT_MASK) == 0)
+    if len(hits):
+        return pos + int(hits[0]) + 1, None
+    return None, int(hashes[-1])
+
+
+if numpy is not None:
+    GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32)
+
+
+class ChunkReader(object):
+    """File-like object that reads the stream of a manifest back."""
+    def __init__(self, store, manifest):
+        self.store = store
+        self._chunks = iter(manifest['chunks'])
+        self._buffer = b''
+        self._pos = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._pos >= len(self._buffer):
+                try:
+                    digest, _ = next(self._chunks)
+                except StopIteration:
+                    break
+                self._buffer = self.store.get(digest)
+                self._pos = 0
+
+            available = len(self._buffer) - self._pos
+            take = available if size < 0 else min(size, available)
+            parts.append(self._buffer[self._pos:self._pos + take])
+            self._pos += take
+            if size > 0:
+                size -= take
+
+        return b''.join(parts)
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def find_manifests(backup_storage_dir):
+    """Returns paths of all manifests of all groups in the storage dir.
+
+    Partial manifests count as well, a backup renames its manifest only
+    after it released the chunk lock.
+    """
+    extensions = (MANIFEST_EXTENSION, MANIFEST_EXTENSION + '.partial')
+    paths = list()
+    for group in os.listdir(backup_storage_dir):
+        group_path = os.path.join(backup_storage_dir, group)
+        if group.startswith('.') or not os.path.isdir(group_path):
+            continue
+        paths.extend(os.path.join(group_path, f) for f in os.listdir(group_path)
+                     if f.endswith(extensions))
+    return paths
@@ -1,9 +1,21 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 import calendar
+import click
 import datetime
 import os
-from .utils import monthdelta
+import time
+from collections import defaultdict
+from .archiver import scandir
+from .checksums import checksum_path
+from .dumps import remove_path, path_size
+from .seekindex import sidecar_path
+from .metrics import measure
+from .names import parse_backup_name
+
+
+# Seconds of a day between the runs a backup stands in for.
+DAY = 24 * 60 * 60
 
 
 class Cleaner(object):
@@ -26,6 +38,21 @@ class Cleaner(object):
     ``day_of_month_to_keep``
         Calendar day of month to use for monthly backups.
 
+    ``threads``
+        Number of threads used to delete files, ``cleaner_threads`` in the
+        config.
+
+    ``keep_latest``
+        Set for groups that skip unchanged items, which have no backup of
+        the days an item did not change. The last backup before such days
+        is their restore point and is kept as long as one of them would be,
+        and the newest backup of an item is never deleted.
+
+    ``catalog``
+        Optional ``Catalog`` to read backups of ``group_title`` from
+        instead of scanning the storage dir. Backup dates are then taken
+        from the file name prefix rather than the mtime.
+
     """
     def __init__(self):
         self.days_to_keep = None
@@ -37,6 +64,12 @@ class Cleaner(object):
         self.files = []
         self.file_index_to_delete = []
         self.compare_time = datetime.datetime.now()
+        self.threads = 8
+        self.keep_latest = False
+        self.catalog = None
+        self.group_title = None
+        self.metrics = None
+        self._day_cache = dict()
 
     def clean(self, storage_dir, dry_run=True):
         """Analyzes outdated files and deletes them from the file system.
@@ -47,119 +80,309 @@ class Cleaner(object):
 
         :param storage_dir: Directory of files to be analyzed and deleted.
         :param dry_run: Flag that indicates whether files will be deleted.
-        :return:
+        :return: Number of bytes freed.
+        """
+        self.plan(storage_dir)
+        return self.delete(dry_run)
+
+    def plan(self, storage_dir):
+        """Analyzes ``storage_dir`` and marks outdated files for deletion.
+
+        :param storage_dir: Directory of files to be analyzed.
+        :return: Number of files marked for deletion.
         """
         self.storage_dir = storage_dir
-        self.files = self._get_files_and_dates()
+        if self.catalog:
+            self.files = self._get_files_and_dates_from_catalog()
+        else:
+            self.files = self._get_files_and_dates()
         file_dates = [x[1] for x in self.files]
-        self.file_index_to_delete = self._get_file_indexes_to_delete(file_dates)
+        indexes = self._get_file_indexes_to_delete(file_dates)
+        if self.keep_latest:
+            indexes = self._keep_latest_per_item(
+                self._keep_covering_backups(indexes))
+        self.file_index_to_delete = self._keep_chain_dependencies(indexes)
+        return len(self.file_index_to_delete)
+
+    def delete(self, dry_run=True):
+        """Deletes the files marked by ``plan`` unless ``dry_run`` is set.
+
+        :return: Number of bytes freed.
+        """
         if not dry_run:
-            self._delete_outdated()
-        else:
-            self._print_outdated()
+            return self._delete_outdated()
+
+        self._print_outdated()
+        return 0
 
     def _delete_outdated(self):
-        """Deletes files marked for deletion from the file system."""
+        """Deletes files marked for deletion from the file system.
+
+        Unlinks run on a pool of ``threads`` threads, since on network file
+        systems every unlink is a round trip. Directory dumps are removed as
+        trees.
+
+        :return: Number of bytes freed.
+        """
+        from multiprocessing.pool import ThreadPool
+
         self._print_outdated()
-        for outdated in sorted(self.file_index_to_delete, reverse=True):
-            os.remove(self.files[outdated][0])
-            pass
+        paths = [self.files[outdated][0]
+                 for outdated in reversed(self.file_index_to_delete)]
+
+        if not paths:
+            return 0
+
+        with measure(self.metrics, 'clean', self.group_title,
+                     self.storage_dir) as m:
+            start = time.time()
+            pool = ThreadPool(min(self.threads, len(paths)))
+            try:
+                freed = sum(pool.map(remove_and_measure, paths))
+            finally:
+                pool.close()
+                pool.join()
+
+            m['bytes_in'] = freed
+            m['stages']['clean'] = time.time() - start
+
+        if self.catalog:
+            self.catalog.mark_deleted(
+                self.group_title, [os.path.basename(p) for p in paths])
+
+        return freed
 
     def _print_outdated(self):
         """Prints all files marked for removal to stdout."""
-        for outdated in sorted(self.file_index_to_delete, reverse=True):
-            print "Marked for removal: {}".format(self.files[outdated][0])
+        if self.file_index_to_delete:
+            print '\n'.join(
+                "Marked for removal: {}".format(self.files[outdated][0])
+                for outdated in reversed(self.file_index_to_delete))
 
     def _get_files_and_dates(self):
-        """Returns a list of tuples with file path and mtime."""
-        return [(os.path.join(self.storage_dir, f),
-                 os.stat(os.path.join(self.storage_dir, f)).st_mtime)
-                for f in os.listdir(self.storage_dir)]
+        """Returns a list of tuples with file path and mtime.
+
+        Uses a single ``scandir`` pass where available, which avoids
+        joining and looking up every path again. Dotfiles hold bookkeeping
+        data and are never considered backups.
+        """
+        if scandir is None:
+            return [(os.path.join(self.storage_dir, f),
+                     os.stat(os.path.join(self.storage_dir, f)).st_mtime)
+                    for f in os.listdir(self.storage_dir)
+                    if not f.startswith('.')]
+
+        return [(entry.path, entry.stat().st_mtime)
+                for entry in scandir(self.storage_dir)
+                if not entry.name.startswith('.')]
+
+    def _get_files_and_dates_from_catalog(self):
+        """Returns a list of tuples with file path and creation time.
+
+        Backups that exist in the storage dir but not in the catalog yet
+        are imported first.
+        """
+        self.catalog.ensure_imported(self.group_title, self.storage_dir)
+        return [(os.path.join(self.storage_dir, row['name']), row['created_at'])
+                for row in self.catalog.backups(self.group_title)]
 
     def _get_file_indexes_to_delete(self, file_dates):
-        """Returns indexes of files to be deleted.
+        """Returns sorted indexes of files to be deleted.
+
+        Classifies all dates in one pass. Dates older than months_to_keep
+        and younger than days_to_keep are decided by comparing timestamps,
+        only dates in between are converted to calendar days and those
+        conversions are cached.
 
         :param file_dates: A list of dates in unix timestamp format.
         :return:
         """
-        cleanup_old = self._filter_older_than_months_to_keep(file_dates)
-        cleanup_months = self._filter_months_to_keep(file_dates)
-        cleanup_weeks = self._filter_weeks_to_keep(file_dates)
-
-        # To ensure unique indexes we return list(set(...)).
-        return list(set(cleanup_old + cleanup_months + cleanup_weeks))
+        limits = self._get_limits()
+        is_outdated = self._is_outdated
+        return [idx for idx, file_date in enumerate(file_dates)
+                if is_outdated(file_date, limits)]
 
-    def _filter_older_than_months_to_keep(self, file_dates):
-        """Returns indexes of dates that exceed months_to_keep.
+    def _is_outdated(self, file_date, limits):
+        """True if retention does not keep a backup of ``file_date``.
 
-        :param file_dates: A list of dates in unix timestamp format.
-        :param compare_time:  A datetime object to compare against.
-        :return: A list of indexes.
+        :param limits: Timestamps returned by ``_get_limits``.
         """
-        latest_date_to_keep = calendar.timegm(monthdelta(
-            self.compare_time, self.months_to_keep * -1).timetuple())
+        months_limit, weeks_limit, days_limit = limits
+        if file_date < months_limit:
+            return True
 
-        to_remove = [idx for idx,val in enumerate(file_dates)
-                     if val < latest_date_to_keep]
+        in_months = file_date <= weeks_limit
+        in_weeks = weeks_limit <= file_date <= days_limit
+        if not in_months and not in_weeks:
+            return False
 
-        return to_remove
+        day, weekday = self._get_day_and_weekday(file_date)
+        if day == self.day_of_month_to_keep:
+            return False
 
-    def _filter_months_to_keep(self, file_dates):
-        """Returns indexes of dates between weeks_to_keep and months_to_keep
-        leaving one backup per month according to day_of_month_to_keep.
+        return in_months or weekday != self.day_of_week_to_keep
 
-        :param file_dates: A list of dates in unix timestamp format.
-        :param compare_time:  A datetime object to compare against.
-        :return: A list of indexes.
-        """
-        latest_date_to_compare = calendar.timegm(monthdelta(
+    def _get_limits(self):
+        """Returns unix timestamps of the months, weeks and days limits."""
+        months_limit = calendar.timegm(monthdelta(
             self.compare_time, self.months_to_keep * -1).timetuple())
 
-        youngest_date_to_compare = calendar.timegm(
+        weeks_limit = calendar.timegm(
             (self.compare_time - datetime.timedelta(weeks=self.weeks_to_keep))
             .timetuple())
 
-        to_remove = list()
-        for idx,file_date in enumerate(file_dates):
-            dt = datetime.datetime.fromtimestamp(file_date)
+        days_limit = calendar.timegm(
+            (self.compare_time - datetime.timedelta(days=self.days_to_keep))
+            .timetuple())
 
-            cond1 = file_date <= youngest_date_to_compare
-            cond2 = file_date >= latest_date_to_compare
-            cond3 = dt.day != self.day_of_month_to_keep
+        return months_limit, weeks_limit, days_limit
 
-            if cond1 and cond2 and cond3:
-                to_remove.append(idx)
+    def _get_day_and_weekday(self, file_date):
+        """Returns local day of month and weekday (Mon is 0) of a timestamp.
 
-        return to_remove
+        Results are cached per quarter of an hour. Local days always start
+        at a quarter hour in UTC, so all timestamps in the same quarter
+        share their day.
+        """
+        key = int(file_date // 900)
+        try:
+            return self._day_cache[key]
+        except KeyError:
+            tm = time.localtime(key * 900)
+            self._day_cache[key] = (tm.tm_mday, tm.tm_wday)
+            return self._day_cache[key]
+
+    def _keep_chain_dependencies(self, indexes):
+        """Returns ``indexes`` without backups that kept backups depend on.
+
+        An incremental backup needs its full backup and all older
+        incremental backups of the same chain. A chain is identified by the
+        item's postfix and the prefix of its full backup.
+
+        :param indexes: Indexes into ``self.files`` marked for deletion.
+        :return: A list of indexes.
+        """
+        to_delete = set(indexes)
+        names = [parse_backup_name(os.path.basename(f[0])) for f in self.files]
 
-    def _filter_weeks_to_keep(self, file_dates):
-        """Returns indexes of dates between days_to_keep and weeks_to_keep.
+        newest_kept = dict()
+        for idx, name in enumerate(names):
+            if name and name['base'] and idx not in to_delete:
+                key = (name['postfix'], name['base'])
+                newest_kept[key] = max(newest_kept.get(key, ''), name['prefix'])
 
-        Leaves one backup per week according to day_of_week_to_keep to ensure
-        that the backup according to day_of_month_to_keep will not be deleted.
+        for idx, name in enumerate(names):
+            if not name:
+                continue
+            key = (name['postfix'], name['base'] or name['prefix'])
+            if key in newest_kept and name['prefix'] <= newest_kept[key]:
+                to_delete.discard(idx)
 
-        :param file_dates: A list of dates in unix timestamp format.
-        :param compare_time:  A datetime object to compare against.
+        return sorted(to_delete)
+
+    def _keep_covering_backups(self, indexes):
+        """Returns ``indexes`` without backups that stand in for a later
+        day retention keeps.
+
+        A backup stands in for the days until the next backup of its item,
+        at the time of day it was made, since skipped runs wrote nothing.
+
+        :param indexes: Indexes into ``self.files`` marked for deletion.
         :return: A list of indexes.
         """
-        latest_date_to_compare = calendar.timegm(
-            (self.compare_time - datetime.timedelta(weeks=self.weeks_to_keep))
-            .timetuple())
+        to_delete = set(indexes)
+        limits = self._get_limits()
+        now = calendar.timegm(self.compare_time.timetuple())
+
+        items = defaultdict(list)
+        for idx, (path, file_date) in enumerate(self.files):
+            name = parse_backup_name(os.path.basename(path))
+            if name:
+                items[name['postfix']].append((file_date, idx))
+
+        for backups in items.values():
+            backups.sort()
+            ends = [file_date for file_date, _ in backups[1:]] + [now]
+            for (file_date, idx), end in zip(backups, ends):
+                if idx not in to_delete:
+                    continue
+                day = file_date + DAY
+                while day < end:
+                    if not self._is_outdated(day, limits):
+                        to_delete.discard(idx)
+                        break
+                    day += DAY
+
+        return sorted(to_delete)
+
+    def _keep_latest_per_item(self, indexes):
+        """Returns ``indexes`` without the newest backup of every item."""
+        latest = dict()
+        for idx, (path, _) in enumerate(self.files):
+            name = parse_backup_name(os.path.basename(path))
+            if name and name['prefix'] >= latest.get(name['postfix'],
+                                                     ('', None))[0]:
+                latest[name['postfix']] = (name['prefix'], idx)
+
+        keep = set(idx for _, idx in latest.values())
+        return [idx for idx in indexes if idx not in keep]
+
+
+def clean_chunks(backup_storage_dir, dry_run):
+    """Removes chunks that are no longer referenced by any manifest.
+
+    Manifests of all groups in the storage dir are considered, not only the
+    selected ones, since groups share the chunk store. Chunks written by a
+    backup in progress are not referenced yet, so nothing is removed while
+    one holds the chunk lock.
+
+    :return: List of unreferenced chunks or None if they were not removed.
+    """
+    from .chunkstore import ChunkStore, find_manifests
+    from .locks import chunk_lock
 
-        youngest_date_to_compare = calendar.timegm(
-            (self.compare_time - datetime.timedelta(days=self.days_to_keep))
-            .timetuple())
+    lock = chunk_lock(backup_storage_dir)
+    if not lock.acquire():
+        click.echo('Skipped unreferenced chunks, a backup is writing chunks')
+        return None
 
-        to_remove = list()
-        for idx,file_date in enumerate(file_dates):
-            dt = datetime.datetime.fromtimestamp(file_date)
+    try:
+        store = ChunkStore(os.path.join(backup_storage_dir, '.chunks'))
+        unreferenced = store.gc(find_manifests(backup_storage_dir), dry_run)
+    finally:
+        lock.release()
+    verb = 'Marked for removal' if dry_run else 'Removed'
+    click.echo('{}: {} unreferenced chunks'.format(verb, len(unreferenced)))
+    return unreferenced
 
-            cond1 = file_date <= youngest_date_to_compare
-            cond2 = file_date >= latest_date_to_compare
-            cond3 = dt.day != self.day_of_month_to_keep
-            cond4 = dt.weekday() != self.day_of_week_to_keep
 
-            if cond1 and cond2 and cond3 and cond4:
-                to_remove.append(idx)
+def remove_and_measure(path):
+    """Removes a file or directory tree and returns the bytes freed.
 
-        return to_remove
+    Files with other hard links, such as backups linked by ``unchanged:
+    link``, free nothing.
+    """
+    if not os.path.lexists(path):
+        return 0
+    if os.path.isdir(path):
+        size = sum(st.st_size for st in (
+            os.lstat(os.path.join(dp, f))
+            for dp, _, fn in os.walk(path) for f in fn) if st.st_nlink == 1)
+    elif os.lstat(path).st_nlink > 1:
+        size = 0
+    else:
+        size = path_size(path)
+    remove_path(path)
+    remove_path(sidecar_path(path))
+    remove_path(checksum_path(path))
+    return size
+
+
+def monthdelta(date, delta):
+    """Provides ability to add/subtract months from dates."""
+    m, y = (date.month+delta) % 12, date.year + ((date.month)+delta-1) // 12
+    if not m: m = 12
+    d = min(date.day, [31,
+        29 if y%4==0 and not y%400==0 else 28,31,30,31,30,31,31,30,31,30,31][m-1])
+
+    return date.replace(day=d,month=m, year=y)
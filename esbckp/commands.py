@@ -2,8 +2,18 @@
 from __future__ import absolute_import, unicode_literals
 import click
 import esbckp
+import multiprocessing
+import os
+from contextlib import contextmanager
+from datetime import datetime
 from .constants import *
-from .utils import do_file_backups_for_group, do_database_backups_for_group
+from .locks import locked_groups
+from .metrics import profile
+from .names import parse_backup_name
+from .scheduler import Job, Scheduler
+
+# The modules that archive, restore and verify are imported by the commands
+# using them, which keeps --help and cron runs of ship and clean fast.
 
 
 @click.group()
@@ -23,41 +33,228 @@ def cli(debug):
 @click.option('--conf', default='~/etc/easybackup_conf.ini', help=HELP_CONF)
 @click.option('--groups', default=None, help=HELP_GROUP)
 @click.option('--routines', default=None, help=HELP_ROUTINES)
-def start(conf, groups, routines):
-    """Start backups."""
+@click.option('--jobs', default=1, type=int, help=HELP_JOBS)
+@click.option('--jobs-per-group', default=0, type=int, help=HELP_JOBS_PER_GROUP)
+@click.option('--jobs-per-device', default=0, type=int,
+              help=HELP_JOBS_PER_DEVICE)
+@click.option('--db-jobs', default=0, type=int, help=HELP_DB_JOBS)
+@click.option('--resume/--no-resume', default=False, help=HELP_RESUME)
+@click.option('--ship/--no-ship', default=False, help=HELP_START_SHIP)
+@click.option('--profile', 'profile_mode', default=None,
+              type=click.Choice(['cpu', 'memory']), help=HELP_PROFILE)
+def start(conf, groups, routines, jobs, jobs_per_group, jobs_per_device,
+          db_jobs, resume, ship, profile_mode):
+    """Start backups.
+
+    Timings and throughput of every item are appended to the metrics file,
+    see metrics_file in the INI file.
+
+    With --ship every finished backup is shipped while the next ones are
+    written, one transfer per host at a time over one shared ssh
+    connection. The command then takes about as long as the slower of
+    backing up and shipping instead of both.
+    """
+    from .shipper import ShipQueue, ssh_connections
+
     backup = esbckp.Backup(conf, groups, routines)
+    shippers = [shipper for group in backup.backup_groups
+                for shipper in group.shippers] if ship else []
+
+    with instrumented(backup, 'start', profile_mode), \
+            locked_groups(backup.backup_groups), ssh_connections(shippers):
+        queue = ShipQueue(backup.backup_groups) if ship else None
+        on_backup = queue.notify if queue else None
+        try:
+            if jobs > 1:
+                start_parallel(backup, jobs, jobs_per_group, jobs_per_device,
+                               db_jobs, resume, on_backup)
+            else:
+                start_serial(backup, resume, on_backup)
+        finally:
+            ship_errors = queue.close() if queue else None
+
+        if ship_errors:
+            raise click.ClickException(
+                ERR_SHIP_JOBS_FAILED.format(len(ship_errors)))
+
 
+def start_serial(backup, resume=False, on_backup=None):
+    """Backs up the items of all groups one after another.
+
+    :param on_backup: Optional callable invoked with the group after each
+        written backup.
+    """
+    from .utils import (do_file_backups_for_group,
+                        do_database_backups_for_group)
+
+    failed = 0
     for group in backup.backup_groups:
         if group.dirs:
-            do_file_backups_for_group(group)
+            do_file_backups_for_group(group, resume, on_backup)
 
         if group.dbs:
-            do_database_backups_for_group(group)
+            failed += do_database_backups_for_group(group, on_backup)
+
+    if failed:
+        raise click.ClickException(ERR_JOBS_FAILED.format(failed))
+
+
+def start_parallel(backup, jobs, jobs_per_group, jobs_per_device, db_jobs=0,
+                   resume=False, on_backup=None):
+    """Schedules all backup items of all groups on a pool of workers.
+
+    Directory archives are built in worker processes since tar and gzip are
+    CPU bound, database dumps are fanned out as subprocesses from threads.
+    The files and bytes archived by all workers are shown on one progress
+    line below the lines of finished jobs.
+    No more dumps of a source type run at once than its driver's
+    ``max_jobs``.
+
+    :param on_backup: Optional callable invoked with the group after each
+        written backup.
+    """
+    from .progress import SharedProgress, init_worker
+    from .utils import do_file_backup, do_database_backup, storage_device
+
+    scheduler = Scheduler(jobs, limits={'group': jobs_per_group,
+                                        'device': jobs_per_device,
+                                        'db': db_jobs})
+    progress = SharedProgress('all items')
+    pool = multiprocessing.Pool(jobs, init_worker, (progress.counters,))
+    job_groups = dict()
+
+    for group in backup.backup_groups:
+        group.check_or_create_base_path()
+        group_slot = ('group', group.group_title)
+        target_slot = ('device', storage_device(group.base_path))
+
+        for item in group.dirs:
+            source = os.path.expanduser(item.dir)
+            if not os.path.exists(source):
+                continue
+
+            slots = [group_slot, target_slot,
+                     ('device', storage_device(source))]
+            job = Job('{}: {}'.format(group.group_title, item.dir),
+                      pool.apply,
+                      (do_file_backup, (group, item, False, resume)), slots)
+            job_groups[job] = group
+            scheduler.add(job)
+
+        for item in group.dbs:
+            title = '{}: {}:{}'.format(group.group_title, item.db_type,
+                                       item.db_name)
+            source_slot = ('source', item.db_type)
+            scheduler.limits[source_slot] = item.source.max_jobs
+            job = Job(title, do_database_backup, (group, item),
+                      [group_slot, target_slot, ('db', None), source_slot])
+            job_groups[job] = group
+            scheduler.add(job)
+
+    def on_done(job):
+        if job.result and on_backup:
+            on_backup(job_groups[job])
+        status = click.style('failed', fg='red') if job.error else 'done'
+        progress.echo('[{}/{}] {} {} in {:.1f}s'.format(
+            len(scheduler.finished), len(scheduler), job.title, status, job.duration))
+
+    try:
+        with progress.drawing():
+            finished = scheduler.run(on_done)
+    finally:
+        pool.close()
+        pool.join()
+
+    click.echo(click.style('Timing summary', fg='yellow'))
+    for job in sorted(finished, key=lambda j: j.duration, reverse=True):
+        click.echo('{:>10.1f}s  {}'.format(job.duration, job.title))
+
+    failed = [job for job in finished if job.error]
+    if failed:
+        for job in failed:
+            click.echo(click.style(job.traceback, fg='red'), err=True)
+        raise click.ClickException(ERR_JOBS_FAILED.format(len(failed)))
 
 
 @cli.command()
 @click.option('--conf', default='~/etc/easybackup_conf.ini', help=HELP_CONF)
 @click.option('--groups', default=None, help=HELP_GROUP)
-def ship(conf, groups):
+@click.option('--jobs', default=1, type=int, help=HELP_SHIP_JOBS)
+@click.option('--jobs-per-host', default=0, type=int, help=HELP_JOBS_PER_HOST)
+@click.option('--bwlimit', default=0, type=int, help=HELP_BWLIMIT)
+@click.option('--rescan/--no-rescan', default=False, help=HELP_RESCAN)
+@click.option('--profile', 'profile_mode', default=None,
+              type=click.Choice(['cpu', 'memory']), help=HELP_PROFILE)
+def ship(conf, groups, jobs, jobs_per_host, bwlimit, rescan, profile_mode):
     """Ship backups via rsync.
 
     If shipper settings are present in the INI file this command rsyncs
-    each group folder to the configured target destination.
+    each group folder to the configured target destinations. Transfers to
+    all targets of all groups are scheduled on --jobs parallel workers.
+    Transfers to the same host share one ssh connection.
+
+    Shipped backups are recorded in the catalog and only new backups are
+    sent. Use --rescan to send everything rsync finds missing
+    on the target, e.g. after the remote copy was restored from elsewhere.
     """
+    from .shipper import ssh_connections
+
     backup = esbckp.Backup(conf, groups)
+    shippers = [shipper for group in backup.backup_groups
+                for shipper in group.shippers]
+
+    with instrumented(backup, 'ship', profile_mode), \
+            locked_groups(backup.backup_groups), ssh_connections(shippers):
+        ship_groups(backup, jobs, jobs_per_host, bwlimit, rescan)
 
-    with click.progressbar(backup.backup_groups,
-                           length=(len(backup.backup_groups)+1),
-                           label="Groups") as bg:
-        for group in bg:
-            group.ship()
+
+def ship_groups(backup, jobs, jobs_per_host, bwlimit, rescan):
+    """Schedules transfers to all targets of all groups, see ``ship``."""
+    # Split the global budget evenly between transfers that may run at the
+    # same time, so the sum never exceeds it. shipper_bwlimit is the
+    # budget of one host and is split between transfers to that host.
+    from .shipper import share_bwlimit
+
+    transfer_bwlimit = share_bwlimit(bwlimit, jobs)
+    host_share = jobs_per_host or jobs
+
+    scheduler = Scheduler(jobs, limits={'host': jobs_per_host})
+    for group in backup.backup_groups:
+        for shipper in group.shippers:
+            limits = [l for l in (transfer_bwlimit, share_bwlimit(
+                shipper.bwlimit, host_share)) if l]
+            scheduler.add(Job(
+                '{}: {}'.format(group.group_title, shipper.target),
+                shipper.ship, (min(limits) if limits else None, rescan),
+                [('host', shipper.host)]))
+
+    def on_done(job):
+        if job.error:
+            status = click.style('failed', fg='red')
+        else:
+            status = '{} new'.format(len(job.result))
+        click.echo('[{}/{}] {} {} in {:.1f}s'.format(
+            len(scheduler.finished), len(scheduler), job.title, status,
+            job.duration))
+
+    finished = scheduler.run(on_done)
+
+    failed = [job for job in finished if job.error]
+    if failed:
+        for job in failed:
+            click.echo(click.style(unicode(job.error), fg='red'), err=True)
+        raise click.ClickException(ERR_SHIP_JOBS_FAILED.format(len(failed)))
 
 
 @cli.command()
 @click.option('--conf', default='~/etc/easybackup_conf.ini', help=HELP_CONF)
 @click.option('--groups', default=None, help=HELP_GROUP)
 @click.option('--dryrun', default=True, type=bool, help=HELP_DRYRUN)
-def clean(conf, groups, dryrun):
+@click.option('--jobs', default=1, type=int, help=HELP_CLEAN_JOBS)
+@click.option('--max-delete', default=0, type=int, help=HELP_MAX_DELETE)
+@click.option('--profile', 'profile_mode', default=None,
+              type=click.Choice(['cpu', 'memory']), help=HELP_PROFILE)
+def clean(conf, groups, dryrun, jobs, max_delete, profile_mode):
     """Clean outdated backups.
 
     Note that to actually delete the outdated files from the file system, the
@@ -68,11 +265,313 @@ def clean(conf, groups, dryrun):
     and weeks_to_keep. This is because the backup according to
     day_of_month_to_keep will not be deleted, even though in most cases
     it will not fall on day_of_week_to_keep.
+
+    All groups are analyzed before anything is deleted. If more than
+    --max-delete backups would be deleted in total, nothing is deleted.
+    """
+    backup = esbckp.Backup(conf, groups)
+
+    with instrumented(backup, 'clean', profile_mode), \
+            locked_groups(backup.backup_groups):
+        clean_groups(backup, dryrun, jobs, max_delete)
+
+
+def clean_groups(backup, dryrun, jobs, max_delete):
+    """Plans all groups before deleting in parallel, see ``clean``."""
+    groups = [group for group in backup.backup_groups
+              if group.cleaner and os.path.exists(group.base_path)]
+
+    marked = sum(group.cleaner.plan(group.base_path) for group in groups)
+    if max_delete and marked > max_delete:
+        raise click.ClickException(
+            ERR_MAX_DELETE_EXCEEDED.format(marked, max_delete))
+
+    scheduler = Scheduler(jobs)
+    for group in groups:
+        scheduler.add(Job(group.group_title, group.cleaner.delete, (dryrun,)))
+
+    def on_done(job):
+        if job.error:
+            status = click.style('failed: {}'.format(job.error), fg='red')
+        elif dryrun:
+            status = 'dry run'
+        else:
+            status = 'freed {:.1f} MB'.format(job.result / 1024.0 / 1024.0)
+        click.echo('[{}/{}] {} {}'.format(
+            len(scheduler.finished), len(scheduler), job.title, status))
+
+    from .cleaner import clean_chunks
+
+    failed = [job for job in scheduler.run(on_done) if job.error]
+
+    if any(group.storage == 'chunked' for group in backup.backup_groups):
+        clean_chunks(backup.backup_storage_dir, dryrun)
+
+    if failed:
+        raise click.ClickException(ERR_CLEAN_JOBS_FAILED.format(len(failed)))
+
+
+@contextmanager
+def instrumented(backup, command, profile_mode=None):
+    """Profiles a command if requested and writes the metrics textfile.
+
+    Profiles are saved to ``.profiles`` in the backup storage dir.
+    """
+    name = '{}-{}'.format(datetime.now().strftime('%Y-%m-%d--%H-%M-%S'),
+                          command)
+    report_dir = os.path.join(backup.backup_storage_dir, '.profiles')
+    try:
+        with profile(profile_mode, report_dir, name):
+            yield
+    finally:
+        backup.metrics.write_textfile(command)
+
+
+@cli.command('list')
+@click.option('--conf', default='~/etc/easybackup_conf.ini', help=HELP_CONF)
+@click.option('--groups', default=None, help=HELP_GROUP)
+def list_backups(conf, groups):
+    """List backups recorded in the catalog.
+
+    Prints one line per backup with its size, codec, duration and the
+    targets it was shipped to.
+    """
+    backup = esbckp.Backup(conf, groups)
+
+    for group in backup.backup_groups:
+        catalog = backup.catalog
+        catalog.ensure_imported(group.group_title, group.base_path)
+        shipments = catalog.shipments(group.group_title)
+
+        click.echo(click.style(group.group_title, fg='yellow'))
+        for row in catalog.backups(group.group_title):
+            click.echo('  {}  {:>10.1f} MB  {:<16} {:>7}  {}'.format(
+                row['name'],
+                (row['size'] or 0) / 1024.0 / 1024.0,
+                row['codec'] or '-',
+                '{:.1f}s'.format(row['duration'])
+                if row['duration'] is not None else '-',
+                ', '.join(sorted(shipments.get(row['name'], []))) or '-'))
+
+
+@cli.command()
+@click.option('--conf', default='~/etc/easybackup_conf.ini', help=HELP_CONF)
+@click.option('--group', required=True, help=HELP_RESTORE_GROUP)
+@click.option('--item', required=True, help=HELP_RESTORE_ITEM)
+@click.option('--at', default=None, help=HELP_RESTORE_AT)
+@click.option('--target', required=True, help=HELP_RESTORE_TARGET)
+@click.option('--path', default=None, help=HELP_RESTORE_PATH)
+@click.option('--jobs', default=1, type=int, help=HELP_RESTORE_JOBS)
+def restore(conf, group, item, at, target, path, jobs):
+    """Restore a backed up directory.
+
+    Restores archives, split archives and chunked manifests. For
+    incremental backups the full backup and all incrementals up to --at are
+    applied in order.
+
+    Archives written with gzip or none have an index of their members, so
+    --path only reads the parts of them it needs.
+    """
+    from .restore import find_restore_chain, restore_chain
+
+    backup = esbckp.Backup(conf, group)
+    groups = [g for g in backup.backup_groups if g.group_title == group]
+    if not groups:
+        raise click.ClickException(ERR_UNKNOWN_GROUP.format(group))
+
+    target = os.path.expanduser(target)
+    if not os.path.exists(target):
+        os.makedirs(target)
+
+    restore_chain(groups[0], find_restore_chain(groups[0], item, at), target,
+                  os.path.expanduser(item), path, max(1, jobs))
+
+
+@cli.command()
+@click.option('--conf', default='~/etc/easybackup_conf.ini', help=HELP_CONF)
+@click.option('--groups', default=None, help=HELP_GROUP)
+@click.option('--jobs', default=1, type=int, help=HELP_VERIFY_JOBS)
+@click.option('--latest/--all', default=False, help=HELP_VERIFY_LATEST)
+@click.option('--remote/--no-remote', default=False, help=HELP_VERIFY_REMOTE)
+@click.option('--profile', 'profile_mode', default=None,
+              type=click.Choice(['cpu', 'memory']), help=HELP_PROFILE)
+def verify(conf, groups, jobs, latest, remote, profile_mode):
+    """Verify that backups can be read back.
+
+    Every file of the backups in the catalog is read once. Its sha256 is
+    compared with the one recorded when it was written, archives are
+    decompressed and walked member by member and dumps are listed with
+    pg_restore --list. Files are verified by --jobs parallel workers.
+
+    With --remote shipped copies are compared with the catalog as well.
+    sha256sum runs on the shipper hosts, so nothing is downloaded.
+
+    Set verify: yes in a group to verify every backup right after it was
+    written.
     """
     backup = esbckp.Backup(conf, groups)
 
-    with click.progressbar(backup.backup_groups,
-                           length=(len(backup.backup_groups) + 1),
-                           label="Groups") as bg:
-        for group in bg:
-            group.clean(dry_run=dryrun)
+    with instrumented(backup, 'verify', profile_mode):
+        verify_groups(backup, jobs, latest, remote)
+
+
+def verify_groups(backup, jobs, latest, remote):
+    """Schedules the files of all backups of all groups, see ``verify``."""
+    from .verify import backup_files, verify_file
+
+    scheduler = Scheduler(jobs, limits={'host': 1})
+    failed = list()
+
+    for group in backup.backup_groups:
+        catalog = backup.catalog
+        catalog.ensure_imported(group.group_title, group.base_path)
+        rows = catalog.backups(group.group_title)
+        if latest:
+            # Rows are sorted oldest first, so the latest of an item wins.
+            # Imported rows spell items differently, the name postfix not.
+            latest_rows = dict(
+                (parse_backup_name(row['name'])['postfix'], row)
+                for row in rows)
+            rows = sorted(latest_rows.values(), key=lambda row: row['name'])
+        shipments = catalog.shipments(group.group_title)
+        shipped = dict((s.target, dict()) for s in group.shippers)
+
+        for row in rows:
+            path = os.path.join(group.base_path, row['name'])
+            try:
+                files = backup_files(path, row['sha256'])
+            except click.ClickException, e:
+                click.echo(click.style(e.message, fg='red'), err=True)
+                failed.append(row['name'])
+                continue
+
+            for file_path, digest in files:
+                name = os.path.relpath(file_path, group.base_path)
+                scheduler.add(Job('{}: {}'.format(group.group_title, name),
+                                  verify_file, (group, file_path, digest)))
+                for target in shipments.get(row['name'], []):
+                    if digest and target in shipped:
+                        shipped[target][name] = digest
+
+        for shipper in group.shippers if remote else []:
+            if shipped[shipper.target]:
+                scheduler.add(Job(
+                    '{}: {}'.format(group.group_title, shipper.target),
+                    shipper.verify, (shipped[shipper.target],),
+                    [('host', shipper.host)]))
+
+    def on_done(job):
+        if job.error:
+            status = click.style('failed', fg='red')
+        elif job.result:
+            status = '{} shipped file(s) match'.format(job.result)
+        else:
+            status = 'ok'
+        click.echo('[{}/{}] {} {} in {:.1f}s'.format(
+            len(scheduler.finished), len(scheduler), job.title, status,
+            job.duration))
+
+    finished = scheduler.run(on_done)
+
+    failed.extend(job for job in finished if job.error)
+    for job in finished:
+        if job.error:
+            click.echo(click.style(unicode(job.error), fg='red'), err=True)
+    if failed:
+        raise click.ClickException(ERR_VERIFY_FAILED.format(len(failed)))
+
+
+@cli.command()
+@click.option('--conf', default='~/etc/easybackup_conf.ini', help=HELP_CONF)
+@click.option('--group', required=True, help=HELP_DECRYPT_GROUP)
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def decrypt(conf, group, path):
+    """Write the plaintext of an encrypted backup file to stdout.
+
+    Archives are restored with the restore command, this is meant for
+    dumps, e.g. esbckp decrypt --group=test3 <name>.dump.enc | pg_restore
+    -d db_name
+    """
+    from .encryption import CHUNK_SIZE, open_decrypted
+
+    backup = esbckp.Backup(conf, group)
+    groups = [g for g in backup.backup_groups if g.group_title == group]
+    if not groups:
+        raise click.ClickException(ERR_UNKNOWN_GROUP.format(group))
+
+    reader = open_decrypted(path, groups[0].encryption_key)
+    out = click.get_binary_stream('stdout')
+    try:
+        for block in iter(lambda: reader.read(CHUNK_SIZE), b''):
+            out.write(block)
+    finally:
+        reader.close()
+
+
+@cli.command()
+@click.option('--conf', default='~/etc/easybackup_conf.ini', help=HELP_CONF)
+@click.option('--groups', default=None, help=HELP_GROUP)
+@click.option('--jobs', default=1, type=int, help=HELP_DAEMON_JOBS)
+@click.option('--socket', 'socket_path', default=None, help=HELP_SOCKET)
+def daemon(conf, groups, jobs, socket_path):
+    """Run backups on the schedules of the config file.
+
+    Groups with a schedule run their pipeline, start, ship and clean by
+    default, whenever it is due. Each stage starts as soon as the one
+    before it is done. The clean stage deletes outdated backups, leave it
+    out of the pipeline to keep them.
+
+    The daemon runs in the foreground, reloads the config file when it
+    changes and stops on SIGTERM after the running pipelines. Use the ctl
+    command to inspect and trigger groups.
+    """
+    from .daemon import Daemon
+
+    Daemon(conf, groups, jobs, socket_path).run()
+
+
+@cli.command()
+@click.option('--conf', default='~/etc/easybackup_conf.ini', help=HELP_CONF)
+@click.option('--socket', 'socket_path', default=None, help=HELP_SOCKET)
+@click.option('--stages', default=None, help=HELP_CTL_STAGES)
+@click.argument('action', type=click.Choice(['status', 'trigger', 'reload',
+                                             'stop']))
+@click.argument('group', required=False)
+def ctl(conf, socket_path, stages, action, group):
+    """Control a running daemon.
+
+    status lists the groups with their schedule, state and last run,
+    trigger GROUP queues the pipeline of a group now, reload reads the
+    config file again and stop stops the daemon.
+    """
+    from .config import load_config, split_values
+    from .daemon import default_socket_path, send_request
+
+    if action == 'trigger' and not group:
+        raise click.UsageError(ERR_TRIGGER_GROUP_MISSING)
+
+    socket_path = socket_path or default_socket_path(
+        load_config(conf).backup_storage_dir)
+    request = {'command': action}
+    if action == 'trigger':
+        request['group'] = group
+        request['stages'] = split_values(stages) if stages else None
+
+    result = send_request(socket_path, request)
+
+    if action == 'trigger':
+        click.echo('Queued {}'.format(group) if result else
+                   '{} is already queued or running'.format(group))
+    elif action == 'stop':
+        click.echo('Stopping after the running pipelines')
+    else:
+        for state in result:
+            click.echo('{:<20} {:<8} {:<6} next {:<19}  last {} {}'.format(
+                state['group'],
+                state['state'],
+                state['stage'] or '-',
+                state['next_run'] or '-',
+                state['finished'] or '-',
+                {True: 'ok', False: click.style(
+                    'failed: {}'.format(state['error']), fg='red'),
+                 None: ''}[state['ok']]))
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import click
+import gzip
+import subprocess
+import threading
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from .constants import *
+
+
+# Codec name -> (file extension, external command or None).
+CODECS = {
+    'gzip': ('.tar.gz', None),
+    'pigz': ('.tar.gz', ['pigz', '-c', '-{level}', '-p', '{threads}']),
+    'zstd': ('.tar.zst', ['zstd', '-q', '-c', '-{level}', '-T{threads}']),
+    'lz4': ('.tar.lz4', ['lz4', '-q', '-c', '-{level}']),
+    'none': ('.tar', None),
+}
+
+DEFAULT_LEVELS = {
+    'gzip': 9,
+    'pigz': 6,
+    'zstd': 3,
+    'lz4': 1,
+    'none': 0,
+}
+
+
+class Compression(object):
+    """Configuration and writer factory for the compression of archives.
+
+    ``gzip`` compresses in process and switches to block-parallel gzip when
+    ``threads`` is greater than 1. ``pigz``, ``zstd`` and ``lz4`` pipe the
+    tar stream through the external command.
+    """
+    def __init__(self, codec='gzip', level=None, threads=1):
+        if codec not in CODECS:
+            raise click.ClickException(
+                ERR_UNKNOWN_COMPRESSION.format(codec, ', '.join(sorted(CODECS))))
+
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else int(level)
+        self.threads = max(1, int(threads))
+
+    @property
+    def extension(self):
+        return CODECS[self.codec][0]
+
+    @property
+    def stream_extension(self):
+        """Extension of compressed streams other than tar, e.g. ``.gz``."""
+        return self.extension[len('.tar'):]
+
+    def get_cmd(self):
+        """Returns the external compressor command as list or None."""
+        cmd = CODECS[self.codec][1]
+        if cmd is None:
+            return None
+        return [t.format(level=self.level, threads=self.threads) for t in cmd]
+
+    @contextmanager
+    def open(self, fileobj, seek_points=None):
+        """Yields a file object that compresses everything written to it
+        into ``fileobj``.
+
+        :param seek_points: Optional list that receives the uncompressed
+            and compressed offsets of the gzip members of in process gzip
+            streams. A stream is then always written as one member per
+            block, which lets readers start at every block, see
+            ``seekindex.GzipSeekReader``.
+        """
+        cmd = self.get_cmd()
+
+        if cmd:
+            # Only real files can be handed to the compressor, the output
+            # for other file objects is copied by a thread.
+            errors = list()
+            if hasattr(fileobj, 'fileno'):
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                        stdout=fileobj)
+                pump = None
+            else:
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+                pump = threading.Thread(target=copy_stream,
+                                        args=(proc.stdout, fileobj, errors))
+                pump.start()
+            try:
+                yield proc.stdin
+            finally:
+                proc.stdin.close()
+                if pump:
+                    pump.join()
+                returncode = proc.wait()
+            if errors:
+                raise errors[0]
+            if returncode != 0:
+                raise click.ClickException(
+                    ERR_COMPRESSOR_FAILED.format(' '.join(cmd), returncode))
+
+        elif self.codec == 'none':
+            yield fileobj
+
+        elif self.threads > 1 or seek_points is not None:
+            writer = ParallelGzipWriter(fileobj, self.level, self.threads,
+                                        seek_points=seek_points)
+            try:
+                yield writer
+            finally:
+                writer.close()
+
+        else:
+            writer = gzip.GzipFile(fileobj=fileobj, mode='wb',
+                                   compresslevel=self.level)
+            try:
+                yield writer
+            finally:
+                writer.close()
+
+
+def copy_stream(source, target, errors, block_size=1024 * 1024):
+    """Copies ``source`` to ``target`` until the end of ``source``.
+
+    Meant to run in a thread. An exception is appended to ``errors`` and
+    closes ``source``, so the process writing to it fails instead of
+    blocking.
+    """
+    try:
+        for block in iter(lambda: source.read(block_size), b''):
+            target.write(block)
+    except BaseException, e:
+        errors.append(e)
+        source.close()
+
+
+class ParallelGzipWriter(object):
+    """File-like object that compresses blocks on a pool of threads.
+
+    Every block is written as a complete gzip member. Concatenated gzip
+    members are a valid gzip file, so the result can be read with gunzip
+    and the ``gzip``/``tarfile`` modules. zlib releases the GIL while
+    compressing, which makes threads sufficient here.
+
+    :param seek_points: Optional list that receives the uncompressed and
+        compressed offset of every member.
+    """
+    def __init__(self, fileobj, level=6, threads=2, block_size=1024 * 1024,
+                 seek_points=None):
+        from multiprocessing.pool import ThreadPool
+
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.max_pending = threads * 2
+        self.seek_points = seek_points
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._pool = ThreadPool(threads)
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._pool is None:
+            return
+        if self._buffered:
+            self._submit()
+        while self._pending:
+            self._write_next()
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+    def _submit(self):
+        block = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append((len(block), self._pool.apply_async(
+            compress_gzip_member, (block, self.level))))
+        while len(self._pending) > self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        size, result = self._pending.popleft()
+        data = result.get()
+        if self.seek_points is not None:
+            self.seek_points.append((self.bytes_in, self.bytes_out))
+        self.fileobj.write(data)
+        self.bytes_in += size
+        self.bytes_out += len(data)
+
+
+def compress_gzip_member(data, level):
+    """Returns ``data`` compressed as one complete gzip member."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""Typed model of the INI file.
+
+``load_config`` parses and validates the file into a ``Config`` with one
+``GroupConfig`` per section. The model only holds plain values, so it is
+cached as a pickle keyed on the path, mtime and size of the file. Later
+runs skip ``ConfigParser`` and all validation until the file changes.
+Caches of other users or writable by them are ignored.
+
+``Backup`` turns the ``GroupConfig`` of the selected groups into
+``BackupGroup`` objects with their ``Compression``, ``Shipper`` and
+``Cleaner``, other groups cost nothing beyond the cache.
+"""
+from __future__ import absolute_import, unicode_literals
+import click
+import cPickle as pickle
+import hashlib
+import os
+from collections import OrderedDict
+from .constants import *
+
+# Bump when the model changes, older caches are then compiled again.
+CACHE_VERSION = 3
+
+# Errors of a cache that was written by another version or is damaged.
+CACHE_ERRORS = (IOError, OSError, EOFError, ValueError, TypeError,
+                AttributeError, ImportError, IndexError, pickle.PickleError)
+
+
+class Model(object):
+    """Base of the config classes. Slots not passed to ``__init__`` are
+    None.
+    """
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.pop(name, None))
+        if values:
+            raise TypeError('Unknown fields {}'.format(', '.join(values)))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, n) == getattr(other, n) for n in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(n, getattr(self, n)) for n in self.__slots__))
+
+
+class Config(Model):
+    """Settings of the DEFAULT section and the groups by title.
+
+    In a cached config the values of ``groups`` are pickled until ``group``
+    loads them, so a run only unpickles the groups it selects.
+    """
+    __slots__ = ('backup_storage_dir', 'metrics_file', 'metrics_textfile_dir',
+                 'groups')
+
+    def group(self, title):
+        """Returns the ``GroupConfig`` of ``title``.
+
+        :raises: ClickException if the group is unknown or invalid.
+        """
+        group = self.groups.get(title)
+        if group is None:
+            raise click.ClickException(ERR_UNKNOWN_GROUP.format(title))
+        if isinstance(group, bytes):
+            group = self.groups[title] = pickle.loads(group)
+        if group.error:
+            raise click.ClickException(group.error)
+        return group
+
+    def select(self, groups=None):
+        """Returns the titles of the groups named in the comma separated
+        ``groups`` in file order, all titles if ``groups`` is empty.
+
+        :raises: ClickException if a name is no group.
+        """
+        if not groups:
+            return list(self.groups)
+        names = split_values(groups)
+        for name in names:
+            if name not in self.groups:
+                raise click.ClickException(ERR_UNKNOWN_GROUP.format(name))
+        return [title for title in self.groups if title in names]
+
+
+class GroupConfig(Model):
+    """Validated settings of one section.
+
+    ``error`` holds the message of an invalid section instead of raising
+    it, so a broken group only fails the commands that select it.
+    """
+    __slots__ = ('title', 'dirs', 'dbs', 'compression', 'compression_level',
+                 'compression_threads', 'mode', 'full_every', 'unchanged',
+                 'exclude', 'include', 'max_file_size', 'one_file_system',
+                 'storage', 'volume_size', 'db_format', 'db_jobs', 'verify',
+                 'encryption_key_file', 'schedule', 'pipeline', 'shipper',
+                 'cleaner', 'error')
+
+
+class ShipperConfig(Model):
+    """Shipper settings of a group, shared by all of its ``hosts``."""
+    __slots__ = ('hosts', 'ssh_port', 'user', 'target_dir', 'bwlimit',
+                 'retries', 'volume_jobs')
+
+
+class CleanerConfig(Model):
+    """Retention settings of a group, see ``Cleaner``."""
+    __slots__ = ('days_to_keep', 'weeks_to_keep', 'months_to_keep',
+                 'day_of_week_to_keep', 'day_of_month_to_keep', 'threads')
+
+
+def load_config(path, cache_dir=None):
+    """Returns the ``Config`` of the INI file at ``path``.
+
+    The cached model is used if it was compiled from the current mtime and
+    size of the file, otherwise the file is compiled and the cache
+    replaced. Caches that can't be read or written are ignored.
+
+    :param cache_dir: Directory of the cache, by default esbckp in
+        ``$XDG_CACHE_HOME`` or ``~/.cache``. An empty string disables it.
+    :raises: ClickException if the file is missing or invalid as a whole.
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise click.ClickException(ERR_CONFIG_FILE_DOES_NOT_EXIST)
+    key = (CACHE_VERSION, path, stat.st_mtime, stat.st_size)
+
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or '~/.cache', 'esbckp')
+
+    cache = None
+    if cache_dir:
+        cache = os.path.join(os.path.expanduser(cache_dir), 'config-{}.pickle'
+                             .format(hashlib.sha1(path.encode('utf-8'))
+                                     .hexdigest()[:16]))
+        try:
+            cached_key, config = _read_cache(cache)
+            if cached_key == key:
+                return config
+        except CACHE_ERRORS:
+            pass
+
+    config = compile_config(path)
+    if cache:
+        packed = Config(**dict((name, getattr(config, name))
+                               for name in Config.__slots__))
+        packed.groups = OrderedDict(
+            (title, pickle.dumps(group, pickle.HIGHEST_PROTOCOL))
+            for title, group in config.groups.items())
+        _write_cache(cache, (key, packed))
+    return config
+
+
+def _read_cache(path):
+    """Returns the value of the cache at ``path``.
+
+    Unpickling can run code, so the cache, including the groups pickled
+    in it, is only read if it belongs to the current user and nobody else
+    can write it.
+
+    :raises: One of ``CACHE_ERRORS`` if the cache can't be used.
+    """
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            raise IOError('{} may have been written by another user'
+                          .format(path))
+        return pickle.load(f)
+
+
+def _write_cache(path, value):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o700)
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                               0o600), 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def compile_config(path):
+    """Parses and validates the INI file at ``path`` into a ``Config``."""
+    from ConfigParser import ConfigParser
+
+    parser = ConfigParser()
+    parser.read([path])
+    defaults = parser.defaults()
+    if not defaults.get('backup_storage_dir'):
+        raise click.ClickException(ERR_STORAGE_DIR_MISSING.format(path))
+
+    groups = OrderedDict()
+    for section in parser.sections():
+        groups[section] = compile_group(parser, section)
+
+    return Config(backup_storage_dir=defaults['backup_storage_dir'],
+                  metrics_file=defaults.get('metrics_file') or None,
+                  metrics_textfile_dir=defaults.get('metrics_textfile_dir') or
+                  None,
+                  groups=groups)
+
+
+def compile_group(parser, section):
+    """Returns the ``GroupConfig`` of ``section``, see ``GroupConfig.error``.
+    """
+    from ConfigParser import Error
+
+    group = GroupConfig(title=section)
+    try:
+        # One read of the section is much cheaper than a get per option.
+        try:
+            values = dict(parser.items(section))
+        except Error, e:
+            raise click.ClickException(
+                ERR_INVALID_SECTION.format(section, e))
+        _fill_group(group, values, section)
+    except click.ClickException, e:
+        group.error = e.message
+    return group
+
+
+def _fill_group(group, values, section):
+    from datetime import datetime
+    from .compression import CODECS
+    from .filters import PathFilter, parse_size
+    from .scheduler import CronSchedule
+
+    option = values.get
+
+    def number(name, default):
+        value = option(name, default)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise click.ClickException(
+                ERR_INVALID_NUMBER.format(value, name, section))
+
+    def flag(name):
+        return option(name, 'no').lower() in BOOLEAN_TRUE
+
+    def choice(name, default, choices, message):
+        value = option(name, default)
+        if value not in choices:
+            raise click.ClickException(message.format(value, section))
+        return value
+
+    group.dirs = split_values(option('dir', ''))
+    group.dbs = split_values(option('db', ''))
+
+    group.compression = option('compression', 'gzip')
+    if group.compression not in CODECS:
+        raise click.ClickException(ERR_UNKNOWN_COMPRESSION.format(
+            group.compression, ', '.join(sorted(CODECS))))
+    if option('compression_level') is not None:
+        group.compression_level = number('compression_level', None)
+    group.compression_threads = number('compression_threads', 1)
+
+    group.mode = choice('mode', 'full', ('full', 'incremental'),
+                        ERR_UNKNOWN_MODE)
+    group.full_every = number('full_every', 7)
+    group.unchanged = choice('unchanged', 'backup', ('backup', 'skip', 'link'),
+                             ERR_UNKNOWN_UNCHANGED)
+    group.exclude = split_values(option('exclude', ''))
+    group.include = split_values(option('include', ''))
+    group.max_file_size = parse_size(option('max_file_size', '0'))
+    group.one_file_system = flag('one_file_system')
+    # Compiles the patterns once to report invalid ones early.
+    PathFilter(group.exclude, group.include)
+
+    group.storage = choice('storage', 'archive', ('archive', 'chunked'),
+                           ERR_UNKNOWN_STORAGE)
+    group.volume_size = parse_size(option('volume_size', '0'))
+    group.db_format = choice('db_format', 'custom', ('custom', 'directory'),
+                             ERR_UNKNOWN_DB_FORMAT)
+    group.db_jobs = number('db_jobs', 1)
+    group.verify = flag('verify')
+
+    # The key itself is only read by commands that use it.
+    group.encryption_key_file = option('encryption_key_file') or None
+    if group.encryption_key_file and group.storage == 'chunked':
+        raise click.ClickException(ERR_ENCRYPTION_UNSUPPORTED.format(
+            section, 'storage chunked'))
+    if group.encryption_key_file and group.db_format == 'directory':
+        raise click.ClickException(ERR_ENCRYPTION_UNSUPPORTED.format(
+            section, 'db_format directory'))
+
+    # Only the daemon runs schedules, see ``daemon.Daemon``.
+    group.schedule = option('schedule') or None
+    if group.schedule:
+        try:
+            CronSchedule(group.schedule).next_after(datetime.now())
+        except ValueError, e:
+            raise click.ClickException(ERR_INVALID_SCHEDULE.format(
+                group.schedule, section, e))
+    group.pipeline = split_values(option('pipeline', ', '.join(STAGES)))
+    for stage in group.pipeline:
+        if stage not in STAGES:
+            raise click.ClickException(ERR_UNKNOWN_STAGE.format(
+                stage, section, ', '.join(STAGES)))
+
+    hosts = split_values(option('shipper_host', ''))
+    if hosts and None not in (option('shipper_ssh_port'), option('shipper_user'),
+                              option('shipper_dir')):
+        group.shipper = ShipperConfig(
+            hosts=hosts,
+            ssh_port=option('shipper_ssh_port'),
+            user=option('shipper_user'),
+            target_dir=option('shipper_dir'),
+            bwlimit=number('shipper_bwlimit', 0),
+            retries=number('shipper_retries', 2),
+            volume_jobs=number('shipper_volume_jobs', 4))
+
+    names = [name for name in CleanerConfig.__slots__ if name != 'threads']
+    if all(option('cleaner_' + name) is not None for name in names):
+        group.cleaner = CleanerConfig(
+            threads=number('cleaner_threads', 8),
+            **dict((name, number('cleaner_' + name, None)) for name in names))
+
+
+def split_values(val):
+    """Returns the comma separated values of an option without blanks."""
+    return [x.strip() for x in val.split(',') if x.strip()]
@@ -2,6 +2,11 @@
 from __future__ import absolute_import, unicode_literals
 
 
+BOOLEAN_TRUE = ('1', 'yes', 'true', 'on')
+
+# Stages of a daemon pipeline in the order they run.
+STAGES = ('start', 'ship', 'clean')
+
 HELP_CONF = (
     "Location of configuration file.")
 
@@ -13,6 +18,108 @@ HELP_ROUTINES = (
     "Specify the routines that should be run for this backup. Separate "
     "routines with comma (,), e.g. --routines=dir,db.")
 
+HELP_JOBS = (
+    "Number of backup items to run in parallel across all groups. Directory "
+    "archives are built in worker processes, database dumps run as parallel "
+    "subprocesses.")
+
+HELP_JOBS_PER_GROUP = (
+    "Maximum number of items of the same group to run at once when --jobs "
+    "is greater than 1. 0 means no limit.")
+
+HELP_JOBS_PER_DEVICE = (
+    "Maximum number of items reading from or writing to the same storage "
+    "device at once when --jobs is greater than 1. 0 means no limit.")
+
+HELP_DB_JOBS = (
+    "Maximum number of database dumps to run at once across all groups when "
+    "--jobs is greater than 1. 0 means no limit.")
+
+HELP_SHIP_JOBS = (
+    "Number of rsync transfers to run in parallel across all groups and "
+    "targets.")
+
+HELP_JOBS_PER_HOST = (
+    "Maximum number of transfers to the same host at once. 0 means no "
+    "limit.")
+
+HELP_BWLIMIT = (
+    "Total bandwidth limit in KB/s for all transfers. It is split evenly "
+    "between parallel transfers. Per host limits can be set with "
+    "shipper_bwlimit in the INI file. 0 means no limit.")
+
+HELP_RESCAN = (
+    "Ignore shipments recorded in the catalog and offer all backups to "
+    "rsync, which skips those that already exist on the target.")
+
+HELP_CLEAN_JOBS = (
+    "Number of groups to clean in parallel. Within a group files are "
+    "deleted by a pool of cleaner_threads threads.")
+
+HELP_MAX_DELETE = (
+    "Safety budget. Abort without deleting anything if more than this many "
+    "backups would be deleted across all groups. 0 means no limit.")
+
+HELP_RESUME = (
+    "Continue directory backups that were interrupted after the last "
+    "finished volume instead of starting over. Needs volume_size.")
+
+HELP_START_SHIP = (
+    "Ship every finished backup to the targets of its group while the next "
+    "ones are written, instead of running ship afterwards.")
+
+HELP_PROFILE = (
+    "Profile the run with cProfile (cpu) or tracemalloc (memory) and save "
+    "the report to .profiles in backup_storage_dir. Work done in worker "
+    "processes is not included.")
+
+HELP_RESTORE_GROUP = (
+    "Section name of the group to restore from.")
+
+HELP_RESTORE_ITEM = (
+    "Backed up directory as configured in the dir setting, e.g. ~/foo/bar.")
+
+HELP_RESTORE_AT = (
+    "Restore the latest backup at or before this timestamp. Accepts full or "
+    "partial filename prefixes, e.g. 2014-11-05 or 2014-11-05--03-30-00. "
+    "Defaults to the latest backup.")
+
+HELP_RESTORE_TARGET = (
+    "Directory to restore into. It is created if it does not exist.")
+
+HELP_RESTORE_PATH = (
+    "Restore only files and directories matching this glob, given relative "
+    "to --item, e.g. docs/*.txt. Matching directories are restored with "
+    "everything below them.")
+
+HELP_RESTORE_JOBS = (
+    "Number of threads extracting archives that have an index.")
+
+HELP_VERIFY_JOBS = (
+    "Number of backup files to verify in parallel.")
+
+HELP_VERIFY_LATEST = (
+    "Only verify the latest backup of every item.")
+
+HELP_VERIFY_REMOTE = (
+    "Also compare the checksums of shipped copies, computed on the shipper "
+    "hosts with sha256sum over ssh, with the catalog.")
+
+HELP_DECRYPT_GROUP = (
+    "Section name of the group whose key encrypted the file.")
+
+HELP_DAEMON_JOBS = (
+    "Number of group pipelines to run at once. Stages of one group always "
+    "run one after another.")
+
+HELP_SOCKET = (
+    "Path of the control socket. Defaults to .esbckp.sock in "
+    "backup_storage_dir.")
+
+HELP_CTL_STAGES = (
+    "Stages to run for trigger, separated by commas (,). Defaults to the "
+    "pipeline of the group.")
+
 HELP_DRYRUN = (
     "By default easybackups_clean will only list the files that would be "
     "deleted  from the file system. To actually delete them, pass "
@@ -24,7 +131,164 @@ ERR_CONFIG_FILE_DOES_NOT_EXIST = (
 ERR_BACK_STORAGE_DOES_NOT_EXIST = (
     "Backup storage directory does not exist at {}")
 
-ERR_DB_STRING_LENGTH = (
-    "Error with db string {}. It needs to have three tokens separated by a "
-    "colon (:), e.g. postgres:my_database:my_user. Skipping this particular "
-    "db-backup.")
+ERR_STORAGE_DIR_MISSING = (
+    "backup_storage_dir is not set in the DEFAULT section of {}.")
+
+ERR_INVALID_NUMBER = (
+    "Invalid value {} for {} in group {}. Use a whole number.")
+
+ERR_INVALID_SECTION = (
+    "Group {} can't be read: {}")
+
+ERR_INVALID_SCHEDULE = (
+    "Invalid schedule {} in group {}: {}. Use the five fields of crontab, "
+    "e.g. 30 3 * * *.")
+
+ERR_UNKNOWN_STAGE = (
+    "Unknown stage {} in the pipeline of group {}. Use {}.")
+
+ERR_LOCKED = (
+    "{} is busy in another process, see {}.")
+
+ERR_DAEMON_NOT_RUNNING = (
+    "No daemon listens on {}: {}")
+
+ERR_DAEMON_REQUEST = (
+    "The daemon refused the request: {}")
+
+ERR_UNKNOWN_CONTROL_COMMAND = (
+    "Unknown command {}. Use status, trigger, reload or stop.")
+
+ERR_TRIGGER_GROUP_MISSING = (
+    "trigger needs the name of a group, e.g. esbckp ctl trigger test1.")
+
+ERR_DB_STRING = (
+    "Error with db string {}. It needs to look like {}. Skipping this "
+    "particular db-backup.")
+
+ERR_DB_NAME = (
+    "Invalid name {} in db string {}. Use letters, digits, dots, dashes and "
+    "underscores. Skipping this particular db-backup.")
+
+ERR_UNKNOWN_SOURCE = (
+    "Unknown database type {}. Use postgres, mysql, mariadb, sqlite, redis, "
+    "command or the type of an installed esbckp.sources driver. Skipping "
+    "this particular db-backup.")
+
+ERR_JOBS_FAILED = (
+    "{} backup item(s) failed.")
+
+ERR_UNKNOWN_COMPRESSION = (
+    "Unknown compression {}. Choose one of {}.")
+
+ERR_COMPRESSOR_FAILED = (
+    "Compressor {} exited with status {}.")
+
+ERR_DECOMPRESSOR_FAILED = (
+    "Decompressor {} exited with status {}.")
+
+ERR_UNKNOWN_MODE = (
+    "Unknown mode {} in group {}. Choose one of full, incremental.")
+
+ERR_UNKNOWN_UNCHANGED = (
+    "Unknown value {} for unchanged in group {}. Choose one of backup, skip, "
+    "link.")
+
+ERR_UNKNOWN_STORAGE = (
+    "Unknown storage {} in group {}. Choose one of archive, chunked.")
+
+ERR_NO_BACKUP_FOUND = (
+    "No backup of {} found at or before '{}'.")
+
+ERR_BROKEN_CHAIN = (
+    "Full backup {} of incremental chain is missing.")
+
+ERR_RESTORE_DUMP = (
+    "{} is a database dump. Use pg_restore to restore it.")
+
+ERR_RESTORE_ENCRYPTED_DUMP = (
+    "{} is an encrypted database dump. Pipe the output of esbckp decrypt "
+    "into pg_restore to restore it.")
+
+ERR_LINK_TARGET_MISSING = (
+    "Skipped hard link {}, its target {} was not restored.")
+
+ERR_UNKNOWN_GROUP = (
+    "Group {} does not exist.")
+
+ERR_UNKNOWN_DB_FORMAT = (
+    "Unknown db_format {} in group {}. Choose one of custom, directory.")
+
+ERR_DUMP_FAILED = (
+    "Dump of database {} failed: {}")
+
+ERR_SHIP_RETRY = (
+    "{} exited with status {}. Retrying in {} seconds.")
+
+ERR_SHIP_FAILED = (
+    "{} exited with status {} after {} attempts.")
+
+ERR_SHIP_JOBS_FAILED = (
+    "{} transfer(s) failed.")
+
+ERR_MAX_DELETE_EXCEEDED = (
+    "{} backups are marked for removal, which exceeds --max-delete={}. "
+    "Nothing was deleted.")
+
+ERR_CLEAN_JOBS_FAILED = (
+    "Cleaning {} group(s) failed.")
+
+ERR_TRACEMALLOC_MISSING = (
+    "Memory profiles need the tracemalloc module, which is not available "
+    "in this Python version.")
+
+ERR_CRYPTOGRAPHY_MISSING = (
+    "Encryption needs the cryptography package, install it with "
+    "pip install esbckp[encryption].")
+
+ERR_INVALID_KEY_FILE = (
+    "Key file {} must hold a 256 bit key as 64 hex digits.")
+
+ERR_ENCRYPTION_UNSUPPORTED = (
+    "Group {} can not be encrypted with {}. Encryption needs storage "
+    "archive and db_format custom.")
+
+ERR_ENCRYPTION_KEY_MISSING = (
+    "{} is encrypted, but its group has no encryption_key_file.")
+
+ERR_WRONG_KEY = (
+    "{} was encrypted with a different key.")
+
+ERR_DECRYPT_FAILED = (
+    "{} could not be decrypted. It is damaged, truncated or was modified.")
+
+ERR_BACKUP_DAMAGED = (
+    "{} is damaged: {}")
+
+ERR_CHECKSUM_MISMATCH = (
+    "{} has checksum {}, but {} was recorded when it was written.")
+
+ERR_CHECKSUMS_MODIFIED = (
+    "Checksum file {} does not match the catalog.")
+
+ERR_DUMP_UNREADABLE = (
+    "pg_restore can't read dump {}: {}")
+
+ERR_CHUNK_DAMAGED = (
+    "Chunk {} is damaged, its content does not match its name.")
+
+ERR_REMOTE_CHECKSUMS_FAILED = (
+    "Computing checksums on {} failed with status {}: {}")
+
+ERR_REMOTE_MISMATCH = (
+    "{} shipped file(s) on {} are missing or differ: {}")
+
+ERR_VERIFY_FAILED = (
+    "Verifying {} backup file(s) failed.")
+
+ERR_INVALID_PATTERN = (
+    "Invalid pattern in {}: {}")
+
+ERR_INVALID_SIZE = (
+    "Invalid size {}. Use a number of bytes with an optional K, M, G or T "
+    "suffix, e.g. 100M.")
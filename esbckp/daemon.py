@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""Long running scheduler for the groups of one config file.
+
+The daemon keeps the config, catalog and metrics in memory and runs the
+pipeline of a group, e.g. start, ship and clean, whenever its schedule is
+due or a client triggers it through the control socket. Stages of a group
+run one after another as soon as the previous one is done, up to ``jobs``
+groups run at once. Groups are locked like in the commands, see ``locks``.
+
+The control socket speaks one JSON object per line, e.g.
+``{"command": "trigger", "group": "test1"}``, and answers with
+``{"ok": true, "result": ...}`` or ``{"ok": false, "error": ...}``.
+"""
+from __future__ import absolute_import, unicode_literals
+import click
+import json
+import os
+import signal
+import socket
+import SocketServer
+import threading
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+from Queue import Queue
+from .backups import Backup
+from .constants import *
+from .locks import LOCK_DIR, Lock, group_lock
+from .scheduler import CronSchedule
+
+SOCKET_NAME = '.esbckp.sock'
+
+# Seconds between checks of the config file and the schedules.
+TICK = 10
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class GroupState(object):
+    """Schedule and outcome of the runs of one group."""
+    def __init__(self, title):
+        self.title = title
+        self.schedule = None
+        self.pipeline = list(STAGES)
+        self.next_run = None
+        self.state = 'idle'
+        self.stage = None
+        self.started = None
+        self.finished = None
+        self.ok = None
+        self.error = None
+        self.runs = 0
+        self.failures = 0
+
+    def as_dict(self):
+        def fmt(dt):
+            return dt.strftime(TIME_FORMAT) if dt else None
+
+        return {
+            'group': self.title,
+            'schedule': self.schedule.expr if self.schedule else None,
+            'pipeline': self.pipeline,
+            'next_run': fmt(self.next_run),
+            'state': self.state,
+            'stage': self.stage,
+            'started': fmt(self.started),
+            'finished': fmt(self.finished),
+            'ok': self.ok,
+            'error': self.error,
+            'runs': self.runs,
+            'failures': self.failures,
+        }
+
+
+class Daemon(object):
+    """Runs the pipelines of the groups of ``conf`` on schedule.
+
+    :param groups: Comma separated groups to manage, all if empty.
+    :param jobs: Number of group pipelines to run at once.
+    :param socket_path: Path of the control socket, by default
+        ``.esbckp.sock`` in the backup storage dir.
+    """
+    def __init__(self, conf, groups=None, jobs=1, socket_path=None):
+        self.conf = conf
+        self.groups = groups
+        self.jobs = max(1, jobs)
+        self.backup = None
+        self.states = OrderedDict()
+        self.queue = Queue()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._config_key = None
+        self.load()
+        self.socket_path = socket_path or default_socket_path(
+            self.backup.backup_storage_dir)
+
+    def load(self):
+        """Reads the config and updates the schedules of the groups.
+
+        Schedules that did not change keep their next run. Pipelines that
+        are running finish with the config they started with.
+        """
+        key = self._read_config_key()
+        backup = Backup(self.conf, self.groups)
+        now = datetime.now()
+
+        states = OrderedDict()
+        for group in backup.backup_groups:
+            state = self.states.get(group.group_title) or \
+                GroupState(group.group_title)
+            schedule = CronSchedule(group.schedule) if group.schedule \
+                else None
+            if schedule is None:
+                state.next_run = None
+            elif state.schedule is None or \
+                    state.schedule.expr != schedule.expr:
+                state.next_run = schedule.next_after(now)
+            state.schedule = schedule
+            state.pipeline = group.pipeline
+            states[group.group_title] = state
+
+        with self._lock:
+            self.backup = backup
+            self.states = states
+            self._config_key = key
+
+    def run(self):
+        """Serves the control socket and runs schedules until ``stop``.
+
+        :raises: ClickException if another daemon runs on the same storage
+            dir.
+        """
+        path = os.path.join(self.backup.backup_storage_dir, LOCK_DIR,
+                            'daemon.lock')
+        with Lock(path):
+            server = self._bind()
+            threads = [threading.Thread(target=server.serve_forever)]
+            threads.extend(threading.Thread(target=self._work)
+                           for _ in range(self.jobs))
+            for t in threads:
+                t.daemon = True
+                t.start()
+
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda *args: self.stop())
+            log('Listening on {}'.format(self.socket_path))
+
+            try:
+                while not self._stopped.is_set():
+                    self._reload_if_changed()
+                    self._run_due(datetime.now())
+                    # Waits with a timeout, signals are not handled while
+                    # a plain wait blocks.
+                    self._stopped.wait(self._seconds_to_sleep())
+            finally:
+                self._stopped.set()
+                server.shutdown()
+                server.server_close()
+                os.remove(self.socket_path)
+                for _ in threads[1:]:
+                    self.queue.put(None)
+                log('Stopping, waiting for running pipelines')
+                for t in threads[1:]:
+                    t.join()
+
+    def stop(self):
+        """Stops after the running pipelines, queued ones are dropped."""
+        self._stopped.set()
+
+    def trigger(self, title, stages=None):
+        """Queues the pipeline of a group.
+
+        :param stages: Stages to run instead of the group's pipeline. They
+            always run in the order of ``STAGES``.
+        :return: False if the group is already queued or running.
+        :raises: ClickException if the group or a stage is unknown.
+        """
+        with self._lock:
+            state = self.states.get(title)
+            if state is None:
+                raise click.ClickException(ERR_UNKNOWN_GROUP.format(title))
+            for stage in stages or []:
+                if stage not in STAGES:
+                    raise click.ClickException(ERR_UNKNOWN_STAGE.format(
+                        stage, title, ', '.join(STAGES)))
+            if state.state != 'idle':
+                return False
+            stages = stages or state.pipeline
+            state.state = 'queued'
+            self.queue.put((title, [s for s in STAGES if s in stages]))
+            return True
+
+    def status(self):
+        """Returns the states of all groups as dicts, see ``GroupState``."""
+        with self._lock:
+            return [state.as_dict() for state in self.states.values()]
+
+    def handle(self, request):
+        """Answers a request of the control socket.
+
+        :raises: ClickException if the request is invalid.
+        """
+        command = request.get('command')
+        if command == 'status':
+            return self.status()
+        if command == 'trigger':
+            return self.trigger(request.get('group'), request.get('stages'))
+        if command == 'reload':
+            self.load()
+            return self.status()
+        if command == 'stop':
+            self.stop()
+            return None
+        raise click.ClickException(ERR_UNKNOWN_CONTROL_COMMAND.format(command))
+
+    def run_pipeline(self, title, stages):
+        """Runs ``stages`` of a group and stops at the first failing one.
+
+        The group is built again for every run, so backups get a new
+        filename prefix and the cleaner compares with the current time. A
+        group locked by another process is skipped and counts as failed.
+        """
+        with self._lock:
+            backup = self.backup
+            state = self.states.get(title)
+        if state is None:
+            return
+
+        state.state = 'running'
+        state.started = datetime.now()
+        lock = group_lock(backup.backup_storage_dir, title)
+        try:
+            with backup.metrics.measure('pipeline', title, ','.join(stages)):
+                with lock:
+                    group = backup.build_group(backup.config.group(title))
+                    for stage in stages:
+                        state.stage = stage
+                        log('{}: {}'.format(title, stage))
+                        STAGE_FUNCTIONS[stage](group)
+            state.ok = True
+            state.error = None
+        except Exception, e:
+            state.ok = False
+            state.failures += 1
+            if isinstance(e, click.ClickException):
+                state.error = e.message
+            else:
+                state.error = unicode(e)
+                click.echo(traceback.format_exc(), err=True)
+            log('{}: {} failed: {}'.format(title, state.stage or 'pipeline',
+                                           state.error))
+        finally:
+            state.state = 'idle'
+            state.stage = None
+            state.finished = datetime.now()
+            state.runs += 1
+            backup.metrics.write_textfile('daemon')
+
+        if state.ok:
+            log('{}: done in {:.1f}s'.format(
+                title, (state.finished - state.started).total_seconds()))
+
+    def _work(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            title, stages = entry
+            if self._stopped.is_set():
+                with self._lock:
+                    if title in self.states:
+                        self.states[title].state = 'idle'
+                continue
+            self.run_pipeline(title, stages)
+
+    def _run_due(self, now):
+        for state in self._group_states():
+            if state.next_run and state.next_run <= now:
+                state.next_run = state.schedule.next_after(now)
+                if not self.trigger(state.title):
+                    log('{}: skipped, the last run is not done'.format(
+                        state.title))
+
+    def _group_states(self):
+        with self._lock:
+            return list(self.states.values())
+
+    def _seconds_to_sleep(self):
+        now = datetime.now()
+        runs = [state.next_run for state in self._group_states()
+                if state.next_run]
+        if not runs:
+            return TICK
+        return max(0, min(TICK, (min(runs) - now).total_seconds()))
+
+    def _read_config_key(self):
+        try:
+            stat = os.stat(os.path.expanduser(self.conf))
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def _reload_if_changed(self):
+        if self._read_config_key() == self._config_key:
+            return
+        try:
+            self.load()
+            log('Reloaded {}'.format(self.conf))
+        except click.ClickException, e:
+            # Keeps the last good config, the file is checked again.
+            self._config_key = self._read_config_key()
+            log(click.style(e.message, fg='red'))
+
+    def _bind(self):
+        # The daemon lock is held, so a socket left behind is stale.
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        umask = os.umask(0o177)
+        try:
+            return ControlServer(self.socket_path, self)
+        finally:
+            os.umask(umask)
+
+
+class ControlServer(SocketServer.ThreadingMixIn,
+                    SocketServer.UnixStreamServer):
+    """Unix socket server handing requests to a ``Daemon``."""
+    daemon_threads = True
+
+    def __init__(self, path, backup_daemon):
+        self.backup_daemon = backup_daemon
+        SocketServer.UnixStreamServer.__init__(self, path, ControlHandler)
+
+
+class ControlHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            if not isinstance(request, dict):
+                raise ValueError('Expected a JSON object')
+            result = self.server.backup_daemon.handle(request)
+            response = {'ok': True, 'result': result}
+        except click.ClickException, e:
+            response = {'ok': False, 'error': e.message}
+        except ValueError, e:
+            response = {'ok': False, 'error': unicode(e)}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+def start_group(group):
+    """Backs up all directories and databases of ``group``.
+
+    :raises: ClickException if an item failed, after all items ran.
+    """
+    from .utils import do_file_backup, do_database_backup
+
+    group.check_or_create_base_path()
+    failed = 0
+    for func, items in ((do_file_backup, group.dirs),
+                        (do_database_backup, group.dbs)):
+        for item in items:
+            try:
+                if func is do_file_backup:
+                    func(group, item, progress=False)
+                else:
+                    func(group, item)
+            except click.ClickException, e:
+                click.echo(click.style(e.message, fg='red'), err=True)
+                failed += 1
+
+    if failed:
+        raise click.ClickException(ERR_JOBS_FAILED.format(failed))
+
+
+def ship_group(group):
+    """Ships new backups of ``group`` to all of its targets."""
+    group.ship()
+
+
+def clean_group(group):
+    """Deletes outdated backups of ``group`` and unreferenced chunks."""
+    from .cleaner import clean_chunks
+
+    if group.cleaner and os.path.exists(group.base_path):
+        group.clean(dry_run=False)
+    if group.storage == 'chunked':
+        clean_chunks(group.backup_storage_dir, False)
+
+
+STAGE_FUNCTIONS = {
+    'start': start_group,
+    'ship': ship_group,
+    'clean': clean_group,
+}
+
+
+def default_socket_path(backup_storage_dir):
+    return os.path.join(os.path.expanduser(backup_storage_dir), SOCKET_NAME)
+
+
+def send_request(socket_path, request):
+    """Sends ``request`` to the daemon listening on ``socket_path``.
+
+    :return: The result of the request.
+    :raises: ClickException if no daemon listens or it refuses the request.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        response = json.loads(sock.makefile().readline())
+    except (socket.error, ValueError), e:
+        raise click.ClickException(
+            ERR_DAEMON_NOT_RUNNING.format(socket_path, e))
+    finally:
+        sock.close()
+
+    if not response['ok']:
+        raise click.ClickException(ERR_DAEMON_REQUEST.format(
+            response['error']))
+    return response['result']
+
+
+def log(message):
+    click.echo('{} {}'.format(datetime.now().strftime(TIME_FORMAT), message))
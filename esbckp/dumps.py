@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import click
+import os
+import shutil
+import subprocess
+import time
+from .checksums import HashingWriter
+from .constants import *
+from .encryption import EncryptingWriter
+
+
+def get_pg_dump_cmd(item, dump_format='custom', jobs=1, target_path=None):
+    """Builds the pg_dump command for ``item`` as list.
+
+    Custom format dumps are written to stdout, directory format dumps need
+    a target directory and may use several jobs.
+    """
+    cmd = ['pg_dump', '-U', item.db_user]
+
+    if dump_format == 'directory':
+        cmd += ['-Fd', '-f', target_path]
+        if jobs > 1:
+            cmd += ['-j', str(jobs)]
+    else:
+        cmd += ['-Fc']
+
+    return cmd + [item.db_name]
+
+
+def dump_postgres(item, target_path, dump_format='custom', jobs=1,
+                  key=None):
+    """Dumps a postgres database to ``target_path``.
+
+    The dump is written to a partial path next to ``target_path`` and only
+    renamed to ``target_path`` if pg_dump exited successfully.
+
+    :param item: Instance of ``DatabaseBackupItem``
+    :param target_path: Final path of the dump file or directory.
+    :param dump_format: Either ``custom`` or ``directory``.
+    :param jobs: Number of parallel jobs for directory format dumps.
+    :param key: Optional key to encrypt custom format dumps with while
+        pg_dump writes them, see ``encryption.EncryptingWriter``.
+    :return: Tuple of bytes written, duration in seconds and the sha256 of
+        custom format dumps, which is computed while they are written.
+    :raises: ClickException if pg_dump fails.
+    """
+    if dump_format != 'directory':
+        from .sources import PostgresSource
+        return dump_source(PostgresSource(), item, target_path, key=key)
+
+    partial_path = _partial_path(target_path)
+    cmd = get_pg_dump_cmd(item, dump_format, jobs, partial_path)
+    start = time.time()
+
+    try:
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+
+        if proc.returncode != 0:
+            raise click.ClickException(ERR_DUMP_FAILED.format(
+                item.db_name, err.strip() or proc.returncode))
+
+        os.rename(partial_path, target_path)
+
+    except OSError, e:
+        remove_path(partial_path)
+        raise click.ClickException(ERR_DUMP_FAILED.format(
+            item.db_name, e.strerror))
+    except BaseException:
+        remove_path(partial_path)
+        raise
+
+    make_read_only(target_path)
+
+    return path_size(target_path), time.time() - start, None
+
+
+def dump_source(source, item, target_path, compression=None, key=None):
+    """Streams the dump of ``item`` into the file ``target_path``.
+
+    The output of the driver is compressed, encrypted with ``key`` and
+    hashed on its way to a partial path next to ``target_path``, which is
+    only renamed once the dump succeeded. Nothing uncompressed is written
+    to disk.
+
+    :param source: Driver of the item, see ``sources.Source``.
+    :param compression: Optional ``Compression`` of the dump.
+    :return: Tuple of bytes written, duration in seconds and the sha256 of
+        the written file.
+    :raises: ClickException if the dump fails.
+    """
+    partial_path = _partial_path(target_path)
+    start = time.time()
+
+    try:
+        with open(partial_path, 'wb') as f:
+            hashing = out = HashingWriter(f)
+            encryptor = None
+            if key:
+                encryptor = out = EncryptingWriter(hashing, key)
+            if compression:
+                with compression.open(out) as stream:
+                    source.dump(item, stream)
+            else:
+                source.dump(item, out)
+            if encryptor:
+                encryptor.close()
+
+        os.rename(partial_path, target_path)
+
+    except OSError, e:
+        remove_path(partial_path)
+        raise click.ClickException(ERR_DUMP_FAILED.format(
+            item.db_name, e.strerror))
+    except BaseException:
+        remove_path(partial_path)
+        raise
+
+    make_read_only(target_path)
+
+    return path_size(target_path), time.time() - start, hashing.hexdigest()
+
+
+def _partial_path(target_path):
+    head, tail = os.path.split(target_path)
+    return os.path.join(head, '.{}.partial'.format(tail))
+
+
+def path_size(path):
+    """Returns the size of a file or the summed size of a directory tree."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(dp, f))
+               for dp, _, fn in os.walk(path) for f in fn)
+
+
+def remove_path(path):
+    """Removes a file or directory tree if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def link_path(source, target):
+    """Hard links a file or every file of a directory tree to ``target``."""
+    if not os.path.isdir(source):
+        os.link(source, target)
+        return
+
+    for dp, _, fn in os.walk(source):
+        target_dir = os.path.join(target, os.path.relpath(dp, source))
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+        for f in fn:
+            os.link(os.path.join(dp, f), os.path.join(target_dir, f))
+
+
+def make_read_only(path):
+    """Sets files to 0400.
+
+    Directories stay writable for the owner so the cleaner can remove them.
+    """
+    if not os.path.isdir(path):
+        os.chmod(path, 0o400)
+        return
+
+    for dp, _, fn in os.walk(path):
+        for f in fn:
+            os.chmod(os.path.join(dp, f), 0o400)
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import binascii
+import click
+import hashlib
+import os
+import struct
+from .constants import *
+
+ENCRYPTED_EXTENSION = '.enc'
+CODEC_SUFFIX = '+aes-gcm'
+
+MAGIC = b'ESBCKPE1'
+KEY_SIZE = 32
+TAG_SIZE = 16
+
+# Plaintext bytes per authenticated chunk.
+CHUNK_SIZE = 64 * 1024
+
+# Magic, key id, nonce prefix and chunk size. The header is authenticated
+# with every chunk.
+HEADER = struct.Struct(b'>8s8s7sI')
+
+
+def import_cryptography():
+    """Imports cryptography on first use, which keeps it out of the startup
+    time of groups without encryption.
+
+    :return: Tuple of the ``AESGCM`` class and the ``InvalidTag`` error.
+    :raises: ClickException if cryptography is not installed.
+    """
+    try:
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise click.ClickException(ERR_CRYPTOGRAPHY_MISSING)
+    return AESGCM, InvalidTag
+
+
+def load_key(path):
+    """Reads a 256 bit key from a file holding it as 64 hex digits.
+
+    :raises: ClickException if the file can't be read or holds no key.
+    """
+    import_cryptography()
+    try:
+        with open(os.path.expanduser(path)) as f:
+            key = binascii.unhexlify(f.read().strip())
+    except (IOError, TypeError, binascii.Error):
+        raise click.ClickException(ERR_INVALID_KEY_FILE.format(path))
+    if len(key) != KEY_SIZE:
+        raise click.ClickException(ERR_INVALID_KEY_FILE.format(path))
+    return key
+
+
+def key_id(key):
+    """Returns 8 bytes that tell keys apart without revealing them."""
+    return hashlib.sha256(b'esbckp key id' + key).digest()[:8]
+
+
+def open_decrypted(path, key, fileobj=None):
+    """Returns a ``DecryptingReader`` of the encrypted file at ``path``.
+
+    :param fileobj: Optional seekable file object to read ``path`` from.
+    :raises: ClickException if no key is configured.
+    """
+    if key is None:
+        raise click.ClickException(ERR_ENCRYPTION_KEY_MISSING.format(path))
+    return DecryptingReader(fileobj or open(path, 'rb'), key, path)
+
+
+def encrypt_text(text, key):
+    """Returns ``text`` encrypted with ``key`` as hex digits, for short
+    values in files that are plaintext otherwise.
+    """
+    aesgcm, _ = import_cryptography()
+    nonce = os.urandom(12)
+    sealed = aesgcm(key).encrypt(nonce, text.encode('utf-8'), key_id(key))
+    return binascii.hexlify(nonce + sealed).decode('ascii')
+
+
+def decrypt_text(token, key, name=None):
+    """Returns the text of a token of ``encrypt_text``.
+
+    :param name: Name of the file holding ``token`` for error messages.
+    :raises: ClickException if no key is configured or ``token`` was not
+        encrypted with ``key``.
+    """
+    if key is None:
+        raise click.ClickException(ERR_ENCRYPTION_KEY_MISSING.format(name))
+    aesgcm, invalid_tag = import_cryptography()
+    try:
+        raw = binascii.unhexlify(token)
+        return aesgcm(key).decrypt(raw[:12], raw[12:],
+                                   key_id(key)).decode('utf-8')
+    except (TypeError, binascii.Error, invalid_tag):
+        raise click.ClickException(ERR_DECRYPT_FAILED.format(name))
+
+
+def _nonce(prefix, index, final):
+    return prefix + struct.pack(b'>IB', index, 1 if final else 0)
+
+
+class EncryptingWriter(object):
+    """File-like object that encrypts everything written to it into
+    ``fileobj``.
+
+    The stream is split into chunks of ``chunk_size`` bytes that are
+    encrypted with AES-256-GCM one by one, so memory stays constant and
+    nothing is read twice. The nonce of a chunk is a random prefix of the
+    file, the chunk number and a flag for the last chunk. Reordered,
+    dropped or truncated chunks therefore fail authentication, while every
+    chunk can still be decrypted on its own, see ``DecryptingReader``.
+    """
+    def __init__(self, fileobj, key, chunk_size=CHUNK_SIZE):
+        aesgcm, _ = import_cryptography()
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._aead = aesgcm(key)
+        self._prefix = os.urandom(7)
+        self._header = HEADER.pack(MAGIC, key_id(key), self._prefix,
+                                   chunk_size)
+        self._index = 0
+        self._buffer = []
+        self._buffered = 0
+        self.fileobj.write(self._header)
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        # The last chunk is only known on close, so a full chunk is held
+        # back until more data follows.
+        if self._buffered <= self.chunk_size:
+            return
+
+        data = b''.join(self._buffer)
+        pos = 0
+        while len(data) - pos > self.chunk_size:
+            self._write_chunk(data[pos:pos + self.chunk_size], False)
+            pos += self.chunk_size
+        self._buffer = [data[pos:]]
+        self._buffered = len(data) - pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._aead is None:
+            return
+        self._write_chunk(b''.join(self._buffer), True)
+        self._buffer = []
+        self._aead = None
+
+    def _write_chunk(self, data, final):
+        nonce = _nonce(self._prefix, self._index, final)
+        self.fileobj.write(self._aead.encrypt(nonce, data, self._header))
+        self._index += 1
+
+
+class DecryptingReader(object):
+    """Seekable read only file object of the plaintext of an encrypted file.
+
+    Chunks are located by their number, so seeking only decrypts the chunk
+    that holds the new position. Threads may read different parts of one
+    file through readers of their own.
+
+    :param fileobj: Seekable file object of the encrypted file.
+    :param name: Name of the file for error messages.
+    :raises: ClickException if the file was not encrypted with ``key`` or
+        was modified or truncated.
+    """
+    def __init__(self, fileobj, key, name=None):
+        aesgcm, self._invalid_tag = import_cryptography()
+        self.fileobj = fileobj
+        self.name = name
+        self._header = fileobj.read(HEADER.size)
+        try:
+            magic, kid, self._prefix, self.chunk_size = \
+                HEADER.unpack(self._header)
+        except struct.error:
+            magic = None
+        if magic != MAGIC or self.chunk_size < 1:
+            raise click.ClickException(ERR_DECRYPT_FAILED.format(name))
+        if kid != key_id(key):
+            raise click.ClickException(ERR_WRONG_KEY.format(name))
+
+        self._aead = aesgcm(key)
+        fileobj.seek(0, 2)
+        encrypted = fileobj.tell() - HEADER.size
+        stride = self.chunk_size + TAG_SIZE
+        self._chunks = max(1, -(-encrypted // stride))
+        self.size = encrypted - self._chunks * TAG_SIZE
+        self._pos = 0
+        self._chunk_index = None
+        self._chunk = b''
+        # Authenticating the last chunk up front reveals truncated files
+        # before anything is read.
+        self._read_chunk(self._chunks - 1)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self.size
+        self._pos = max(0, pos)
+
+    def read(self, size=-1):
+        end = self.size if size < 0 else min(self.size, self._pos + size)
+        parts = list()
+        while self._pos < end:
+            index, offset = divmod(self._pos, self.chunk_size)
+            data = self._read_chunk(index)[offset:offset + end - self._pos]
+            parts.append(data)
+            self._pos += len(data)
+        return b''.join(parts)
+
+    def close(self):
+        self.fileobj.close()
+
+    def _read_chunk(self, index):
+        if index != self._chunk_index:
+            stride = self.chunk_size + TAG_SIZE
+            self.fileobj.seek(HEADER.size + index * stride)
+            nonce = _nonce(self._prefix, index, index == self._chunks - 1)
+            try:
+                self._chunk = self._aead.decrypt(
+                    nonce, self.fileobj.read(stride), self._header)
+            except self._invalid_tag:
+                raise click.ClickException(
+                    ERR_DECRYPT_FAILED.format(self.name))
+            self._chunk_index = index
+        return self._chunk
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import click
+import fnmatch
+import os
+import re
+from .constants import *
+
+IGNORE_FILE = '.esbckpignore'
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+              'T': 1024 ** 4}
+
+
+class PathFilter(object):
+    """Decides which entries of a tree are archived.
+
+    Patterns are globs or, with a ``re:`` prefix, regular expressions.
+    Globs without a slash match the name of an entry at any depth, e.g.
+    ``node_modules`` or ``*.log``. Globs with a slash and all regular
+    expressions match the path relative to the backed up directory, e.g.
+    ``var/cache/*``. All patterns are compiled into one regular expression
+    per kind, so every entry is matched once instead of once per pattern.
+
+    Entries matching ``exclude`` are skipped unless they match ``include``.
+    Excluded directories are pruned and never listed. ``.esbckpignore``
+    files add exclude globs for their directory and everything below it.
+
+    ``max_file_size`` skips larger files, ``one_file_system`` does not
+    descend into directories on other devices than the backed up directory.
+    """
+    def __init__(self, exclude=(), include=(), max_file_size=0,
+                 one_file_system=False):
+        self.exclude = compile_patterns(exclude)
+        self.include = compile_patterns(include)
+        self.max_file_size = max_file_size
+        self.one_file_system = one_file_system
+        self.top = None
+        self._device = None
+        self._ignore_stack = []
+
+    def start(self, top):
+        """Prepares the filter for a walk of ``top``."""
+        self.top = top.rstrip(os.sep)
+        self._device = os.lstat(top).st_dev if self.one_file_system else None
+        self._ignore_stack = []
+
+    def __call__(self, path, is_dir):
+        """Returns False if ``path`` and everything below is excluded."""
+        # Paths from the walk always start with top, slicing is cheaper
+        # than os.path.relpath.
+        rel = path[len(self.top) + 1:]
+        directory, name = os.path.split(path)
+
+        excluded = _matches(self.exclude, name, rel)
+        if not excluded:
+            for base, patterns in self._ignore_rules(directory):
+                if _matches(patterns, name, path[len(base) + 1:]):
+                    excluded = True
+                    break
+
+        return not excluded or _matches(self.include, name, rel)
+
+    def descend(self, path):
+        """Returns False if the walk must not enter directory ``path``."""
+        if self._device is None:
+            return True
+        try:
+            return os.lstat(path).st_dev == self._device
+        except OSError:
+            return False
+
+    def allows_size(self, size):
+        return not self.max_file_size or size <= self.max_file_size
+
+    def _ignore_rules(self, directory):
+        """Returns ``(base, patterns)`` of ignore files that apply to the
+        entries of ``directory``.
+
+        The walk is depth first, so the rules of the directories on the
+        current path are kept on a stack and each ignore file is read once.
+        """
+        stack = self._ignore_stack
+        while stack and not _is_ancestor_or_same(stack[-1][0], directory):
+            stack.pop()
+
+        if not stack or stack[-1][0] != directory:
+            inherited = stack[-1][1] if stack else []
+            patterns = read_ignore_file(os.path.join(directory, IGNORE_FILE))
+            rules = inherited + [(directory, patterns)] if patterns else \
+                inherited
+            stack.append((directory, rules))
+
+        return stack[-1][1]
+
+
+class CompiledPatterns(object):
+    """Name and relative path regular expressions of a list of patterns."""
+    def __init__(self, name_re, path_re):
+        self.name_re = name_re
+        self.path_re = path_re
+
+    def __nonzero__(self):
+        return bool(self.name_re or self.path_re)
+
+
+def compile_patterns(patterns):
+    """Compiles globs and ``re:`` patterns into ``CompiledPatterns``.
+
+    :raises: ClickException if a regular expression is invalid.
+    """
+    name_parts = list()
+    path_parts = list()
+
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith('#'):
+            continue
+
+        if pattern.startswith('re:'):
+            path_parts.append('(?:{})\\Z'.format(pattern[3:]))
+        elif '/' in pattern.rstrip('/'):
+            path_parts.append(fnmatch.translate(pattern.strip('/')))
+        else:
+            name_parts.append(fnmatch.translate(pattern.rstrip('/')))
+
+    try:
+        return CompiledPatterns(
+            re.compile('|'.join(name_parts)) if name_parts else None,
+            re.compile('|'.join(path_parts)) if path_parts else None)
+    except re.error, e:
+        raise click.ClickException(ERR_INVALID_PATTERN.format(
+            ', '.join(patterns), e))
+
+
+def read_ignore_file(path):
+    """Returns ``CompiledPatterns`` of an ignore file or None."""
+    try:
+        with open(path) as f:
+            patterns = compile_patterns(f.read().splitlines())
+    except IOError:
+        return None
+    return patterns or None
+
+
+def parse_size(value):
+    """Converts sizes like ``512``, ``100M`` or ``2G`` to bytes."""
+    match = re.match(r'^\s*(\d+)\s*([KMGT]?)B?\s*$', value or '', re.I)
+    if not match:
+        raise click.ClickException(ERR_INVALID_SIZE.format(value))
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+
+def _matches(patterns, name, rel):
+    if not patterns:
+        return False
+    if patterns.name_re and patterns.name_re.match(name):
+        return True
+    return bool(patterns.path_re and patterns.path_re.match(rel))
+
+
+def _is_ancestor_or_same(ancestor, path):
+    return path == ancestor or path.startswith(ancestor.rstrip(os.sep) +
+                                               os.sep)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import errno
+import hashlib
+import io
+import json
+import os
+import stat
+import tarfile
+import time
+from .archiver import walk_tree
+
+DELETED_MEMBER = '.esbckp-deleted'
+
+
+class FileIndex(object):
+    """On-disk index of the files of one ``FileBackupItem``.
+
+    The index lives in ``<group>/.index/<postfix>.files`` and holds one JSON
+    list ``[path, size, mtime, inode]`` per line in the order of
+    ``archiver.walk_tree``. The mtime keeps its fraction of a second, so a
+    file rewritten within the second of the last run is seen as changed. Next to it ``<postfix>.chain`` records the prefix
+    of the full backup the current chain is based on and how many
+    incremental backups have been written since.
+    """
+    def __init__(self, index_path, postfix):
+        self.index_path = index_path
+        self.files_path = os.path.join(index_path, postfix + '.files')
+        self.chain_path = os.path.join(index_path, postfix + '.chain')
+
+    def read_chain(self):
+        """Returns the chain dict or None if no full backup exists yet."""
+        try:
+            with open(self.chain_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def needs_full(self, full_every):
+        """Returns True if the next backup has to be a full backup."""
+        chain = self.read_chain()
+        if chain is None or not os.path.exists(self.files_path):
+            return True
+        return chain['count'] + 1 >= full_every
+
+    def entries(self):
+        """Yields ``(path, size, mtime, inode)`` tuples of the last run."""
+        if not os.path.exists(self.files_path):
+            return
+        with open(self.files_path) as f:
+            for line in f:
+                yield tuple(json.loads(line))
+
+    def commit(self, detector, base_prefix, count):
+        """Replaces index and chain with the result of a finished backup."""
+        os.rename(detector.new_index_path, self.files_path)
+        with open(self.chain_path, 'w') as f:
+            json.dump({'base': base_prefix, 'count': count}, f)
+
+
+class ChangeDetector(object):
+    """Selects new and changed files during an archive walk.
+
+    The walk and the previous index share the same order, so both are
+    merged like sorted lists. This keeps memory constant regardless of the
+    number of files. A fresh index is written along the way.
+
+    :param file_index: ``FileIndex`` of the item.
+    :param full: If True every file is selected, but the index is rebuilt.
+    """
+    def __init__(self, file_index, full=False):
+        self.full = full
+        self.deleted = []
+        self.new_index_path = file_index.files_path + '.tmp'
+        self._old = iter(() if full else file_index.entries())
+        self._current = next(self._old, None)
+        if not os.path.exists(file_index.index_path):
+            os.makedirs(file_index.index_path)
+        self._out = open(self.new_index_path, 'w')
+
+    def __call__(self, path, tarinfo):
+        """Returns True if ``path`` needs to be added to the archive."""
+        if not tarinfo.isreg():
+            return True
+
+        st = os.lstat(path)
+        entry = [path, st.st_size, st.st_mtime, st.st_ino]
+        self._out.write(json.dumps(entry) + '\n')
+
+        key = _walk_key(path)
+        while self._current is not None and _walk_key(self._current[0]) < key:
+            self.deleted.append(self._current[0])
+            self._current = next(self._old, None)
+
+        if self._current is not None and self._current[0] == path:
+            changed = list(self._current[1:]) != entry[1:]
+            self._current = next(self._old, None)
+            return self.full or changed
+
+        return True
+
+    def finish(self, tar):
+        """Records remaining old entries as deleted and closes the index."""
+        while self._current is not None:
+            self.deleted.append(self._current[0])
+            self._current = next(self._old, None)
+        self._out.close()
+
+        if self.full:
+            return
+
+        data = '\n'.join(p.lstrip(os.sep) for p in self.deleted)
+        data = data.encode('utf-8')
+        tarinfo = tarfile.TarInfo(DELETED_MEMBER)
+        tarinfo.size = len(data)
+        tarinfo.mtime = time.time()
+        tar.addfile(tarinfo, io.BytesIO(data))
+
+    def abort(self):
+        """Discards the new index after a failed backup."""
+        self._out.close()
+        if os.path.exists(self.new_index_path):
+            os.remove(self.new_index_path)
+
+
+def tree_fingerprint(top, path_filter=None):
+    """Returns a cheap fingerprint of the tree below ``top``.
+
+    The fingerprint is a digest of path, type, size and mtime of every
+    entry, including directories, so it changes if files are added,
+    removed, resized or modified. Only metadata is read, no file contents,
+    but it is a walk of its own in addition to the one of the archiver.
+
+    :return: Dict with ``digest``, ``files`` and ``bytes``.
+    """
+    digest = hashlib.sha1()
+    files = 0
+    num_bytes = 0
+
+    for path, is_dir in walk_tree(top, path_filter):
+        try:
+            st = os.lstat(path)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+
+        if path_filter and not is_dir and stat.S_ISREG(st.st_mode) and \
+                not path_filter.allows_size(st.st_size):
+            continue
+
+        digest.update(path if isinstance(path, bytes) else
+                      path.encode('utf-8'))
+        digest.update(b'\0%d\0%d\0%.6f\n' % (st.st_mode, st.st_size,
+                                              st.st_mtime))
+        if not is_dir:
+            files += 1
+            num_bytes += st.st_size
+
+    return {'digest': digest.hexdigest(), 'files': files, 'bytes': num_bytes}
+
+
+class FingerprintStore(object):
+    """Fingerprint of an item's tree at the time of its last backup.
+
+    Stored in ``<group>/.index/<postfix>.fingerprint`` together with the
+    name of the backup it belongs to.
+    """
+    def __init__(self, index_path, postfix):
+        self.index_path = index_path
+        self.path = os.path.join(index_path, postfix + '.fingerprint')
+
+    def read(self):
+        """Returns the stored dict with ``digest`` and ``name`` or None."""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write(self, fingerprint, name):
+        if not os.path.exists(self.index_path):
+            os.makedirs(self.index_path)
+        data = dict(fingerprint, name=name)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(self.path + '.tmp', self.path)
+
+
+def _walk_key(path):
+    """Sort key that matches the depth first order of ``walk_tree``."""
+    return path.split(os.sep)
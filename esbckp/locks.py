@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Advisory locks between esbckp processes.
+
+Locks are ``flock`` locks on files in ``<backup_storage_dir>/.locks``, so
+the kernel releases them when a process dies and no stale lock files need
+to be cleaned up. Commands and the daemon lock every group they work on,
+which keeps overlapping cron runs and daemon pipelines from writing,
+shipping and cleaning the same group at once.
+"""
+from __future__ import absolute_import, unicode_literals
+import click
+import errno
+import fcntl
+import os
+from contextlib import contextmanager
+from .constants import *
+
+LOCK_DIR = '.locks'
+
+
+class Lock(object):
+    """Exclusive or shared lock on the file at ``path``."""
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self._fd = None
+
+    @property
+    def name(self):
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+    def acquire(self, blocking=False):
+        """Takes the lock.
+
+        :return: False if another process holds it and ``blocking`` is not
+            set.
+        """
+        if not os.path.isdir(os.path.dirname(self.path)):
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(fd, flags if blocking else flags | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise click.ClickException(ERR_LOCKED.format(self.name,
+                                                         self.path))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def group_lock(backup_storage_dir, group_title):
+    """Returns the ``Lock`` of a group."""
+    return Lock(os.path.join(backup_storage_dir, LOCK_DIR,
+                             group_title.replace(os.sep, '#') + '.lock'))
+
+
+def chunk_lock(backup_storage_dir, shared=False):
+    """Returns the ``Lock`` of the chunk store.
+
+    Backups writing chunks hold it shared, removing unreferenced chunks
+    needs it exclusively, since chunks of a backup in progress are not yet
+    referenced by a manifest.
+    """
+    return Lock(os.path.join(backup_storage_dir, LOCK_DIR, 'chunks.lock'),
+                shared)
+
+
+@contextmanager
+def locked_groups(groups):
+    """Holds the locks of all ``groups`` during the block.
+
+    :raises: ClickException if another process holds one of them.
+    """
+    locks = list()
+    try:
+        for group in groups:
+            lock = group_lock(group.backup_storage_dir, group.group_title)
+            lock.__enter__()
+            locks.append(lock)
+        yield
+    finally:
+        for lock in locks:
+            lock.release()
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import click
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from .constants import *
+
+
+class Metrics(object):
+    """Appends timing and throughput records to a JSON lines file.
+
+    Every record describes one operation on one item: a file backup, a
+    dump, a transfer to one target or the cleaning of one group. Records
+    are appended with a single write each, so worker processes can record
+    to the same file. The object only holds paths and can be pickled.
+
+    If ``textfile_dir`` is set, ``write_textfile`` summarizes the records
+    of this run for the Prometheus node exporter's textfile collector.
+    """
+    def __init__(self, path, textfile_dir=None):
+        self.path = path
+        self.textfile_dir = textfile_dir
+        self.run_id = '{}-{}'.format(int(time.time()), os.getpid())
+        self._offset = os.path.getsize(path) if os.path.exists(path) else 0
+
+    @contextmanager
+    def measure(self, operation, group_title, item):
+        """Records wall and CPU time of the block as one record.
+
+        Yields a dict the block may fill with ``bytes_in``, ``bytes_out``
+        and ``stages``. CPU time is the one of the whole process including
+        child processes such as compressors, pg_dump and rsync. It is only
+        recorded if no other thread measured at the same time, since it
+        would include the CPU time of that thread's item too.
+        """
+        entry = {'bytes_in': None, 'bytes_out': None, 'stages': {}}
+        start = time.time()
+        cpu_start = cpu_time()
+        token = _measuring.start()
+        ok = False
+        try:
+            yield entry
+            ok = True
+        finally:
+            overlapped = _measuring.stop(token)
+            self.record(operation, group_title, item, time.time() - start,
+                        None if overlapped else cpu_time() - cpu_start,
+                        ok=ok, **entry)
+
+    def record(self, operation, group_title, item, seconds, cpu_seconds=None,
+               bytes_in=None, bytes_out=None, stages=None, ok=True):
+        line = json.dumps({
+            'run': self.run_id,
+            'time': round(time.time(), 3),
+            'operation': operation,
+            'group': group_title,
+            'item': item,
+            'ok': ok,
+            'seconds': round(seconds, 4),
+            'cpu_seconds': None if cpu_seconds is None else
+            round(cpu_seconds, 4),
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'stages': dict((k, round(v, 4)) for k, v in (stages or {}).items()),
+        }, sort_keys=True) + '\n'
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def records(self):
+        """Returns the records of this run, including those of workers."""
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            records = [json.loads(line) for line in f if line.strip()]
+        return [r for r in records if r['run'] == self.run_id]
+
+    def write_textfile(self, command):
+        """Writes the records of this run in Prometheus text format.
+
+        Each command writes ``esbckp_<command>.prom``, so a ``clean`` does
+        not replace the metrics of the last ``start``. Of several records
+        of an item only the last one is written. The file is replaced
+        atomically, as the textfile collector may read it at any time.
+        """
+        if not self.textfile_dir:
+            return
+
+        # A daemon records an item on every run, only the last one counts.
+        latest = OrderedDict()
+        for record in self.records():
+            latest[record['operation'], record['group'], record['item']] = \
+                record
+
+        lines = list()
+        for name, help_text in PROMETHEUS_METRICS:
+            lines.append('# HELP esbckp_{} {}'.format(name, help_text))
+            lines.append('# TYPE esbckp_{} gauge'.format(name))
+            for record in latest.values():
+                for labels, value in _samples(name, record):
+                    lines.append('esbckp_{}{{{}}} {}'.format(
+                        name, ','.join('{}="{}"'.format(k, _escape(v))
+                                       for k, v in labels), value))
+
+        path = os.path.join(self.textfile_dir,
+                            'esbckp_{}.prom'.format(command))
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, path)
+
+
+class _Measuring(object):
+    """Tracks the measures running in the threads of this process."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = {}
+
+    def start(self):
+        """Returns a token of a new measure of the calling thread."""
+        token = object()
+        thread = threading.current_thread().ident
+        with self._lock:
+            others = [t for t, (other, _) in self._active.items()
+                      if other != thread]
+            for t in others:
+                self._active[t][1] = True
+            self._active[token] = [thread, bool(others)]
+        return token
+
+    def stop(self, token):
+        """Ends the measure of ``token``.
+
+        :return: True if another thread measured while it ran.
+        """
+        with self._lock:
+            return self._active.pop(token)[1]
+
+
+_measuring = _Measuring()
+
+
+@contextmanager
+def measure(metrics, operation, group_title, item):
+    """Like ``Metrics.measure`` but only yields a dict if metrics is None."""
+    if metrics is None:
+        yield {'bytes_in': None, 'bytes_out': None, 'stages': {}}
+        return
+
+    with metrics.measure(operation, group_title, item) as entry:
+        yield entry
+
+
+class Timings(dict):
+    """Accumulates seconds per stage of a single operation.
+
+    Directory backups are timed in the stages ``walk``, ``read``,
+    ``compress``, ``encrypt`` and ``write``.
+    """
+    def add(self, stage, seconds):
+        self[stage] = self.get(stage, 0.0) + seconds
+
+    def stages(self):
+        """Returns the stages with the time of the stages they write to
+        taken out, compress writes to encrypt, which writes to write.
+        """
+        stages = dict(self)
+        write = stages.get('write', 0.0)
+        if 'encrypt' in stages:
+            encrypt = stages['encrypt']
+            stages['encrypt'] = max(0.0, encrypt - write)
+        else:
+            encrypt = write
+        if 'compress' in stages:
+            stages['compress'] = max(0.0, stages['compress'] - encrypt)
+        return stages
+
+
+class TimedFile(object):
+    """File-like wrapper that adds the time of reads and writes to a stage."""
+    def __init__(self, fileobj, timings, stage):
+        self.fileobj = fileobj
+        self.timings = timings
+        self.stage = stage
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self.fileobj.read(size)
+        self.timings.add(self.stage, time.time() - start)
+        return data
+
+    def write(self, data):
+        start = time.time()
+        self.fileobj.write(data)
+        self.timings.add(self.stage, time.time() - start)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+
+def timed(iterable, timings, stage):
+    """Yields from ``iterable`` and adds the time spent in it to a stage."""
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            value = next(iterator)
+        finally:
+            timings.add(stage, time.time() - start)
+        yield value
+
+
+# Metric name suffix and help text of the Prometheus textfile.
+PROMETHEUS_METRICS = (
+    ('seconds', 'Wall time of the last operation on an item.'),
+    ('cpu_seconds', 'CPU time of the process and its children during the '
+                    'last operation, unless it ran in parallel.'),
+    ('bytes_in', 'Bytes read by the last operation on an item.'),
+    ('bytes_out', 'Bytes written or sent by the last operation on an item.'),
+    ('stage_seconds', 'Wall time per stage of the last operation.'),
+    ('success', '1 if the last operation on an item succeeded.'),
+)
+
+
+def _samples(name, record):
+    labels = [('operation', record['operation']), ('group', record['group']),
+              ('item', record['item'])]
+
+    if name == 'stage_seconds':
+        return [(labels + [('stage', stage)], value)
+                for stage, value in sorted(record['stages'].items())]
+
+    if name == 'success':
+        return [(labels, 1 if record['ok'] else 0)]
+
+    if record[name] is None:
+        return []
+
+    return [(labels, record[name])]
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def cpu_time():
+    """Returns user and system time of this process and its waited for
+    children.
+    """
+    times = os.times()
+    return sum(times[:4])
+
+
+@contextmanager
+def profile(mode, report_dir, name):
+    """Profiles the block and saves a report to ``report_dir``.
+
+    ``cpu`` uses cProfile and saves the statistics sorted by cumulative
+    time, ``memory`` uses tracemalloc and saves the top allocations. Work
+    done in worker processes is not included.
+
+    :param mode: ``cpu``, ``memory`` or None to not profile.
+    :param name: Name of the report without extension.
+    """
+    if not mode:
+        yield
+        return
+
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    report_path = os.path.join(report_dir, '{}-{}.txt'.format(name, mode))
+
+    if mode == 'memory':
+        try:
+            import tracemalloc
+        except ImportError:
+            raise click.ClickException(ERR_TRACEMALLOC_MISSING)
+
+        tracemalloc.start(25)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            with open(report_path, 'w') as f:
+                f.write('Peak traced memory: {} bytes\n\n'.format(peak))
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write('{}\n'.format(stat))
+            click.echo('Saved memory profile to {}'.format(report_path))
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(report_path[:-len('.txt')] + '.prof')
+        with open(report_path, 'w') as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats('cumulative').print_stats(50)
+        click.echo('Saved CPU profile to {}'.format(report_path))
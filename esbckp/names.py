@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import re
+
+BACKUP_NAME_RE = re.compile(
+    r'^(?P<prefix>\d{4}-\d\d-\d\d--\d\d-\d\d-\d\d)__(?P<postfix>.+?)'
+    r'(?:\.incr-(?P<base>\d{4}-\d\d-\d\d--\d\d-\d\d-\d\d))?'
+    r'(?P<ext>(?:\.tar(?:\.gz|\.zst|\.lz4)?|\.dump|'
+    r'\.[a-z0-9]+(?:\.gz|\.zst|\.lz4)?)(?:\.enc)?|\.manifest|\.volumes)$')
+
+
+def parse_backup_name(fname):
+    """Returns a dict with prefix, postfix, base and ext of a backup file
+    name.
+
+    Dumps of sources other than postgres end in the extension of their
+    driver and compression, e.g. ``.sql.gz``, see ``sources.Source``.
+
+    ``base`` is the prefix of the full backup an incremental backup depends
+    on or None for full backups. Returns None for unknown file names.
+    """
+    match = BACKUP_NAME_RE.match(fname)
+    return match.groupdict() if match else None
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import click
+import ctypes
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+
+# Serializes progress lines of threads that share a terminal.
+_lock = threading.Lock()
+
+# Counters of the parent's ``SharedProgress`` in a worker process, see
+# ``init_worker``.
+_shared = None
+
+
+class Progress(object):
+    """Throttled progress line for archiving one item.
+
+    Instances are used as ``on_add`` callback of ``archiver.add_tree`` and
+    count files and bytes themselves, so every worker can have its own.
+    The line is redrawn at most every ``interval`` seconds and shows the
+    throughput and, if totals of the previous run are known, an ETA.
+
+    Output is disabled automatically if stdout is not a terminal, so cron
+    logs only receive the final messages. Worker processes count into a
+    ``SharedProgress`` of the parent instead, see ``worker_counter``.
+    """
+    def __init__(self, label='', total_files=None, total_bytes=None,
+                 interval=0.5, enabled=None):
+        self.label = label
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.enabled = stdout_is_tty() if enabled is None else enabled
+        self.files = 0
+        self.bytes = 0
+        self.start = time.time()
+        self._next_update = self.start + interval
+        self._width = 0
+
+    def __call__(self, tarinfo):
+        if tarinfo.isfile():
+            self.files += 1
+            self.bytes += tarinfo.size
+
+        if not self.enabled:
+            return
+
+        now = time.time()
+        if now >= self._next_update:
+            self._next_update = now + self.interval
+            self._draw(self.format_line(now))
+
+    def format_line(self, now=None):
+        elapsed = max((now or time.time()) - self.start, 1e-6)
+        rate = self.bytes / elapsed
+
+        if self.total_files:
+            files = '{}/~{} files'.format(self.files, self.total_files)
+        else:
+            files = '{} files'.format(self.files)
+
+        line = '{}{}, {:.1f} MB, {:.1f} MB/s'.format(
+            '{}: '.format(self.label) if self.label else '', files,
+            self.bytes / 1024.0 / 1024.0, rate / 1024.0 / 1024.0)
+
+        eta = self.eta(elapsed)
+        if eta is not None:
+            line += ', ETA {}'.format(format_duration(eta))
+
+        return line
+
+    def eta(self, elapsed):
+        """Returns the estimated remaining seconds or None.
+
+        Bytes are preferred over files, as a few large files can take longer
+        than thousands of small ones.
+        """
+        if self.total_bytes and self.bytes:
+            done = float(self.bytes) / self.total_bytes
+        elif self.total_files and self.files:
+            done = float(self.files) / self.total_files
+        else:
+            return None
+
+        if done >= 1:
+            return 0
+        return elapsed / done - elapsed
+
+    def finish(self):
+        """Clears the progress line."""
+        if self.enabled and self._width:
+            self._draw('')
+
+    def echo(self, message):
+        """Prints ``message`` on a line of its own, the progress line is
+        drawn again below it on the next update.
+        """
+        self.finish()
+        with _lock:
+            click.echo(message)
+
+    def _draw(self, line):
+        padding = ' ' * max(0, self._width - len(line))
+        self._width = len(line)
+        with _lock:
+            click.echo(click.style('\r' + line + padding, fg='yellow') +
+                       ('\r' if not line else ''), nl=False)
+
+
+class SharedProgress(Progress):
+    """One progress line of the items archived by the worker processes of
+    a pool.
+
+    ``counters`` of files and bytes live in shared memory and are handed
+    to the workers by the pool initializer ``init_worker``, where
+    ``do_file_backup`` counts into them through a ``SharedCounter``.
+    ``drawing`` redraws the line from them while its block runs.
+    """
+    def __init__(self, label='', interval=0.5, enabled=None):
+        super(SharedProgress, self).__init__(label, interval=interval,
+                                             enabled=enabled)
+        self.counters = multiprocessing.Array(ctypes.c_longlong, 2)
+
+    def refresh(self):
+        """Reads the counters and redraws the line."""
+        with self.counters.get_lock():
+            self.files, self.bytes = self.counters[:]
+        if self.enabled:
+            self._draw(self.format_line())
+
+    @contextmanager
+    def drawing(self):
+        """Redraws the line every ``interval`` seconds during the block."""
+        stop = threading.Event()
+
+        def draw():
+            while not stop.wait(self.interval):
+                self.refresh()
+
+        thread = threading.Thread(target=draw)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+            self.refresh()
+            self.finish()
+
+
+class SharedCounter(object):
+    """``on_add`` callback of a worker process that adds files and bytes
+    to the counters of a ``SharedProgress``.
+
+    Counts are added at most every ``interval`` seconds and by ``finish``,
+    so workers don't contend for the lock of the counters on every file.
+    """
+    def __init__(self, counters, interval=0.2):
+        self.counters = counters
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self._next_flush = time.time() + interval
+
+    def __call__(self, tarinfo):
+        if tarinfo.isfile():
+            self.files += 1
+            self.bytes += tarinfo.size
+
+        now = time.time()
+        if now >= self._next_flush:
+            self._next_flush = now + self.interval
+            self._flush()
+
+    def finish(self):
+        self._flush()
+
+    def _flush(self):
+        if not self.files and not self.bytes:
+            return
+        with self.counters.get_lock():
+            self.counters[0] += self.files
+            self.counters[1] += self.bytes
+        self.files = self.bytes = 0
+
+
+def init_worker(counters):
+    """Initializer of pool processes that count into ``counters``, see
+    ``SharedProgress``.
+    """
+    global _shared
+    _shared = counters
+
+
+def worker_counter():
+    """Returns a ``SharedCounter`` in worker processes of a pool with a
+    ``SharedProgress`` or None.
+    """
+    return SharedCounter(_shared) if _shared is not None else None
+
+
+def stdout_is_tty():
+    try:
+        return click.get_text_stream('stdout').isatty()
+    except (AttributeError, ValueError):
+        return False
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import click
+import fnmatch
+import os
+import re
+import tarfile
+from multiprocessing.pool import ThreadPool
+from .constants import *
+from .encryption import ENCRYPTED_EXTENSION
+from .incremental import DELETED_MEMBER
+from .seekindex import SEEKABLE_CODECS, read_index, open_indexed
+from .streams import open_backup_stream
+from .names import parse_backup_name
+from .volumes import VOLUMES_EXTENSION, volume_paths, find_volumes
+
+GLOB_CHARS = re.compile(r'[*?[]')
+
+
+def find_restore_chain(group, source, at=None):
+    """Returns the backups needed to restore ``source`` as it was at ``at``.
+
+    :param group: Instance of ``BackupGroup``
+    :param source: Backed up directory as configured in ``dir``.
+    :param at: Optional (partial) filename prefix, e.g. ``2014-11-05``.
+        Defaults to the latest backup.
+    :return: List of paths, a full backup followed by its incrementals.
+    """
+    postfix = os.path.expanduser(source).replace(os.sep, '#')
+    backups = list()
+    for fname in os.listdir(group.base_path):
+        name = parse_backup_name(fname)
+        if not name or name['postfix'] != postfix:
+            continue
+        if at and name['prefix'][:len(at)] > at:
+            continue
+        backups.append((name['prefix'], name['base'], fname))
+
+    if not backups:
+        raise click.ClickException(ERR_NO_BACKUP_FOUND.format(source, at or ''))
+
+    latest_prefix, base, _ = max(backups)
+    if base is None:
+        chain = [b for b in backups if b[0] == latest_prefix]
+    else:
+        chain = sorted(b for b in backups
+                       if (b[0] == base and b[1] is None) or
+                       (b[1] == base and b[0] <= latest_prefix))
+        if chain[0][0] != base:
+            raise click.ClickException(ERR_BROKEN_CHAIN.format(base))
+
+    return [os.path.join(group.base_path, b[2]) for b in chain]
+
+
+def restore_chain(group, paths, target, source=None, pattern=None, jobs=1):
+    """Extracts ``paths`` in order into ``target``.
+
+    Files listed as deleted in an incremental backup are removed from
+    ``target`` after the backup was extracted.
+
+    Archives with an index, see ``seekindex``, are read from the offsets of
+    the selected members only and extracted by ``jobs`` threads. Other
+    backups are read as one stream.
+
+    :param source: Backed up directory, needed with ``pattern``.
+    :param pattern: Optional glob of paths relative to ``source``. Only
+        matching files and directories and everything below them are
+        restored. Of split backups only the volumes that can hold them are
+        read.
+    :param jobs: Number of threads extracting indexed archives.
+    """
+    selected = path_selector(source, pattern) if pattern else \
+        lambda name: True
+    member = os.path.join(source, pattern.strip('/')) \
+        if pattern and not GLOB_CHARS.search(pattern) else None
+
+    for path in paths:
+        click.echo(click.style('Restoring {}'.format(path), fg='yellow'))
+        tasks = list()
+        deferred = list()
+
+        for part in backup_parts(path, source, member,
+                                 group.encryption_key):
+            index = read_index(part, _key(group, part))
+            if not index or index['codec'] not in SEEKABLE_CODECS:
+                with open_backup_stream(group, part) as tar:
+                    for info in tar:
+                        _extract(tar, info, target, selected, deferred)
+                continue
+
+            members = [m for m in index['members']
+                       if m[0] == DELETED_MEMBER or selected(m[0])]
+            size = -(-len(members) // jobs) if members else 1
+            tasks.extend((part, index, members[x:x + size])
+                         for x in range(0, len(members), size))
+
+        if tasks:
+            _make_parent_dirs(target, [m[0] for t in tasks for m in t[2]])
+            pool = ThreadPool(jobs)
+            try:
+                results = [pool.apply_async(_extract_indexed, task + (
+                    target, selected, _key(group, task[0])))
+                    for task in tasks]
+                for result in results:
+                    deferred.extend(result.get())
+            finally:
+                pool.close()
+                pool.join()
+
+        _finish_deferred(target, deferred)
+
+
+def backup_parts(path, source=None, member=None, key=None):
+    """Returns the volumes of a split backup that hold ``member`` or
+    ``path`` itself for other backups.
+
+    :param key: Key of an encrypted group, see ``volumes.find_volumes``.
+    """
+    if not path.endswith(VOLUMES_EXTENSION):
+        return [path]
+    if member:
+        return find_volumes(path, source, member, key)
+    return volume_paths(path)
+
+
+def _key(group, path):
+    """Returns the key to decrypt ``path`` with or None if it is plain."""
+    return group.encryption_key if path.endswith(ENCRYPTED_EXTENSION) \
+        else None
+
+
+def path_selector(source, pattern):
+    """Returns a function that tells if a member is selected by ``pattern``.
+
+    A member is selected if its path relative to ``source`` or the path of
+    one of its parent directories matches.
+    """
+    prefix = member_name(source).rstrip('/') + '/'
+    pattern = pattern.strip('/')
+
+    def selected(name):
+        if not name.startswith(prefix):
+            return False
+        parts = name[len(prefix):].split('/')
+        return any(fnmatch.fnmatchcase('/'.join(parts[:x]), pattern)
+                   for x in range(1, len(parts) + 1))
+
+    return selected
+
+
+def member_name(path):
+    """Returns the name ``tarfile`` gives the member archived from
+    ``path``.
+    """
+    return path.replace(os.sep, '/').lstrip('/')
+
+
+def _extract_indexed(path, index, members, target, selected, key=None):
+    """Extracts ``members`` of the indexed archive at ``path``.
+
+    :param key: Encryption key of the archive, if it is encrypted.
+    :return: List of deferred ``TarInfo`` objects, see ``_extract``.
+    """
+    deferred = list()
+    fileobj = open_indexed(path, index, key)
+    try:
+        fileobj.seek(members[0][1])
+        tar = tarfile.open(fileobj=fileobj, mode='r:')
+        for name, offset in members:
+            # The first member was read when the archive was opened.
+            tar.offset = offset
+            _extract(tar, tar.next(), target, selected, deferred)
+            tar.members = []
+    finally:
+        fileobj.close()
+    return deferred
+
+
+def _extract(tar, info, target, selected, deferred):
+    """Extracts one member.
+
+    Hard links are deferred until their targets were extracted, which
+    may happen in another thread. Directories are extracted right away, but
+    appended to ``deferred`` to set their times once they are filled.
+    """
+    if info.name == DELETED_MEMBER:
+        data = tar.extractfile(info).read().decode('utf-8')
+        _remove_deleted(target, [n for n in data.split('\n')
+                                 if n and selected(n)])
+    elif not selected(info.name):
+        return
+    elif info.islnk():
+        deferred.append(info)
+    else:
+        tar.extract(info, target)
+        if info.isdir():
+            deferred.append(info)
+
+
+def _finish_deferred(target, deferred):
+    for info in deferred:
+        if not info.islnk():
+            continue
+        source = os.path.join(target, info.linkname)
+        path = os.path.join(target, info.name)
+        if not os.path.exists(source):
+            click.echo(click.style(ERR_LINK_TARGET_MISSING.format(
+                info.name, info.linkname), fg='yellow'), err=True)
+            continue
+        if os.path.lexists(path):
+            os.remove(path)
+        os.link(source, path)
+
+    directories = [i for i in deferred if i.isdir()]
+    for info in sorted(directories, key=lambda i: i.name, reverse=True):
+        path = os.path.join(target, info.name)
+        if os.path.isdir(path):
+            os.utime(path, (info.mtime, info.mtime))
+
+
+def _make_parent_dirs(target, names):
+    """Creates parent directories up front, so threads do not race."""
+    for parent in set(os.path.dirname(n) for n in names):
+        path = os.path.join(target, parent)
+        if parent and not os.path.isdir(path):
+            os.makedirs(path)
+
+
+def _remove_deleted(target, names):
+    for name in names:
+        path = os.path.join(target, name)
+        if os.path.isfile(path) or os.path.islink(path):
+            os.remove(path)
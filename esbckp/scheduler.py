@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import threading
+import time
+import traceback
+from collections import defaultdict
+from datetime import timedelta
+
+# Fields of a cron schedule with their smallest and largest value.
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+class Job(object):
+    """Data object for one unit of work run by the ``Scheduler``.
+
+    ``slots`` is a list of ``(kind, key)`` tuples, e.g. ``('group', 'test1')``
+    or ``('device', 2049)``. The scheduler never runs more jobs holding a slot
+    of the same kind and key than the limit configured for that kind.
+    """
+    def __init__(self, title, func, args=(), slots=()):
+        self.title = title
+        self.func = func
+        self.args = args
+        self.slots = list(set(slots))
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.duration = None
+
+    def run(self):
+        start = time.time()
+        try:
+            self.result = self.func(*self.args)
+        except Exception, e:
+            self.error = e
+            self.traceback = traceback.format_exc()
+        finally:
+            self.duration = time.time() - start
+
+
+class Scheduler(object):
+    """Runs jobs on a pool of worker threads.
+
+    Jobs are picked in the order they were added, skipping jobs whose slots
+    are exhausted until a running job releases them. Limits are given per
+    slot kind or, overriding that, per ``(kind, key)`` slot. A limit of 0
+    or None means no cap.
+    """
+    def __init__(self, jobs=1, limits=None):
+        self.jobs = max(1, jobs)
+        self.limits = limits or {}
+        self.finished = []
+        self.total = 0
+        self._pending = []
+        self._active = defaultdict(int)
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self.total
+
+    def add(self, job):
+        self._pending.append(job)
+        self.total += 1
+
+    def run(self, on_done=None):
+        """Runs all added jobs and blocks until they are done.
+
+        :param on_done: Optional callable invoked with each finished ``Job``.
+        :return: List of finished jobs in order of completion.
+        """
+        threads = [threading.Thread(target=self._work, args=(on_done,))
+                   for _ in range(min(self.jobs, len(self._pending)))]
+
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        return self.finished
+
+    def _work(self, on_done):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            job.run()
+
+            with self._cond:
+                for slot in job.slots:
+                    self._active[slot] -= 1
+                self.finished.append(job)
+                if on_done:
+                    on_done(job)
+                self._cond.notify_all()
+
+    def _next_job(self):
+        with self._cond:
+            while self._pending:
+                for job in self._pending:
+                    if all(self._has_capacity(s) for s in job.slots):
+                        self._pending.remove(job)
+                        for slot in job.slots:
+                            self._active[slot] += 1
+                        return job
+                self._cond.wait()
+            return None
+
+    def _has_capacity(self, slot):
+        limit = self.limits.get(slot, self.limits.get(slot[0]))
+        return not limit or self._active[slot] < limit
+
+
+class CronSchedule(object):
+    """Schedule in the five field format of crontab, e.g. ``30 3 * * *``.
+
+    Fields are minute, hour, day of month, month and weekday and accept
+    ``*``, numbers, ranges, lists and steps like ``*/15`` or ``1-5``.
+    Weekdays 0 and 7 are Sunday. As in cron, a day matches if its day of
+    month or its weekday matches when both fields are restricted.
+
+    :raises: ValueError if ``expr`` is not a schedule.
+    """
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError('expected 5 fields, got {}'.format(len(fields)))
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            _parse_cron_field(field, low, high)
+            for field, (low, high) in zip(fields, CRON_FIELDS)]
+        self.weekdays = set(day % 7 for day in weekdays)
+        self._any_day = '*' in (fields[2], fields[4])
+
+    def next_after(self, dt):
+        """Returns the first full minute after ``dt`` that matches.
+
+        :raises: ValueError if no day in the next years matches, e.g. for
+            ``0 0 31 2 *``.
+        """
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=5 * 366)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) +
+                     timedelta(days=32)).replace(day=1)
+            elif not self._matches_day(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError('never matches')
+
+    def _matches_day(self, t):
+        day = t.day in self.days
+        weekday = t.isoweekday() % 7 in self.weekdays
+        if self._any_day:
+            return day and weekday
+        return day or weekday
+
+
+def _parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        body, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if body == '*':
+            start, end = low, high
+        elif '-' in body:
+            start, end = [int(x) for x in body.split('-', 1)]
+        else:
+            start = int(body)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError('{} is out of range {}-{}'.format(part, low, high))
+        values.update(range(start, end + 1, step))
+    return values
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import bisect
+import gzip
+import io
+import json
+import os
+import zlib
+from .encryption import EncryptingWriter, open_decrypted
+
+# Codecs whose archives can be read from an offset with an index. pigz
+# writes a single gzip member, which could only be read from the start.
+SEEKABLE_CODECS = ('gzip', 'none')
+
+# Compressed bytes read from an archive at once.
+READ_SIZE = 64 * 1024
+
+
+class IndexedTar(object):
+    """Wraps a ``TarFile`` opened for writing and records the offset of
+    every member in the tar stream.
+
+    Can be passed to ``archiver.add_tree`` in place of the ``TarFile``.
+    """
+    def __init__(self, tar):
+        self.tar = tar
+        self.members = list()
+
+    def gettarinfo(self, name):
+        return self.tar.gettarinfo(name)
+
+    def addfile(self, tarinfo, fileobj=None):
+        self.members.append((tarinfo.name, self.tar.offset))
+        self.tar.addfile(tarinfo, fileobj)
+
+
+def sidecar_path(path):
+    """Returns the path of the index of the archive at ``path``.
+
+    The index is a hidden file next to the archive, so it is neither
+    shipped nor mistaken for a backup.
+    """
+    head, tail = os.path.split(path)
+    return os.path.join(head, '.{}.idx'.format(tail))
+
+
+def write_index(path, codec, members, seek_points=None, key=None):
+    """Writes the index of the archive at ``path``.
+
+    The index is a gzipped file of JSON lines. The first line holds the
+    codec and the seek points, every other line the name and tar offset of
+    one member.
+
+    :param seek_points: Optional list of uncompressed and compressed
+        offsets at which a new gzip member starts.
+    :param key: Encryption key of the archive. The index lists the names
+        of all members, so it is encrypted like the archive.
+    """
+    index_path = sidecar_path(path)
+    with open(index_path + '.tmp', 'wb') as raw:
+        out = EncryptingWriter(raw, key) if key else raw
+        with gzip.GzipFile(fileobj=out, mode='wb') as f:
+            f.write(json.dumps({'codec': codec,
+                                'seek_points': seek_points or []}) + '\n')
+            for member in members:
+                f.write(json.dumps(member) + '\n')
+        if key:
+            out.close()
+    os.rename(index_path + '.tmp', index_path)
+
+
+def read_index(path, key=None):
+    """Returns the index of the archive at ``path`` or None.
+
+    :param key: Encryption key of the archive.
+    :return: Dict with ``codec``, ``seek_points`` and ``members``, a list
+        of name and offset tuples in archive order.
+    """
+    index_path = sidecar_path(path)
+    try:
+        if key:
+            reader = open_decrypted(index_path, key)
+            try:
+                f = gzip.GzipFile(fileobj=io.BytesIO(reader.read()))
+            finally:
+                reader.close()
+        else:
+            f = gzip.open(index_path, 'rb')
+        with f:
+            index = json.loads(f.readline())
+            index['members'] = [tuple(json.loads(line)) for line in f]
+    except (IOError, ValueError):
+        return None
+    return index
+
+
+def open_indexed(path, index, key=None):
+    """Returns a seekable file object of the tar stream of ``path``.
+
+    :param key: Encryption key of the archive, if it is encrypted.
+    """
+    fileobj = open_decrypted(path, key) if key else open(path, 'rb')
+    if index['codec'] == 'none':
+        return fileobj
+    return GzipSeekReader(fileobj, index['seek_points'])
+
+
+class GzipSeekReader(object):
+    """Read only file object of the decompressed data of a gzip file.
+
+    Seeking forward decompresses and skips the data in between unless a
+    seek point lies in between. Then, like for seeking backward, reading
+    restarts at the closest gzip member before the new position. Archives
+    of ``compression.ParallelGzipWriter`` start a member every block.
+
+    :param path: Path or seekable file object of the gzip file.
+    :param seek_points: List of uncompressed and compressed offsets of
+        gzip members.
+    """
+    def __init__(self, path, seek_points=()):
+        self._file = path if hasattr(path, 'read') else open(path, 'rb')
+        self._points = sorted(set([(0, 0)] + [tuple(p) for p in seek_points]))
+        self._offsets = [p[0] for p in self._points]
+        self._decompressor = None
+        self._pending = b''
+        self._buffer = b''
+        self._buffer_pos = 0
+        self._offset = 0
+        self._restart(self._points[0])
+
+    def tell(self):
+        return self._buffer_pos + self._offset
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.tell()
+        elif whence == 2:
+            raise IOError('Can not seek from the end of a gzip stream.')
+
+        if self._buffer_pos <= pos <= self._buffer_pos + len(self._buffer):
+            self._offset = pos - self._buffer_pos
+            return
+
+        point = self._points[bisect.bisect_right(self._offsets, pos) - 1]
+        if pos < self.tell() or point[0] > self.tell():
+            self._restart(point)
+        self._skip(pos - self.tell())
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) - self._offset < size:
+            if not self._fill():
+                break
+
+        end = len(self._buffer) if size < 0 else self._offset + size
+        data = self._buffer[self._offset:end]
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+    def _restart(self, point):
+        self._file.seek(point[1])
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._pending = b''
+        self._buffer = b''
+        self._buffer_pos = point[0]
+        self._offset = 0
+
+    def _skip(self, size):
+        while size > 0:
+            data = self.read(min(size, READ_SIZE * 16))
+            if not data:
+                break
+            size -= len(data)
+
+    def _fill(self):
+        """Decompresses the next piece, returns False at the end."""
+        data = self._pending or self._file.read(READ_SIZE)
+        self._pending = b''
+        if not data:
+            return False
+
+        out = self._decompressor.decompress(data)
+        if self._decompressor.unused_data:
+            # The member ended, the rest starts the next one.
+            self._pending = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        # Data before the current position is only kept until the next
+        # fill, which allows cheap seeks back to a header just read.
+        self._buffer_pos += self._offset
+        self._buffer = self._buffer[self._offset:] + out
+        self._offset = 0
+        return True
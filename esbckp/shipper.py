@@ -1,13 +1,34 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+import click
+import os
+import pipes
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from .constants import *
+from .metrics import measure
+
+# Extensions of files rsync should not try to compress in transit.
+SKIP_COMPRESS = 'gz/tgz/zst/lz4/xz/bz2/dump/manifest/enc'
+
+# Files hashed by one remote sha256sum call.
+CHECKSUM_BATCH_SIZE = 500
+
+# Seconds a shared ssh connection stays open after its last transfer.
+CONTROL_PERSIST = 60
 
 
 class Shipper(object):
     """Ships backups via rsync to remote destination.
 
     Mostly a small wrapper around the rsync command that will be invoked
-    via ``subprocess.call()``.
+    via ``subprocess.call()``. A group has one ``Shipper`` per target host.
     """
     def __init__(self):
         self.ssh_port = 22
@@ -15,19 +36,377 @@ class Shipper(object):
         self.host = None
         self.source_dir = None
         self.target_dir = None
+        self.chunk_dir = None
+        self.bwlimit = None
+        self.retries = 2
+        self.retry_delay = 10
+        self.volume_jobs = 1
+        self.catalog = None
+        self.group_title = None
+        self.metrics = None
+        self.control_path = None
+
+    @property
+    def target(self):
+        return '{}@{}:{}'.format(self.user, self.host, self.target_dir)
+
+    def get_rsync_cmd(self, source_dir=None, target_dir=None, compress=True,
+                      bwlimit=None, files_from=None):
+        """Builds rsync command from Shipper configuration.
+
+        :param compress: Flag that indicates whether to use transport
+            compression. Files that are compressed already are skipped.
+        :param bwlimit: Bandwidth limit in KB/s for this transfer.
+        :param files_from: Optional path of a file listing the paths
+            relative to ``source_dir`` to transfer.
+        """
+        cmd = ['rsync', '-rv', '-e', ' '.join(
+            pipes.quote(arg) for arg in ['ssh'] + self.get_ssh_options()),
+               '--ignore-existing', '--exclude=.*']
+
+        if compress:
+            cmd += ['-z', '--skip-compress={}'.format(SKIP_COMPRESS)]
+
+        if bwlimit:
+            cmd += ['--bwlimit={}'.format(bwlimit)]
+
+        if files_from:
+            cmd += ['--files-from={}'.format(files_from)]
+
+        return cmd + [source_dir or self.source_dir, '{}@{}:{}'.format(
+            self.user, self.host, target_dir or self.target_dir)]
+
+    def get_new_entries(self):
+        """Returns names of backups not shipped to this target yet.
+
+        The names are queried from the ``Catalog``, the group directory is
+        only read once to import backups the catalog does not know yet.
+        """
+        self.catalog.ensure_imported(self.group_title, self.source_dir)
+        return self.catalog.unshipped(self.group_title, self.target)
+
+    def ship(self, bwlimit=None, rescan=False):
+        """Ships current group to target location via rsync.
+
+        Only entries the ``Catalog`` has not recorded for this target are
+        sent in one batch using ``--files-from``, so rsync neither lists nor
+        compares the backups shipped before. Without new entries no
+        connection is made.
+        Chunks of chunked groups are shipped first, so remote manifests
+        never reference chunks that are not there yet.
+
+        Failed transfers are retried ``retries`` times with exponential
+        backoff starting at ``retry_delay`` seconds.
+
+        :param bwlimit: Bandwidth limit in KB/s, overrides ``self.bwlimit``
+            if it is lower.
+        :param rescan: Ignore the catalog and let rsync compare the whole
+            group directory with the target.
+        :return: List of shipped entry names.
+        :raises: ClickException if a transfer still fails after retrying.
+        """
+        limits = [l for l in (bwlimit, self.bwlimit) if l]
+        bwlimit = min(limits) if limits else None
+        target_dir = os.path.join(self.target_dir, self.group_title)
+
+        if rescan:
+            names = sorted(n for n in os.listdir(self.source_dir)
+                           if not n.startswith('.'))
+        else:
+            names = self.get_new_entries()
+
+        if not names:
+            return names
+
+        # Cron runs without new backups return above and never load the
+        # modules below.
+        from .chunkstore import MANIFEST_EXTENSION, read_manifest
+        from .dumps import path_size
+
+        with measure(self.metrics, 'ship', self.group_title,
+                     self.target) as m:
+            if self.chunk_dir:
+                chunks = set()
+                for name in names:
+                    if name.endswith(MANIFEST_EXTENSION):
+                        manifest = read_manifest(
+                            os.path.join(self.source_dir, name))
+                        chunks.update(os.path.join(d[:2], d)
+                                      for d, _ in manifest['chunks'])
+
+                start = time.time()
+                self._ship_batch(self.chunk_dir,
+                                 os.path.join(self.target_dir, '.chunks'),
+                                 sorted(chunks), bwlimit, compress=False)
+                m['stages']['chunks'] = time.time() - start
+
+            start = time.time()
+            self._ship_entries(target_dir, names, bwlimit)
+            m['stages']['ship'] = time.time() - start
+            m['bytes_out'] = sum(path_size(os.path.join(self.source_dir, n))
+                                 for n in names)
+
+        self.catalog.record_shipment(self.group_title, self.target, names)
+
+        return names
+
+    def get_ssh_options(self):
+        """Returns the options of ssh connections to the host.
+
+        With a ``control_path`` connections go through one master
+        connection per host, see ``ssh_connections``.
+        """
+        options = ['-p', '{}'.format(self.ssh_port)]
+        if self.control_path:
+            options += ['-o', 'ControlMaster=auto',
+                        '-o', 'ControlPath={}'.format(self.control_path),
+                        '-o', 'ControlPersist={}'.format(CONTROL_PERSIST)]
+        return options
+
+    def get_ssh_cmd(self, command):
+        """Builds the ssh command that runs ``command`` on the host."""
+        return ['ssh'] + self.get_ssh_options() + [
+            '{}@{}'.format(self.user, self.host), command]
+
+    def remote_checksums(self, names):
+        """Returns sha256 digests of shipped files, computed on the host.
+
+        Only the digests travel back, nothing is downloaded. Files missing
+        on the host are left out.
+
+        :param names: Paths relative to the target directory of the group.
+        :return: Dict of name -> hex digest.
+        :raises: ClickException if ssh or sha256sum fail otherwise.
+        """
+        target_dir = os.path.join(self.target_dir, self.group_title)
+        checksums = dict()
+        for x in range(0, len(names), CHECKSUM_BATCH_SIZE):
+            batch = names[x:x + CHECKSUM_BATCH_SIZE]
+            command = 'cd {} && sha256sum -- {}'.format(
+                pipes.quote(target_dir),
+                ' '.join(pipes.quote(n) for n in batch))
+            proc = subprocess.Popen(
+                self.get_ssh_cmd(command.encode('utf-8')),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+            # sha256sum exits with 1 if some files are missing.
+            if proc.returncode not in (0, 1):
+                raise click.ClickException(ERR_REMOTE_CHECKSUMS_FAILED.format(
+                    self.host, proc.returncode, err.strip()))
+            for line in out.decode('utf-8').splitlines():
+                digest, _, name = line.partition('  ')
+                checksums[name] = digest
+        return checksums
+
+    def verify(self, checksums):
+        """Compares shipped files with the digests they were written with.
+
+        :param checksums: Dict of name relative to the target directory of
+            the group -> hex digest.
+        :return: Number of verified files.
+        :raises: ClickException if files are missing or differ.
+        """
+        names = sorted(checksums)
+        remote = self.remote_checksums(names)
+        bad = [n for n in names if remote.get(n) != checksums[n]]
+        if bad:
+            raise click.ClickException(ERR_REMOTE_MISMATCH.format(
+                len(bad), self.target, ', '.join(bad[:10])))
+        return len(names)
+
+    def _ship_entries(self, target_dir, names, bwlimit):
+        """Transfers backups, the volumes of split backups in parallel.
+
+        Volumes are distributed over ``volume_jobs`` rsync runs that share
+        ``bwlimit``, so a failed run only retries its own volumes. The
+        ``volumes.json`` files are sent last, so a remote split backup is
+        only complete once all its volumes arrived.
+        """
+        from multiprocessing.pool import ThreadPool
+        from .volumes import VOLUMES_EXTENSION, VOLUMES_FILE, volume_paths
+
+        split = [n for n in names if n.endswith(VOLUMES_EXTENSION)]
+        if self.volume_jobs < 2 or not split:
+            self._ship_batch(self.source_dir, target_dir, names, bwlimit)
+            return
+
+        others = [n for n in names if n not in split]
+        if others:
+            self._ship_batch(self.source_dir, target_dir, others, bwlimit)
+
+        volumes = [os.path.relpath(p, self.source_dir) for name in split
+                   for p in volume_paths(os.path.join(self.source_dir, name))]
+        jobs = min(self.volume_jobs, len(volumes))
+        batches = [volumes[x::jobs] for x in range(jobs)]
+        batch_bwlimit = share_bwlimit(bwlimit, jobs)
+
+        pool = ThreadPool(jobs)
+        try:
+            results = [pool.apply_async(self._ship_batch, (
+                self.source_dir, target_dir, batch, batch_bwlimit))
+                for batch in batches]
+            for result in results:
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+
+        self._ship_batch(self.source_dir, target_dir,
+                         [os.path.join(n, VOLUMES_FILE) for n in split],
+                         bwlimit)
+
+    def _ship_batch(self, source_dir, target_dir, names, bwlimit,
+                    compress=True):
+        """Transfers ``names`` relative to ``source_dir`` in one rsync run."""
+        with tempfile.NamedTemporaryFile(suffix='.files') as f:
+            f.write('\n'.join(names).encode('utf-8'))
+            f.flush()
+            cmd = self.get_rsync_cmd(source_dir.rstrip(os.sep) + os.sep,
+                                     target_dir, compress, bwlimit, f.name)
+            run_with_retries(cmd, self.retries, self.retry_delay)
+
+
+class ShipQueue(object):
+    """Ships backups of groups while other backups are still written.
+
+    ``notify`` is called whenever a backup of a group is complete and
+    queues its shippers. One thread per host ships the queued ones after
+    another, so backups that finish during a transfer go out together in
+    the next one. Shippers send what the catalog has not recorded for
+    their target, so nothing is sent twice and partial backups are never
+    sent. ``close`` ships all groups once more and waits.
+    """
+    def __init__(self, groups):
+        self.errors = OrderedDict()
+        self._shippers = dict((g.group_title, g.shippers) for g in groups)
+        self._pending = OrderedDict()
+        self._closed = False
+        self._cond = threading.Condition()
+        for shippers in self._shippers.values():
+            for shipper in shippers:
+                self._pending.setdefault(shipper.host, list())
+
+        self._threads = [threading.Thread(target=self._work, args=(host,))
+                         for host in self._pending]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def notify(self, group):
+        """Queues the shippers of ``group``, a ``BackupGroup``."""
+        with self._cond:
+            self._queue(self._shippers.get(group.group_title, []))
+
+    def close(self):
+        """Ships every group a last time and waits for all transfers.
+
+        :return: Dict of (group title, target) -> exception of the
+            shippers whose last transfer failed.
+        """
+        with self._cond:
+            for shippers in self._shippers.values():
+                self._queue(shippers)
+            self._closed = True
+        for t in self._threads:
+            t.join()
+        return self.errors
+
+    def _queue(self, shippers):
+        for shipper in shippers:
+            if shipper not in self._pending[shipper.host]:
+                self._pending[shipper.host].append(shipper)
+        self._cond.notify_all()
+
+    def _work(self, host):
+        while True:
+            with self._cond:
+                while not self._pending[host] and not self._closed:
+                    self._cond.wait()
+                if not self._pending[host]:
+                    return
+                shipper = self._pending[host].pop(0)
+
+            key = (shipper.group_title, shipper.target)
+            try:
+                names = shipper.ship()
+            except Exception, e:
+                # Any error, e.g. a missing rsync, fails only this transfer
+                # and keeps the thread shipping to its host.
+                self.errors[key] = e
+                if isinstance(e, click.ClickException):
+                    message = e.message
+                else:
+                    message = traceback.format_exc()
+                click.echo(click.style(message, fg='red'), err=True)
+                continue
+            self.errors.pop(key, None)
+            if names:
+                click.echo('Shipped {} backup(s) of {} to {}'.format(
+                    len(names), shipper.group_title, shipper.target))
+
+
+@contextmanager
+def ssh_connections(shippers):
+    """Shares one ssh connection per host between the transfers of the
+    block.
+
+    The first connection to a host becomes a ControlMaster that later
+    rsync and ssh runs of ``shippers`` reuse instead of negotiating their
+    own. Masters are closed when the block is left.
+    """
+    if not shippers:
+        yield
+        return
+
+    control_dir = tempfile.mkdtemp(prefix='esbckp-ssh-')
+    for shipper in shippers:
+        shipper.control_path = os.path.join(control_dir, '%r@%h:%p')
+    try:
+        yield
+    finally:
+        with open(os.devnull, 'w') as devnull:
+            for shipper in unique_hosts(shippers):
+                if os.listdir(control_dir):
+                    subprocess.call(
+                        ['ssh'] + shipper.get_ssh_options() + [
+                            '-O', 'exit',
+                            '{}@{}'.format(shipper.user, shipper.host)],
+                        stdout=devnull, stderr=devnull)
+        for shipper in shippers:
+            shipper.control_path = None
+        shutil.rmtree(control_dir, ignore_errors=True)
+
+
+def unique_hosts(shippers):
+    """Returns one of the ``shippers`` per user, host and port."""
+    found = OrderedDict()
+    for shipper in shippers:
+        found.setdefault((shipper.user, shipper.host, shipper.ssh_port),
+                         shipper)
+    return list(found.values())
+
+
+def share_bwlimit(bwlimit, transfers):
+    """Returns the share of ``bwlimit`` of each of ``transfers`` transfers
+    running at once, at least 1 KB/s since rsync takes 0 as no limit.
+    """
+    if not bwlimit:
+        return None
+    return max(1, bwlimit // max(1, transfers))
+
+
+def run_with_retries(cmd, retries, delay):
+    """Runs ``cmd`` until it succeeds or ``retries`` are exhausted."""
+    for attempt in range(retries + 1):
+        returncode = subprocess.call(cmd)
+        if returncode == 0:
+            return
+
+        if attempt < retries:
+            wait = delay * 2 ** attempt
+            click.echo(click.style(ERR_SHIP_RETRY.format(
+                ' '.join(cmd), returncode, wait), fg='yellow'), err=True)
+            time.sleep(wait)
 
-    def get_rsync_cmd(self):
-        """Builds rsync command from Shipper configuration."""
-        # TODO(sthzg) Create as list.
-        cmd = "rsync -rvz -e 'ssh -p {}' --progress --ignore-existing {} {}@{}:{}"  # NOQA
-        return cmd.format(
-            self.ssh_port,
-            self.source_dir,
-            self.user,
-            self.host,
-            self.target_dir)
-
-    def ship(self):
-        """Ships current group to target location via rsync."""
-        cmd = self.get_rsync_cmd()
-        subprocess.call(cmd, shell=True)
+    raise click.ClickException(ERR_SHIP_FAILED.format(
+        ' '.join(cmd), returncode, retries + 1))
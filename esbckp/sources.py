@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""Drivers for the sources of database backups.
+
+A db string ``<type>:<spec>`` selects the driver registered for ``type``,
+which parses ``spec`` and dumps the item as a stream. Dumps are streamed
+through the group's compression, encryption and checksum, see
+``dumps.dump_source``, only postgres writes its own compressed format.
+
+Drivers of other packages are registered as entry points in the
+``esbckp.sources`` group, e.g. ``etcd = mypackage.sources:EtcdSource``.
+Entry points are only looked up for types that are not built in, which
+keeps runs without them from importing ``pkg_resources``.
+"""
+from __future__ import absolute_import, unicode_literals
+import click
+import os
+import subprocess
+import tempfile
+from .constants import *
+from .dumps import get_pg_dump_cmd
+
+ENTRY_POINT_GROUP = 'esbckp.sources'
+
+# Bytes of dump output read or buffered at once.
+READ_SIZE = 1024 * 1024
+
+
+class Source(object):
+    """Base of source drivers.
+
+    ``extension``
+        Extension of the uncompressed dump, the group's compression adds
+        its own, e.g. ``.sql.gz``.
+
+    ``compressed``
+        True if the dump is compressed by the tool already and is written
+        as it is.
+
+    ``max_jobs``
+        Number of dumps of this type that may run at once in ``start
+        --jobs``, 0 means no limit besides --db-jobs.
+
+    ``tool``
+        Name of the dump tool recorded as codec in the catalog.
+
+    ``example``
+        Example of a db string shown for invalid ones.
+
+    """
+    extension = '.out'
+    compressed = False
+    max_jobs = 0
+    tool = None
+    example = None
+
+    def parse(self, spec):
+        """Returns the settings of an item from the part of its db string
+        after the type.
+
+        The dict needs a ``name`` that is used in file names and may hold
+        a ``user`` and settings of the driver.
+
+        :raises: ValueError if ``spec`` is invalid, see ``example``.
+        """
+        raise NotImplementedError
+
+    def get_cmd(self, item):
+        """Returns the command writing the dump of ``item`` to stdout."""
+        raise NotImplementedError
+
+    def dump(self, item, out):
+        """Writes the dump of ``item`` to the file object ``out``.
+
+        stderr goes to a temporary file, so a chatty tool can't block
+        while its output is read.
+
+        :raises: ClickException if the dump fails.
+        """
+        cmd = self.get_cmd(item)
+        with tempfile.TemporaryFile() as err_file:
+            try:
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                        stderr=err_file)
+            except OSError, e:
+                raise click.ClickException(ERR_DUMP_FAILED.format(
+                    item.db_name, '{}: {}'.format(cmd[0], e.strerror)))
+            try:
+                for block in iter(lambda: proc.stdout.read(READ_SIZE), b''):
+                    out.write(block)
+            finally:
+                # Stops the tool if writing failed.
+                proc.stdout.close()
+                proc.wait()
+            if proc.returncode != 0:
+                err_file.seek(0)
+                raise click.ClickException(ERR_DUMP_FAILED.format(
+                    item.db_name, err_file.read().strip() or proc.returncode))
+
+
+class PostgresSource(Source):
+    """``postgres:<name>:<user>``, dumped with ``pg_dump -Fc``.
+
+    Directory format dumps are written by pg_dump itself, see
+    ``dumps.dump_postgres``.
+    """
+    extension = '.dump'
+    compressed = True
+    tool = 'pg_dump'
+    example = 'postgres:my_database:my_user'
+
+    def parse(self, spec):
+        return parse_name_and_user(spec)
+
+    def get_cmd(self, item):
+        return get_pg_dump_cmd(item)
+
+
+class MysqlSource(Source):
+    """``mysql:<name>:<user>`` or ``mariadb:<name>:<user>``, dumped with
+    ``mysqldump --single-transaction``, which reads InnoDB tables in one
+    consistent snapshot without locking them. Passwords are read from
+    ``~/.my.cnf``.
+    """
+    extension = '.sql'
+    tool = 'mysqldump'
+    example = 'mysql:my_database:my_user'
+
+    def parse(self, spec):
+        return parse_name_and_user(spec)
+
+    def get_cmd(self, item):
+        return ['mysqldump', '--single-transaction', '--quick', '--routines',
+                '--events', '-u', item.db_user, item.db_name]
+
+
+class SqliteSource(Source):
+    """``sqlite:<path>``, dumped as SQL in process.
+
+    The dump is read in one transaction, so it is consistent while other
+    processes write to the database. Only one sqlite dump runs at a time,
+    since it competes for the interpreter with the other jobs.
+    """
+    extension = '.sql'
+    max_jobs = 1
+    tool = 'sqlite'
+    example = 'sqlite:~/app.db'
+
+    def parse(self, spec):
+        if not spec:
+            raise ValueError(spec)
+        name = os.path.splitext(os.path.basename(spec))[0]
+        return {'name': name, 'path': spec}
+
+    def dump(self, item, out):
+        import sqlite3
+
+        path = os.path.expanduser(item.params['path'])
+        if not os.path.isfile(path):
+            raise click.ClickException(ERR_DUMP_FAILED.format(
+                item.db_name, '{} does not exist'.format(path)))
+
+        conn = sqlite3.connect(path, timeout=60)
+        try:
+            conn.execute('BEGIN')
+            lines, size = list(), 0
+            for line in conn.iterdump():
+                lines.append(line)
+                size += len(line)
+                if size >= READ_SIZE:
+                    out.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                    lines, size = list(), 0
+            if lines:
+                out.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        except sqlite3.Error, e:
+            raise click.ClickException(ERR_DUMP_FAILED.format(
+                item.db_name, e))
+        finally:
+            conn.close()
+
+
+class RedisSource(Source):
+    """``redis:<host>[:<port>]``, an RDB snapshot streamed by ``redis-cli
+    --rdb -``, which needs redis-cli 6.2 or later. The password is read
+    from ``REDISCLI_AUTH``.
+    """
+    extension = '.rdb'
+    max_jobs = 1
+    tool = 'redis-cli'
+    example = 'redis:localhost:6379'
+
+    def parse(self, spec):
+        host, _, port = spec.partition(':')
+        port = port or '6379'
+        if not host or not port.isdigit():
+            raise ValueError(spec)
+        return {'name': '{}-{}'.format(host, port), 'host': host,
+                'port': port}
+
+    def get_cmd(self, item):
+        return ['redis-cli', '-h', item.params['host'],
+                '-p', item.params['port'], '--rdb', '-']
+
+
+class CommandSource(Source):
+    """``command:<name>:<command>``, the output of a shell command, e.g.
+    ``command:ldap:slapcat -n 1``. Commands can't contain commas, which
+    separate db strings. Only one runs at a time, since nothing is known
+    about what it competes for.
+    """
+    max_jobs = 1
+    tool = 'command'
+    example = 'command:ldap:slapcat -n 1'
+
+    def parse(self, spec):
+        name, _, command = spec.partition(':')
+        if not command.strip():
+            raise ValueError(spec)
+        return {'name': name, 'command': command}
+
+    def get_cmd(self, item):
+        return ['sh', '-c', item.params['command']]
+
+
+SOURCES = {
+    'postgres': PostgresSource,
+    'mysql': MysqlSource,
+    'mariadb': MysqlSource,
+    'sqlite': SqliteSource,
+    'redis': RedisSource,
+    'command': CommandSource,
+}
+
+
+def get_source(db_type):
+    """Returns the driver registered for ``db_type``.
+
+    :raises: ValueError if no driver is registered for it.
+    """
+    source = SOURCES.get(db_type)
+    if source is None:
+        import pkg_resources
+        for entry_point in pkg_resources.iter_entry_points(
+                ENTRY_POINT_GROUP, db_type):
+            source = SOURCES[db_type] = entry_point.load()
+            break
+    if source is None:
+        raise ValueError(ERR_UNKNOWN_SOURCE.format(db_type))
+    return source()
+
+
+def parse_name_and_user(spec):
+    tokens = spec.split(':')
+    if len(tokens) != 2 or not all(tokens):
+        raise ValueError(spec)
+    return {'name': tokens[0], 'user': tokens[1]}
+
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import click
+import gzip
+import os
+import subprocess
+import tarfile
+import threading
+from contextlib import contextmanager
+from .chunkstore import ChunkReader, read_manifest
+from .constants import *
+from .encryption import ENCRYPTED_EXTENSION, open_decrypted
+
+# Extension -> external decompressor for codecs Python can't read itself.
+DECOMPRESSORS = {
+    '.zst': ['zstd', '-q', '-d', '-c'],
+    '.lz4': ['lz4', '-q', '-d', '-c'],
+}
+
+# Bytes read from a backup or decompressor at once.
+READ_SIZE = 1024 * 1024
+
+
+@contextmanager
+def open_backup_stream(group, path, fileobj=None):
+    """Yields a ``TarFile`` reading the backup or volume at ``path`` as a
+    stream.
+
+    Archives are read through ``open_decompressed``, manifests through
+    the chunk store.
+
+    :param fileobj: Optional file object to read ``path`` from, e.g. to
+        hash it while it is read. Manifests are always read from ``path``.
+    :raises: ClickException if the decompressor fails.
+    """
+    encrypted = path.endswith(ENCRYPTED_EXTENSION)
+    name = path[:-len(ENCRYPTED_EXTENSION)] if encrypted else path
+
+    if name.endswith('.dump'):
+        raise click.ClickException(
+            (ERR_RESTORE_ENCRYPTED_DUMP if encrypted else
+             ERR_RESTORE_DUMP).format(path))
+
+    if name.endswith('.manifest'):
+        reader = ChunkReader(group.chunk_store, read_manifest(path))
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            yield tar
+        return
+
+    with open_decompressed(group, path, fileobj) as stream:
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            yield tar
+
+
+@contextmanager
+def open_decompressed(group, path, fileobj=None):
+    """Yields a file object reading the content of the archive, volume or
+    streamed dump at ``path``.
+
+    Encrypted files are decrypted with the group's key on the way to the
+    decompressor, which is picked by the extension. gzip streams may
+    consist of several members, see ``compression.ParallelGzipWriter``.
+    Once the block is left without an error the rest of the stream is
+    decompressed too, so a damaged end of a file fails like a damaged
+    member.
+
+    :param fileobj: Optional file object to read ``path`` from.
+    :raises: ClickException if the decompressor fails.
+    """
+    encrypted = path.endswith(ENCRYPTED_EXTENSION)
+    name = path[:-len(ENCRYPTED_EXTENSION)] if encrypted else path
+    ext = os.path.splitext(name)[1]
+
+    source = fileobj or open(path, 'rb')
+    if encrypted:
+        source = open_decrypted(path, group.encryption_key, source)
+
+    try:
+        if ext in DECOMPRESSORS:
+            with _decompressed(DECOMPRESSORS[ext], source) as stream:
+                yield stream
+                drain(stream)
+        elif ext == '.gz':
+            stream = gzip.GzipFile(fileobj=source, mode='rb')
+            yield stream
+            drain(stream)
+        else:
+            yield source
+            drain(source)
+    finally:
+        if fileobj is None:
+            source.close()
+
+
+def drain(fileobj):
+    """Reads ``fileobj`` to its end."""
+    while fileobj.read(READ_SIZE):
+        pass
+
+
+@contextmanager
+def _decompressed(cmd, fileobj):
+    """Yields the output of ``cmd`` decompressing ``fileobj``.
+
+    :raises: ClickException if ``cmd`` fails after the output was read.
+    """
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    errors = list()
+    feeder = threading.Thread(target=feed, args=(fileobj, proc.stdin,
+                                                  errors))
+    feeder.start()
+    try:
+        yield proc.stdout
+    finally:
+        proc.stdout.close()
+        feeder.join()
+        returncode = proc.wait()
+        if errors:
+            raise errors[0]
+
+    if returncode != 0:
+        raise click.ClickException(
+            ERR_DECOMPRESSOR_FAILED.format(' '.join(cmd), returncode))
+
+
+def feed(fileobj, stdin, errors):
+    """Copies ``fileobj`` to the process reading ``stdin``.
+
+    Decryption errors are appended to ``errors``, broken pipes are left to
+    the reader of the process.
+    """
+    try:
+        for block in iter(lambda: fileobj.read(READ_SIZE), b''):
+            stdin.write(block)
+    except click.ClickException, e:
+        errors.append(e)
+    except IOError:
+        pass
+    finally:
+        try:
+            stdin.close()
+        except IOError:
+            pass
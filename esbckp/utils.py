@@ -1,116 +1,397 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 import click
-import esbckp
 import os
-import subprocess
 import tarfile
+import time
+from .archiver import add_tree
+from .checksums import checksums_digest, read_checksums, write_checksums
+from .constants import *
+from .dumps import (dump_postgres, dump_source, path_size, remove_path,
+                    make_read_only, link_path)
+from .encryption import ENCRYPTED_EXTENSION, CODEC_SUFFIX
+from .incremental import (FileIndex, ChangeDetector, FingerprintStore,
+                          tree_fingerprint)
+from .metrics import Timings, measure
+from .names import parse_backup_name
+from .progress import Progress, worker_counter
+from .seekindex import IndexedTar, SEEKABLE_CODECS, sidecar_path, write_index
+from .verify import verify_backup
+from .volumes import (VolumeTar, VOLUMES_EXTENSION, PARTIAL_SUFFIX,
+                      partial_path, strip_partial, read_checkpoint,
+                      resume_point, volume_checksums)
 
 
-def do_file_backups_for_group(group):
-    """Creates tar.gz compressed backups for all backup target directories.
+def do_file_backups_for_group(group, resume=False, on_done=None):
+    """Creates compressed tar backups for all backup target directories.
 
     :param group: Instance of ``BackupGroup``
     :type group: BackupGroup
+    :param resume: Continue interrupted backups, see ``do_file_backup``.
+    :param on_done: Optional callable invoked with the group after each
+        written backup, e.g. ``ShipQueue.notify``.
     """
     group.check_or_create_base_path()
 
     for item in group.dirs:
-        backup_source = os.path.expanduser(item.dir)
+        if do_file_backup(group, item, resume=resume) and on_done:
+            on_done(group)
 
-        if not os.path.exists(backup_source):
-            continue
 
-        # TODO(sthzg) Find better solution than using globals.
-        globals()['current_file_number'] = 0
-        globals()['total_num_files'] = len(
-            [os.path.join(dp, f)
-             for dp, dn, fn in os.walk(backup_source) for f in fn])
+def do_file_backup(group, item, progress=True, resume=False):
+    """Creates a compressed tar backup of one backup target directory.
 
-        postfix = backup_source.replace(os.sep, '#')
-        fname = "{}__{}.tar.gz".format(group.filename_prefix, postfix)
-        target_path = "{}/{}".format(group.base_path, fname)
+    The codec and therefore the file extension are taken from the group's
+    ``Compression`` settings. In incremental mode only files that changed
+    since the last run are archived, see ``incremental.FileIndex``.
 
-        with tarfile.open(target_path, "w:gz") as tar:
-            tar.add(backup_source, filter=tar_add_filter)
-            click.echo('\r', nl=False)
-            msg = 'Wrote {}'.format(target_path)
-            click.echo(click.style(msg, fg='green'))
+    Unless the group's ``unchanged`` option is ``backup``, a fingerprint of
+    the tree is compared with the one of the last backup first, and
+    unchanged items are skipped or linked, see ``reuse_unchanged_backup``.
 
-        subprocess.call(['chmod', '0400', target_path])
+    Backups are written to a hidden ``.<name>.partial`` path and only
+    renamed to their final name once they are complete, so the shipper and
+    cleaner never see them before. With ``volume_size`` the archive is
+    split into volumes, see ``volumes.VolumeTar``. An interrupted split
+    backup keeps its finished volumes and continues after the last of them
+    if ``resume`` is set, otherwise partial backups of the item are removed.
 
+    :param group: Instance of ``BackupGroup``
+    :param item: Instance of ``FileBackupItem``
+    :param progress: Flag that indicates whether to output a progress line.
+        It is only shown if stdout is a terminal, see ``Progress``. Without
+        it, pool workers count into the line of ``start_parallel``.
+    :param resume: Continue the last interrupted split backup of the item.
+    :return: Path of the written or linked backup or None if the source is
+        missing or the item was skipped.
+    """
+    backup_source = os.path.expanduser(item.dir)
+
+    if not os.path.exists(backup_source):
+        return None
+
+    postfix = backup_source.replace(os.sep, '#')
+    detector = None
+    file_index = None
+    full = True
+
+    resume_path = None
+    for path in find_partials(group.base_path, postfix):
+        if resume and group.uses_volumes and path.endswith(
+                VOLUMES_EXTENSION + PARTIAL_SUFFIX):
+            if resume_path:
+                remove_path(resume_path)
+            resume_path = path
+        else:
+            remove_path(path)
+
+    fingerprints = None
+    if group.unchanged != 'backup':
+        fingerprints = FingerprintStore(group.index_path, postfix)
+        fingerprint_start = time.time()
+        fingerprint = tree_fingerprint(backup_source,
+                                       group.make_path_filter())
+        fingerprint_seconds = time.time() - fingerprint_start
+
+        last = fingerprints.read()
+        if last and last['digest'] == fingerprint['digest'] and \
+                not resume_path and \
+                os.path.exists(os.path.join(group.base_path, last['name'])):
+            return reuse_unchanged_backup(group, item, fingerprints,
+                                          fingerprint, last['name'],
+                                          fingerprint_seconds)
+
+    if group.mode == 'incremental':
+        file_index = FileIndex(group.index_path, postfix)
+        full = file_index.needs_full(group.full_every)
+        detector = ChangeDetector(file_index, full=full)
+
+    if resume_path:
+        fname = strip_partial(os.path.basename(resume_path))
+    elif full:
+        fname = "{}__{}{}".format(group.filename_prefix, postfix,
+                                  group.extension)
+    else:
+        chain = file_index.read_chain()
+        fname = "{}__{}.incr-{}{}".format(group.filename_prefix, postfix,
+                                          chain['base'], group.extension)
+
+    target_path = "{}/{}".format(group.base_path, fname)
+    write_path = resume_path or partial_path(target_path)
+
+    checkpoint = read_checkpoint(write_path) if resume_path else None
+    start_after = resume_point(checkpoint, backup_source,
+                               group.encryption_key)
+    done_files = sum(v['files'] for v in checkpoint['volumes']) \
+        if checkpoint else 0
+    done_bytes = sum(v['bytes'] for v in checkpoint['volumes']) \
+        if checkpoint else 0
+
+    on_add = None
+    if progress:
+        total_files, total_bytes = group.get_totals(postfix) if full else \
+            (None, None)
+        on_add = Progress(item.dir, total_files, total_bytes)
+    else:
+        on_add = worker_counter()
+    if on_add:
+        on_add.files, on_add.bytes = done_files, done_bytes
+
+    meta = {'source': backup_source}
+    result = dict()
+    timings = Timings()
+    start = time.time()
+    if fingerprints:
+        timings.add('fingerprint', fingerprint_seconds)
+
+    with measure(group.metrics, 'file', group.group_title, item.dir) as m:
+        try:
+            if group.uses_volumes:
+                num_files, num_bytes = write_volumes(
+                    group, backup_source, write_path, checkpoint, on_add,
+                    meta, timings, start_after)
+            else:
+                with group.open_backup(write_path, meta, result,
+                                       timings) as stream:
+                    with tarfile.open(fileobj=stream, mode="w|") as tar:
+                        tar = IndexedTar(tar)
+                        num_files, num_bytes = add_tree(
+                            tar, backup_source, on_add, select=detector,
+                            timings=timings,
+                            path_filter=group.make_path_filter())
+                        if detector:
+                            detector.finish(tar)
+        except BaseException:
+            if detector:
+                detector.abort()
+            if not group.uses_volumes:
+                remove_path(write_path)
+            raise
+        finally:
+            if on_add:
+                on_add.finish()
+
+        os.rename(write_path, target_path)
+        if result.get('codec') in SEEKABLE_CODECS:
+            write_index(target_path, result['codec'], tar.members,
+                        result['seek_points'], group.encryption_key)
+
+        if group.uses_volumes:
+            checksums = volume_checksums(target_path)
+            result['sha256'] = checksums_digest(checksums)
+        else:
+            checksums = [(fname, result['sha256'])]
+        write_checksums(target_path, checksums)
+
+        num_files += done_files
+        num_bytes += done_bytes
+        m['bytes_in'] = num_bytes
+        m['bytes_out'] = path_size(target_path)
+        m['stages'] = timings.stages()
+
+    if full:
+        group.set_file_count(postfix, num_files, num_bytes)
+
+    if detector and full:
+        file_index.commit(detector, group.filename_prefix, 0)
+    elif detector:
+        file_index.commit(detector, chain['base'], chain['count'] + 1)
+
+    if fingerprints:
+        fingerprints.write(fingerprint, fname)
+
+    if group.catalog:
+        group.catalog.add_backup(group.group_title, item.dir, target_path,
+                                 result.get('sha256'), group.archive_codec,
+                                 time.time() - start)
+
+    msg = 'Wrote {}'.format(target_path)
+    click.echo(click.style(msg, fg='green'))
+
+    make_read_only(target_path)
+
+    if group.verify:
+        verify_backup(group, target_path, result['sha256'])
+    return target_path
 
-def do_database_backups_for_group(group):
+
+def write_volumes(group, backup_source, path, checkpoint=None, on_add=None,
+                  meta=None, timings=None, start_after=None):
+    """Archives ``backup_source`` into volumes in the directory ``path``.
+
+    Finished volumes are kept if archiving fails, so the backup can be
+    continued after ``start_after``, the last member of ``checkpoint``.
+
+    :return: Tuple of number of files and bytes added by this call.
+    """
+    if not os.path.exists(path):
+        os.mkdir(path)
+
+    tar = VolumeTar(group, path, group.volume_size, meta, timings, checkpoint)
+    try:
+        num_files, num_bytes = add_tree(
+            tar, backup_source, on_add, timings=timings,
+            path_filter=group.make_path_filter(), start_after=start_after)
+        tar.close()
+    except BaseException:
+        tar.abort()
+        if tar.volumes:
+            msg = 'Kept {} finished volume(s) in {}, use start --resume to ' \
+                  'continue.'.format(len(tar.volumes), path)
+            click.echo(click.style(msg, fg='yellow'), err=True)
+        raise
+
+    return num_files, num_bytes
+
+
+def reuse_unchanged_backup(group, item, fingerprints, fingerprint, last_name,
+                           fingerprint_seconds=0.0):
+    """Skips or links the backup of an item whose tree did not change.
+
+    With ``unchanged: link`` the last backup is hard linked under the
+    current prefix, so retention and shipping see a backup of this run
+    without archiving anything. Incremental groups always skip, since a
+    linked backup would not fit into the chain.
+
+    :param last_name: File name of the last backup of the item.
+    :return: Path of the linked backup or None if skipped.
+    """
+    last_path = os.path.join(group.base_path, last_name)
+
+    with measure(group.metrics, 'file', group.group_title, item.dir) as m:
+        m['stages'] = {'fingerprint': fingerprint_seconds}
+        m['bytes_out'] = 0
+
+        if group.unchanged != 'link' or group.mode != 'full':
+            msg = 'Skipped {}, unchanged since {}'.format(item.dir, last_name)
+            click.echo(click.style(msg, fg='blue'))
+            return None
+
+        target_path = os.path.join(group.base_path, '{}__{}'.format(
+            group.filename_prefix, last_name.split('__', 1)[1]))
+        if target_path != last_path:
+            link_path(last_path, target_path)
+            if os.path.exists(sidecar_path(last_path)):
+                link_path(sidecar_path(last_path), sidecar_path(target_path))
+            checksums = read_checksums(last_path)
+            if checksums:
+                write_checksums(target_path, [
+                    (os.path.basename(target_path) + n[len(last_name):], d)
+                    for n, d in checksums])
+
+    fingerprints.write(fingerprint, os.path.basename(target_path))
+
+    if group.catalog:
+        last = group.catalog.find(group.group_title, last_name) or {}
+        group.catalog.add_backup(group.group_title, item.dir, target_path,
+                                 last.get('sha256'), last.get('codec'), 0.0)
+
+    msg = 'Linked {} to unchanged {}'.format(target_path, last_name)
+    click.echo(click.style(msg, fg='green'))
+    return target_path
+
+
+def do_database_backups_for_group(group, on_done=None):
     """Creates compressed backups for all backup target databases.
 
+    A failing dump does not stop the remaining dumps of the group.
+
     :param group: Instance of ``BackupGroup``
     :type group: BackupGroup
+    :param on_done: Optional callable invoked with the group after each
+        written dump.
+    :return: Number of failed dumps.
     """
     group.check_or_create_base_path()
     dbs = group.dbs
+    failed = 0
 
     label = "Dumping DBs in group {}".format(group.group_title)
     with click.progressbar(dbs, label=click.style(label, fg='yellow')) as dbs:
         for item in dbs:
-            if item.db_type == 'postgres':
-                target_path = '{}/{}__{}_{}.dump'.format(
-                    group.base_path,
-                    group.filename_prefix,
-                    item.db_type.lower(),
-                    item.db_name.lower())
+            try:
+                path = do_database_backup(group, item)
+            except click.ClickException, e:
+                click.echo(click.style(e.message, fg='red'), err=True)
+                failed += 1
+                continue
+            if path and on_done:
+                on_done(group)
 
-                cmd = 'pg_dump -Fc -U {} {} > {}'.format(
-                    item.db_user,
-                    item.db_name,
-                    target_path)
+    return failed
 
-                subprocess.call(cmd, shell=True)
-                subprocess.call(['chmod', '0400', target_path])
 
+def do_database_backup(group, item):
+    """Creates a compressed backup of one backup target database.
 
-def extract_dirs(val):
-    """Returns a list of paths extracted from the config ``dir`` value."""
-    items = list()
-    for d in [x.strip() for x in val.split(',')]:
-        item = esbckp.FileBackupItem()
-        item.dir = d
-        items.append(item)
+    Postgres dumps are compressed by pg_dump, dumps of other sources are
+    streamed through the group's compression, see ``dumps.dump_source``.
 
-    return items
+    :param group: Instance of ``BackupGroup``
+    :param item: Instance of ``DatabaseBackupItem``
+    :return: Path of the written dump.
+    :raises: ClickException if the dump fails.
+    """
+    source = item.source
+    compression = None if source.compressed else group.compression
+    target_path = '{}/{}__{}_{}{}{}{}'.format(
+        group.base_path,
+        group.filename_prefix,
+        item.db_type.lower(),
+        item.db_name.lower(),
+        source.extension,
+        compression.stream_extension if compression else '',
+        ENCRYPTED_EXTENSION if group.encryption_key else '')
 
+    if item.db_type == 'postgres':
+        codec = 'pg_dump-{}'.format(group.db_format)
+    elif compression:
+        codec = '{}-{}'.format(source.tool, compression.codec)
+    else:
+        codec = source.tool
 
-def extract_databases(val):
-    """Returns a list of db connection strings."""
-    items = list()
-    for db in [x.strip() for x in val.split(',')]:
-        # Skip when no DBs are configured in group (i.e. db is an empty string)
-        if not db:
-            continue
+    with measure(group.metrics, 'dump', group.group_title,
+                 '{}/{}'.format(item.db_type, item.db_name)) as m:
+        if item.db_type == 'postgres':
+            size, duration, sha256 = dump_postgres(
+                item, target_path, group.db_format, group.db_jobs,
+                group.encryption_key)
+        else:
+            size, duration, sha256 = dump_source(
+                source, item, target_path, compression, group.encryption_key)
+        m['bytes_out'] = size
+        m['stages'] = {'dump': duration}
 
-        try:
-            items.append(esbckp.DatabaseBackupItem(db))
-        except ValueError, e:
-            click.echo(click.style(e.message, fg='blue'))
+    if sha256:
+        write_checksums(target_path, [(os.path.basename(target_path), sha256)])
 
-    return items
+    if group.catalog:
+        group.catalog.add_backup(
+            group.group_title, '{}/{}'.format(item.db_type, item.db_name),
+            target_path, sha256,
+            codec + (CODEC_SUFFIX if group.encryption_key else ''), duration)
 
+    msg = 'Wrote {} ({:.1f} MB in {:.1f}s)'.format(
+        target_path, size / 1024.0 / 1024.0, duration)
+    click.echo(click.style(msg, fg='green'))
 
-def tar_add_filter(tarinfo):
-    """Outputs a file progress counter while compressing file backups."""
-    msg = '\r{}/{} files packed.'.format(globals()['current_file_number'],
-                                         globals()['total_num_files'])
-    click.echo(click.style(msg, fg='yellow'), nl=False)
-    if tarinfo.isfile():
-        globals()['current_file_number'] += 1
+    if group.verify:
+        verify_backup(group, target_path, sha256)
+    return target_path
 
-    return tarinfo
 
+def find_partials(base_path, postfix):
+    """Returns the paths of partial backups of the item ``postfix``, oldest
+    first.
+    """
+    paths = list()
+    for fname in sorted(os.listdir(base_path)):
+        name = parse_backup_name(strip_partial(fname) or '')
+        if name and name['postfix'] == postfix:
+            paths.append(os.path.join(base_path, fname))
+    return paths
 
-def monthdelta(date, delta):
-    """Provides ability to add/subtract months from dates."""
-    m, y = (date.month+delta) % 12, date.year + ((date.month)+delta-1) // 12
-    if not m: m = 12
-    d = min(date.day, [31,
-        29 if y%4==0 and not y%400==0 else 28,31,30,31,30,31,31,30,31,30,31][m-1])
 
-    return date.replace(day=d,month=m, year=y)
+def storage_device(path):
+    """Returns the id of the device ``path`` lives on."""
+    return os.stat(os.path.expanduser(path)).st_dev
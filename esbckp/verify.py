@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import click
+import os
+import subprocess
+import tarfile
+import threading
+import zlib
+from .checksums import (HashingReader, checksum_path, checksums_digest,
+                        read_checksums)
+from .constants import *
+from .encryption import ENCRYPTED_EXTENSION, open_decrypted
+from .metrics import measure
+from .names import parse_backup_name
+from .streams import feed, open_backup_stream, open_decompressed
+from .volumes import VOLUMES_FILE, volume_checksums
+
+# Errors of a damaged archive besides the ClickExceptions of decryption
+# and decompressors.
+DAMAGE_ERRORS = (tarfile.TarError, IOError, EOFError, zlib.error)
+
+
+def backup_files(path, sha256=None):
+    """Returns the files of the backup at ``path`` with their expected
+    digests.
+
+    :param sha256: Digest recorded in the catalog, see
+        ``checksums_digest`` for backups of several files.
+    :return: List of path and digest tuples, the digest is None if it is
+        not known, as for directory format dumps.
+    :raises: ClickException if the checksum file does not match ``sha256``.
+    """
+    if not os.path.isdir(path):
+        checksums = read_checksums(path)
+        return [(path, sha256 or (checksums[0][1] if checksums else None))]
+
+    checksums = read_checksums(path)
+    if checksums is None and os.path.exists(
+            os.path.join(path, VOLUMES_FILE)):
+        checksums = volume_checksums(path)
+    if checksums is None:
+        return [(path, None)]
+
+    if sha256 and checksums_digest(checksums) != sha256:
+        raise click.ClickException(ERR_CHECKSUMS_MODIFIED.format(
+            checksum_path(path)))
+    group_dir = os.path.dirname(path)
+    return [(os.path.join(group_dir, name), digest)
+            for name, digest in checksums]
+
+
+def verify_backup(group, path, sha256=None):
+    """Verifies all files of the backup at ``path``, see ``verify_file``."""
+    for file_path, digest in backup_files(path, sha256):
+        verify_file(group, file_path, digest)
+
+
+def verify_file(group, path, sha256=None):
+    """Reads a file of a backup once and checks that it can be restored.
+
+    Archives and volumes are decrypted, decompressed and walked member by
+    member, which checks the gzip CRCs, zstd and lz4 checksums and the
+    authentication tags of encrypted files. Postgres dumps are listed with
+    ``pg_restore --list``, dumps of other sources are decompressed. The
+    file is hashed on the way and compared with ``sha256``.
+
+    :raises: ClickException if the file is damaged or does not match.
+    """
+    with measure(group.metrics, 'verify', group.group_title,
+                 os.path.basename(path)) as m:
+        if os.path.isdir(path):
+            list_dump(group, path)
+            return
+
+        with open(path, 'rb') as f:
+            reader = HashingReader(f)
+            try:
+                if is_dump(path):
+                    list_dump(group, path, reader)
+                elif is_stream_dump(path):
+                    with open_decompressed(group, path, reader):
+                        pass
+                else:
+                    with open_backup_stream(group, path, reader) as tar:
+                        for _ in tar:
+                            pass
+            except DAMAGE_ERRORS, e:
+                raise click.ClickException(
+                    ERR_BACKUP_DAMAGED.format(path, e))
+            digest = reader.hexdigest()
+            m['bytes_in'] = reader.size
+
+    if sha256 and digest != sha256:
+        raise click.ClickException(
+            ERR_CHECKSUM_MISMATCH.format(path, digest, sha256))
+
+
+def is_dump(path):
+    if path.endswith(ENCRYPTED_EXTENSION):
+        path = path[:-len(ENCRYPTED_EXTENSION)]
+    return path.endswith('.dump')
+
+
+def is_stream_dump(path):
+    """True for dumps of sources other than postgres, see ``sources``."""
+    parsed = parse_backup_name(os.path.basename(path))
+    return bool(parsed) and not parsed['ext'].startswith(
+        ('.tar', '.dump', '.manifest', '.volumes'))
+
+
+def list_dump(group, path, fileobj=None):
+    """Lists the dump at ``path`` with ``pg_restore --list``.
+
+    File dumps are fed to pg_restore from ``fileobj``, decrypted if
+    needed, directory format dumps are read by pg_restore itself.
+
+    :raises: ClickException if pg_restore can't read the dump.
+    """
+    if fileobj is None and not os.path.isdir(path):
+        with open(path, 'rb') as f:
+            return list_dump(group, path, f)
+
+    with open(os.devnull, 'wb') as devnull:
+        if os.path.isdir(path):
+            proc = subprocess.Popen(['pg_restore', '--list', path],
+                                    stdout=devnull, stderr=subprocess.PIPE)
+            _, err = proc.communicate()
+        else:
+            if path.endswith(ENCRYPTED_EXTENSION):
+                fileobj = open_decrypted(path, group.encryption_key, fileobj)
+            proc = subprocess.Popen(['pg_restore', '--list'],
+                                    stdin=subprocess.PIPE, stdout=devnull,
+                                    stderr=subprocess.PIPE)
+            errors = list()
+            feeder = threading.Thread(target=feed, args=(
+                fileobj, proc.stdin, errors))
+            feeder.start()
+            err = proc.stderr.read()
+            feeder.join()
+            proc.wait()
+            if errors:
+                raise errors[0]
+
+    if proc.returncode != 0:
+        raise click.ClickException(ERR_DUMP_UNREADABLE.format(
+            path, err.strip() or proc.returncode))
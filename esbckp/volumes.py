@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import json
+import os
+import sys
+import tarfile
+from .archiver import walk_key
+from .dumps import remove_path
+from .seekindex import (IndexedTar, SEEKABLE_CODECS, sidecar_path,
+                        write_index)
+
+VOLUMES_EXTENSION = '.volumes'
+VOLUMES_FILE = 'volumes.json'
+PARTIAL_SUFFIX = '.partial'
+
+# Marks volumes whose first and last member paths are encrypted.
+PATHS_CIPHER = 'aes-gcm'
+
+FS_ENCODING = sys.getfilesystemencoding() or 'utf-8'
+
+# Bytes of tar stream written between two checks of the volume size.
+CHECK_INTERVAL = 1024 * 1024
+
+
+class VolumeTar(object):
+    """Writes a tar stream as a series of independent volumes.
+
+    Stands in for the ``TarFile`` passed to ``archiver.add_tree``. Once the
+    current volume reached ``volume_size`` bytes on disk the next member
+    starts a new volume, so members never span volumes and every volume is
+    a complete compressed tar file named ``vol-00000<ext>``, ...
+
+    Each closed volume is synced to disk, gets an index of its members, see
+    ``seekindex``, and is recorded in the ``volumes.json`` checkpoint
+    together with the paths of its first and last member, encrypted if the
+    group is, see ``member_bounds``. An interrupted
+    backup can continue after the last path, see ``read_checkpoint``. As
+    members are added in walk order, the paths also tell which volumes hold
+    a file or directory, see ``find_volumes``.
+
+    :param group: Instance of ``BackupGroup`` that opens the volumes.
+    :param path: Directory the volumes are written to.
+    :param checkpoint: Checkpoint of an interrupted run to continue.
+    """
+    def __init__(self, group, path, volume_size, meta=None, timings=None,
+                 checkpoint=None):
+        self.group = group
+        self.path = path
+        self.volume_size = volume_size
+        self.meta = meta
+        self.timings = timings
+        self.checkpoint = checkpoint or {'volumes': [], 'complete': False}
+        self._tar = None
+        self._context = None
+        self._result = None
+        self._volume_path = None
+        self._checked_offset = 0
+        self._next_path = None
+        self._first_path = None
+        self._last_path = None
+        self._files = 0
+        self._bytes = 0
+
+    @property
+    def volumes(self):
+        return self.checkpoint['volumes']
+
+    def gettarinfo(self, name):
+        if self._tar is None:
+            self._open_volume()
+        self._next_path = name
+        return self._tar.gettarinfo(name)
+
+    def addfile(self, tarinfo, fileobj=None):
+        interval = min(CHECK_INTERVAL, self.volume_size)
+        if self._tar.tar.offset - self._checked_offset >= interval:
+            self._checked_offset = self._tar.tar.offset
+            if os.path.getsize(self._volume_path) >= self.volume_size:
+                self._close_volume()
+                self._open_volume()
+
+        self._tar.addfile(tarinfo, fileobj)
+        if self._first_path is None:
+            self._first_path = self._next_path
+        self._last_path = self._next_path
+        if tarinfo.isreg():
+            self._files += 1
+            self._bytes += tarinfo.size
+
+    def close(self):
+        """Closes the last volume and marks the checkpoint complete."""
+        if self._tar is not None:
+            self._close_volume()
+        self.checkpoint['complete'] = True
+        write_checkpoint(self.path, self.checkpoint)
+
+    def abort(self):
+        """Discards the current volume, recorded volumes are kept."""
+        if self._tar is None:
+            return
+        try:
+            self._tar.tar.__exit__(*sys.exc_info())
+            self._context.__exit__(*sys.exc_info())
+        finally:
+            remove_path(self._volume_path)
+            self._tar = None
+
+    def _open_volume(self):
+        name = 'vol-{:05d}{}'.format(len(self.volumes),
+                                     self.group.archive_extension)
+        self._volume_path = os.path.join(self.path, name)
+        self._result = dict()
+        self._context = self.group.open_backup(
+            self._volume_path, self.meta, self._result, self.timings)
+        self._tar = IndexedTar(tarfile.open(
+            fileobj=self._context.__enter__(), mode='w|'))
+        self._checked_offset = 0
+        self._first_path = None
+        self._files = 0
+        self._bytes = 0
+
+    def _close_volume(self):
+        self._tar.tar.close()
+        self._context.__exit__(None, None, None)
+        members, self._tar = self._tar.members, None
+        fsync_path(self._volume_path)
+        if self._result['codec'] in SEEKABLE_CODECS:
+            write_index(self._volume_path, self._result['codec'], members,
+                        self._result['seek_points'],
+                        self.group.encryption_key)
+
+        volume = {
+            'name': os.path.basename(self._volume_path),
+            'sha256': self._result['sha256'],
+            'codec': self._result['codec'],
+            'files': self._files,
+            'bytes': self._bytes,
+            'first': self._first_path,
+            'last': self._last_path,
+        }
+        key = self.group.encryption_key
+        if key and self._first_path is not None:
+            from .encryption import encrypt_text
+            volume['first'] = encrypt_text(_text(self._first_path), key)
+            volume['last'] = encrypt_text(_text(self._last_path), key)
+            volume['paths'] = PATHS_CIPHER
+        self.volumes.append(volume)
+        write_checkpoint(self.path, self.checkpoint)
+
+
+def read_checkpoint(path):
+    """Returns the checkpoint of the volumes in ``path`` or None.
+
+    Volume files that are not recorded in the checkpoint were interrupted
+    and are removed, so writing can continue with the next volume.
+    """
+    try:
+        with open(os.path.join(path, VOLUMES_FILE)) as f:
+            checkpoint = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    recorded = set(v['name'] for v in checkpoint['volumes'])
+    recorded.update([os.path.basename(sidecar_path(n)) for n in recorded])
+    for name in os.listdir(path):
+        if name != VOLUMES_FILE and name not in recorded:
+            remove_path(os.path.join(path, name))
+
+    return checkpoint
+
+
+def write_checkpoint(path, checkpoint):
+    """Atomically replaces the checkpoint of the volumes in ``path``."""
+    tmp_path = os.path.join(path, VOLUMES_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, os.path.join(path, VOLUMES_FILE))
+
+
+def member_bounds(volume, key=None):
+    """Returns the paths of the first and last member of a volume of a
+    checkpoint, which are encrypted in encrypted groups.
+
+    :raises: ClickException if they are encrypted and ``key`` is missing or
+        wrong.
+    """
+    if volume.get('paths') != PATHS_CIPHER:
+        return volume.get('first'), volume.get('last')
+
+    from .encryption import decrypt_text
+    return (decrypt_text(volume['first'], key, VOLUMES_FILE),
+            decrypt_text(volume['last'], key, VOLUMES_FILE))
+
+
+def resume_point(checkpoint, like, key=None):
+    """Returns the path of the last archived member or None.
+
+    The path is converted to the string type of ``like``, the directory
+    being archived, so it compares to the paths of the walk.
+    """
+    volumes = checkpoint['volumes'] if checkpoint else None
+    if not volumes or volumes[-1]['last'] is None:
+        return None
+
+    last = member_bounds(volumes[-1], key)[1]
+    if isinstance(like, bytes) and not isinstance(last, bytes):
+        last = last.encode(FS_ENCODING)
+    return last
+
+
+def volume_paths(path):
+    """Returns the paths of the volumes of the backup at ``path`` in order."""
+    with open(os.path.join(path, VOLUMES_FILE)) as f:
+        checkpoint = json.load(f)
+    return [os.path.join(path, v['name']) for v in checkpoint['volumes']]
+
+
+def volume_checksums(path):
+    """Returns the paths relative to the group directory and digests of
+    the volumes of the split backup at ``path``.
+    """
+    with open(os.path.join(path, VOLUMES_FILE)) as f:
+        volumes = json.load(f)['volumes']
+    name = os.path.basename(path)
+    return [('{}/{}'.format(name, v['name']), v['sha256']) for v in volumes]
+
+
+def find_volumes(path, source, member, key=None):
+    """Returns the paths of the volumes that hold ``member`` or anything
+    below it.
+
+    A directory tree is archived in one piece of the walk order, so only
+    the volumes whose first or last member falls into it, or which span
+    it, are returned.
+
+    :param path: Path of a ``.volumes`` backup.
+    :param source: Backed up directory the backup was made from.
+    :param member: Path of a file or directory below ``source``.
+    :param key: Key of an encrypted group, see ``member_bounds``.
+    """
+    with open(os.path.join(path, VOLUMES_FILE)) as f:
+        checkpoint = json.load(f)
+
+    # Paths are read back from JSON as unicode.
+    source, member = _text(source), _text(member)
+    wanted = walk_key(source, member)
+    found = list()
+    for volume in checkpoint['volumes']:
+        if volume.get('first') is None:
+            found.append(volume)
+            continue
+        first, last = member_bounds(volume, key)
+        first, last = walk_key(source, first), walk_key(source, last)
+        if last < wanted:
+            continue
+        if first > wanted and first[:len(wanted)] != wanted:
+            break
+        found.append(volume)
+
+    return [os.path.join(path, v['name']) for v in found]
+
+
+def partial_path(target_path):
+    """Returns the hidden path a backup is written to before it is done."""
+    head, tail = os.path.split(target_path)
+    return os.path.join(head, '.{}{}'.format(tail, PARTIAL_SUFFIX))
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def strip_partial(name):
+    """Returns the final name of a partial backup or None."""
+    if name.startswith('.') and name.endswith(PARTIAL_SUFFIX):
+        return name[1:-len(PARTIAL_SUFFIX)]
+    return None
+
+
+def _text(path):
+    return path.decode(FS_ENCODING) if isinstance(path, bytes) else path
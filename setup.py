@@ -9,8 +9,20 @@ setup(
         'Click',
         'colorama',
     ],
+    extras_require={
+        'encryption': ['cryptography'],
+        'chunking': ['numpy'],
+    },
     entry_points='''
         [console_scripts]
         esbckp=esbckp.commands:cli
+
+        [esbckp.sources]
+        postgres=esbckp.sources:PostgresSource
+        mysql=esbckp.sources:MysqlSource
+        mariadb=esbckp.sources:MysqlSource
+        sqlite=esbckp.sources:SqliteSource
+        redis=esbckp.sources:RedisSource
+        command=esbckp.sources:CommandSource
     ''',
 )
\ No newline at end of file
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from esbckp.archiver import walk_tree, add_tree
+
+
+class TestArchiver(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        for d in ('a/b', 'c'):
+            os.makedirs(os.path.join(self.top, d))
+        for f in ('a/1.txt', 'a/b/2.txt', 'c/3.txt', '4.txt'):
+            with open(os.path.join(self.top, f), 'w') as fh:
+                fh.write(f)
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def test_walk_tree_yields_every_entry_once(self):
+        """The walk matches os.walk and is depth first in sorted order."""
+        walked = [os.path.relpath(p, self.top) for p, _ in walk_tree(self.top)]
+        expected = ['.', '4.txt', 'a', 'a/1.txt', 'a/b', 'a/b/2.txt', 'c',
+                    'c/3.txt']
+        self.assertEqual(expected, walked)
+
+    def test_walk_tree_start_after(self):
+        """A resumed walk yields exactly the entries after the given one."""
+        for start_after in ('a', 'a/1.txt', 'a/b/2.txt', 'c/3.txt'):
+            walked = [os.path.relpath(p, self.top) for p, _ in walk_tree(
+                self.top, start_after=os.path.join(self.top, start_after))]
+            expected = ['.', '4.txt', 'a', 'a/1.txt', 'a/b', 'a/b/2.txt',
+                        'c', 'c/3.txt']
+            self.assertEqual(expected[expected.index(start_after) + 1:],
+                             walked)
+
+    def test_add_tree(self):
+        """All files end up in the archive and are counted."""
+        out = io.BytesIO()
+        with tarfile.open(fileobj=out, mode='w|') as tar:
+            num_files, num_bytes = add_tree(tar, self.top)
+
+        out.seek(0)
+        with tarfile.open(fileobj=out, mode='r') as tar:
+            names = tar.getnames()
+
+        self.assertEqual(4, num_files)
+        self.assertEqual(len('a/1.txta/b/2.txtc/3.txt4.txt'), num_bytes)
+        self.assertEqual(8, len(names))
+
+
+if __name__ == '__main__':
+    unittest.main()
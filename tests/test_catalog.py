@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from esbckp.catalog import Catalog, prefix_to_timestamp
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.group_dir = os.path.join(self.path, 'group')
+        os.makedirs(os.path.join(self.group_dir, '.index'))
+        self.catalog = Catalog(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name):
+        path = os.path.join(self.group_dir, name)
+        with open(path, 'w') as f:
+            f.write(name)
+        return path
+
+    def test_add_backup_and_mark_deleted(self):
+        """Backups are ordered by their prefix, deleted ones are hidden."""
+        newer = self.write('2020-01-02--00-00-00__#srv.tar.gz')
+        older = self.write('2020-01-01--00-00-00__#srv.tar.gz')
+        self.catalog.add_backup('group', '/srv', newer, 'abc', 'gzip', 1.5)
+        self.catalog.add_backup('group', '/srv', older, 'def', 'gzip', 1.0)
+
+        rows = self.catalog.backups('group')
+        self.assertEqual([os.path.basename(older), os.path.basename(newer)],
+                         [row['name'] for row in rows])
+        self.assertEqual(prefix_to_timestamp('2020-01-01--00-00-00'),
+                         rows[0]['created_at'])
+        self.assertEqual('def', rows[0]['sha256'])
+        self.assertEqual(len(os.path.basename(older)), rows[0]['size'])
+
+        self.catalog.mark_deleted('group', [os.path.basename(older)])
+        self.assertEqual([os.path.basename(newer)],
+                         [row['name'] for row in self.catalog.backups('group')])
+
+    def test_ensure_imported(self):
+        """Existing backups and the old ship log are imported once."""
+        name = os.path.basename(self.write('2020-01-01--00-00-00__#srv.tar'))
+        self.write('unrelated.txt')
+        with open(os.path.join(self.group_dir, '.index', 'shipped.log'),
+                  'w') as f:
+            f.write(json.dumps({'target': 'u@h:/r', 'name': name}) + '\n')
+
+        self.catalog.ensure_imported('group', self.group_dir)
+        self.assertEqual([name], [r['name']
+                                  for r in self.catalog.backups('group')])
+        self.assertEqual({name: ['u@h:/r']}, self.catalog.shipments('group'))
+        self.assertEqual([], self.catalog.unshipped('group', 'u@h:/r'))
+
+        self.write('2020-01-02--00-00-00__#srv.tar')
+        self.catalog.ensure_imported('group', self.group_dir)
+        self.assertEqual(1, len(self.catalog.backups('group')))
+
+
+if __name__ == '__main__':
+    unittest.main()
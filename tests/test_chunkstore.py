@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import esbckp.chunkstore
+from esbckp.chunkstore import ChunkStore, ChunkWriter, ChunkReader, read_manifest
+
+
+def write_stream(store, manifest_path, data):
+    writer = ChunkWriter(store, manifest_path)
+    for i in range(0, len(data), 10240):
+        writer.write(data[i:i + 10240])
+    writer.close()
+    return writer
+
+
+class TestChunkStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = ChunkStore(os.path.join(self.path, '.chunks'))
+        rnd = random.Random(42)
+        self.data = bytes(bytearray(rnd.getrandbits(8)
+                                    for _ in range(3 * 1024 * 1024)))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_roundtrip(self):
+        """Reading a manifest back yields the original stream."""
+        manifest_path = os.path.join(self.path, 'a.manifest')
+        write_stream(self.store, manifest_path, self.data)
+
+        reader = ChunkReader(self.store, read_manifest(manifest_path))
+        self.assertEqual(self.data, reader.read(1000) + reader.read())
+
+    def test_insert_only_stores_changed_chunks(self):
+        """An insertion near the start leaves later chunks deduplicated."""
+        first = write_stream(self.store, os.path.join(self.path, 'a.manifest'),
+                             self.data)
+        changed = self.data[:1000] + b'inserted' + self.data[1000:]
+        second = write_stream(self.store, os.path.join(self.path, 'b.manifest'),
+                              changed)
+
+        self.assertTrue(len(first.chunks) > 1)
+        self.assertEqual(first.chunks[1:], second.chunks[1:])
+        self.assertTrue(second.bytes_stored < first.bytes_stored / 2)
+
+    def test_boundaries_without_numpy(self):
+        """The Python hash cuts the stream where the numpy one does."""
+        data = self.data + self.data[::-1]
+        first = write_stream(self.store, os.path.join(self.path, 'a.manifest'),
+                             data)
+        numpy = esbckp.chunkstore.numpy
+        esbckp.chunkstore.numpy = None
+        try:
+            second = write_stream(
+                self.store, os.path.join(self.path, 'b.manifest'), data)
+        finally:
+            esbckp.chunkstore.numpy = numpy
+
+        self.assertTrue(len(first.chunks) > 2)
+        self.assertEqual(first.chunks, second.chunks)
+
+    def test_gc_keeps_referenced_chunks(self):
+        """Only chunks no manifest references are garbage collected."""
+        a = os.path.join(self.path, 'a.manifest')
+        write_stream(self.store, a, self.data)
+        write_stream(self.store, os.path.join(self.path, 'b.manifest'),
+                     b'something else')
+
+        unreferenced = self.store.gc([a], dry_run=False)
+        self.assertEqual(1, len(unreferenced))
+        self.assertEqual(self.data, ChunkReader(self.store,
+                                                read_manifest(a)).read())
+
+
+if __name__ == '__main__':
+    unittest.main()
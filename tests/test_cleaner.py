@@ -3,9 +3,15 @@ import calendar
 import datetime
 import os
 import shutil
+import click
 import subprocess
+import tempfile
+import time
 import unittest
-from esbckp.backups import Cleaner
+from esbckp.backups import BackupGroup, Cleaner
+from esbckp.cleaner import DAY
+from esbckp.commands import clean_groups
+from esbckp.constants import ERR_MAX_DELETE_EXCEEDED
 
 
 def create_testfiles(file_dates):
@@ -52,49 +58,51 @@ class TestCleaner(unittest.TestCase):
                           for x in range(0, 550)]
 
     def test_remove_older_than_months_to_keep(self):
-        """All dates marked for removal are older than months_to_keep."""
-        to_remove = self.cleaner._filter_older_than_months_to_keep(
-            self.date_list)
+        """All dates older than months_to_keep are marked for removal."""
+        to_remove = self.cleaner._get_file_indexes_to_delete(self.date_list)
+        latest_date_to_keep = self.cleaner._get_limits()[0]
 
-        for val,idx in enumerate(to_remove):
-            self.assertEqual(True, self.date_list[idx] < self.compare_date_unix)
-            self.assertEqual(True, len(to_remove) == 184)
+        older = [idx for idx in to_remove
+                 if self.date_list[idx] < latest_date_to_keep]
+        self.assertEqual([idx for idx, file_date in enumerate(self.date_list)
+                          if file_date < latest_date_to_keep], older)
+        self.assertEqual(184, len(older))
 
     def test_months_to_keep(self):
-        """Removed dates are between weeks_to_keep and months_to_keep."""
-        to_remove = self.cleaner._filter_months_to_keep(
-            self.date_list)
+        """Between weeks_to_keep and months_to_keep one date per month
+        according to day_of_month_to_keep is kept."""
+        to_remove = self.cleaner._get_file_indexes_to_delete(self.date_list)
 
         youngest_date_to_compare = 1413244800  # i.e. 2014-10-14 02:00:00
         latest_date_to_compare = 1384128000    # i.e. 2013-11-11 01:00:00
 
-        for val,idx in enumerate(to_remove):
-            cond1 = self.date_list[idx] <= youngest_date_to_compare
-            cond2 = self.date_list[idx] >= latest_date_to_compare
-            cond3 = datetime.datetime.fromtimestamp(
-                self.date_list[idx]).day != self.cleaner.day_of_month_to_keep
-
-            self.assertEqual(True, cond1 and cond2 and cond3)
-            self.assertEqual(True, len(to_remove) == 327)
+        in_months = [idx for idx in to_remove
+                     if latest_date_to_compare <= self.date_list[idx] <=
+                     youngest_date_to_compare]
+        for idx in in_months:
+            self.assertNotEqual(self.cleaner.day_of_month_to_keep,
+                                datetime.datetime.fromtimestamp(
+                                    self.date_list[idx]).day)
+        self.assertEqual(327, len(in_months))
 
     def test_weeks_to_keep(self):
-        """Removed dates are between days_to_keep and weeks_to_keep."""
-        to_remove = self.cleaner._filter_weeks_to_keep(
-            self.date_list)
+        """Between days_to_keep and weeks_to_keep one date per week
+        according to day_of_week_to_keep and the one according to
+        day_of_month_to_keep are kept."""
+        to_remove = self.cleaner._get_file_indexes_to_delete(self.date_list)
 
         youngest_date_to_compare = 1415059200  # i.e. 2014-11-04 01:00:00
         latest_date_to_compare = 1413244800    # i.e. 2014-10-14 02:00:00
 
-        for val,idx in enumerate(to_remove):
-            cond1 = self.date_list[idx] <= youngest_date_to_compare
-            cond2 = self.date_list[idx] >= latest_date_to_compare
-            cond3 = datetime.datetime.fromtimestamp(
-                self.date_list[idx]).weekday() != self.cleaner.day_of_week_to_keep
-            cond4 = datetime.datetime.fromtimestamp(
-                self.date_list[idx]).day != self.cleaner.day_of_month_to_keep
-
-            self.assertEqual(True, cond1 and cond2 and cond3 and cond4)
-            self.assertEqual(True, len(to_remove) == 19)
+        in_weeks = [idx for idx in to_remove
+                    if latest_date_to_compare <= self.date_list[idx] <=
+                    youngest_date_to_compare]
+        for idx in in_weeks:
+            dt = datetime.datetime.fromtimestamp(self.date_list[idx])
+            self.assertNotEqual(self.cleaner.day_of_week_to_keep,
+                                dt.weekday())
+            self.assertNotEqual(self.cleaner.day_of_month_to_keep, dt.day)
+        self.assertEqual(19, len(in_weeks))
 
     def test_get_file_indexes_to_delete(self):
         """List of indexes sum up to the correct amount."""
@@ -111,5 +119,151 @@ class TestCleaner(unittest.TestCase):
 
         self.assertEqual(True, len(os.listdir(self.cleaner.storage_dir)) == 21)
 
+    def test_keep_chain_dependencies(self):
+        """Full and older incremental backups of kept chains survive."""
+        self.cleaner.files = [
+            ('/b/2014-11-01--03-00-00__#srv.tar.gz', 0),
+            ('/b/2014-11-02--03-00-00__#srv.incr-2014-11-01--03-00-00.tar.gz', 0),
+            ('/b/2014-11-03--03-00-00__#srv.incr-2014-11-01--03-00-00.tar.gz', 0),
+            ('/b/2014-11-04--03-00-00__#srv.incr-2014-11-01--03-00-00.tar.gz', 0),
+            ('/b/2014-11-05--03-00-00__#srv.tar.gz', 0),
+            ('/b/2014-11-05--03-00-00__#other.tar.gz', 0),
+        ]
+        to_remove = self.cleaner._keep_chain_dependencies([0, 1, 2, 5])
+        self.assertEqual([5], to_remove)
+
+        to_remove = self.cleaner._keep_chain_dependencies([0, 1, 2, 3])
+        self.assertEqual([0, 1, 2, 3], sorted(to_remove))
+
+    def test_keep_latest_per_item(self):
+        """The newest backup of each item survives for skipped items."""
+        self.cleaner.files = [
+            ('/b/2014-01-01--03-00-00__#srv.tar.gz', 0),
+            ('/b/2014-02-01--03-00-00__#srv.tar.gz', 0),
+            ('/b/2014-01-01--03-00-00__#etc.tar.gz', 0),
+        ]
+        self.assertEqual([0], self.cleaner._keep_latest_per_item([0, 1, 2]))
+
+    def test_keep_covering_backups(self):
+        """Backups stay while they stand in for a kept day that was
+        skipped."""
+        self.cleaner.files = [
+            ('/b/2014-{}-{}--12-00-00__#{}.tar.gz'.format(month, day, item),
+             calendar.timegm((2014, int(month), int(day), 12, 0, 0)))
+            for month, day, item in (
+                ('08', '28', 'srv'),  # Stands in for Sep 1.
+                ('09', '03', 'srv'),
+                ('09', '05', 'srv'),  # Stands in for Oct 1.
+                ('10', '20', 'srv'),  # Stands in for Saturday, Oct 25.
+                ('10', '27', 'srv'),
+                ('10', '28', 'srv'),
+                ('10', '20', 'etc'))]
+        file_dates = [f[1] for f in self.cleaner.files]
+
+        to_remove = self.cleaner._get_file_indexes_to_delete(file_dates)
+        self.assertEqual(range(7), to_remove)
+        self.assertEqual([1, 4],
+                         self.cleaner._keep_covering_backups(to_remove))
+
+    def test_days_across_dst_changes(self):
+        """Cached local days match ``localtime`` around DST changes, also
+        in zones whose offsets are not whole hours."""
+        tz = os.environ.get('TZ')
+        try:
+            for zone, change in (('Europe/Berlin', (2014, 3, 30, 1)),
+                                 ('Europe/Berlin', (2014, 10, 26, 1)),
+                                 ('Australia/Lord_Howe', (2014, 4, 5, 15)),
+                                 ('Australia/Lord_Howe', (2014, 10, 4, 15))):
+                os.environ['TZ'] = zone
+                time.tzset()
+                cleaner = Cleaner()
+                change = calendar.timegm(change + (0, 0))
+                for file_date in range(change - DAY, change + DAY, 7 * 60):
+                    tm = time.localtime(file_date)
+                    self.assertEqual((tm.tm_mday, tm.tm_wday),
+                                     cleaner._get_day_and_weekday(file_date))
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+
+
+class TestDeletion(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage_dir = os.path.join(self.path, 'g1')
+        os.makedirs(self.storage_dir)
+
+        cleaner = Cleaner()
+        cleaner.days_to_keep = 7
+        cleaner.weeks_to_keep = 4
+        cleaner.months_to_keep = 12
+        cleaner.day_of_week_to_keep = 5
+        cleaner.day_of_month_to_keep = 1
+        cleaner.compare_time = datetime.datetime(2014, 11, 11, 0, 0, 0)
+        cleaner.threads = 2
+        self.cleaner = cleaner
+
+        self.group = BackupGroup()
+        self.group.group_title = 'g1'
+        self.group.base_path = self.storage_dir
+        self.group.cleaner = cleaner
+
+        # An outdated archive with checksums, a directory dump and an
+        # archive with a hard link outside the group, next to a kept one.
+        self.old = calendar.timegm((2013, 1, 5, 3, 0, 0))
+        self.new = calendar.timegm((2014, 11, 10, 3, 0, 0))
+        self.write('2013-01-05--03-00-00__#srv.tar.gz', 1000)
+        self.write('.2013-01-05--03-00-00__#srv.tar.gz.sha256', 80)
+        dump = '2013-01-05--03-00-00__postgres_db.dump'
+        os.makedirs(os.path.join(self.storage_dir, dump, 'blobs'))
+        self.write(os.path.join(dump, 'toc.dat'), 100)
+        self.write(os.path.join(dump, 'blobs', '1.dat.gz'), 250)
+        self.write('2013-01-05--03-00-00__#etc.tar.gz', 500)
+        os.link(os.path.join(self.storage_dir,
+                             '2013-01-05--03-00-00__#etc.tar.gz'),
+                os.path.join(self.path, 'etc.tar.gz'))
+        self.write('2014-11-10--03-00-00__#etc.tar.gz', 500)
+        for name in os.listdir(self.storage_dir):
+            path = os.path.join(self.storage_dir, name)
+            mtime = self.new if name.startswith('2014') else self.old
+            os.utime(path, (mtime, mtime))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, size):
+        path = os.path.join(self.storage_dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+
+    def test_max_delete(self):
+        """Nothing is deleted if more backups are outdated than allowed."""
+        class Backup(object):
+            backup_groups = [self.group]
+            backup_storage_dir = self.path
+
+        names = sorted(os.listdir(self.storage_dir))
+        with self.assertRaises(click.ClickException) as cm:
+            clean_groups(Backup(), False, 1, 2)
+        self.assertEqual(ERR_MAX_DELETE_EXCEEDED.format(3, 2),
+                         cm.exception.message)
+        self.assertEqual(names, sorted(os.listdir(self.storage_dir)))
+
+        clean_groups(Backup(), False, 1, 3)
+        self.assertEqual(['2014-11-10--03-00-00__#etc.tar.gz'],
+                         os.listdir(self.storage_dir))
+
+    def test_freed_bytes(self):
+        """Directory dumps are removed as trees, hard linked backups free
+        nothing."""
+        self.assertEqual(1000 + 100 + 250,
+                         self.cleaner.clean(self.storage_dir, dry_run=False))
+        self.assertEqual(['2014-11-10--03-00-00__#etc.tar.gz'],
+                         os.listdir(self.storage_dir))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import os
+import unittest
+from esbckp.compression import Compression, ParallelGzipWriter
+
+
+class TestCompression(unittest.TestCase):
+    def test_extension_follows_codec(self):
+        """File extensions are derived from the configured codec."""
+        self.assertEqual('.tar.gz', Compression('gzip').extension)
+        self.assertEqual('.tar.gz', Compression('pigz').extension)
+        self.assertEqual('.tar.zst', Compression('zstd').extension)
+        self.assertEqual('.tar.lz4', Compression('lz4').extension)
+        self.assertEqual('.tar', Compression('none').extension)
+
+    def test_external_cmd(self):
+        """External compressor commands contain level and threads."""
+        cmd = Compression('zstd', level=5, threads=4).get_cmd()
+        self.assertEqual(['zstd', '-q', '-c', '-5', '-T4'], cmd)
+        self.assertEqual(None, Compression('gzip').get_cmd())
+
+    def test_parallel_gzip_is_gunzip_compatible(self):
+        """Block-parallel output decompresses to the original data."""
+        data = os.urandom(50000) * 10
+        out = io.BytesIO()
+        writer = ParallelGzipWriter(out, level=6, threads=3, block_size=70000)
+        for i in range(0, len(data), 8192):
+            writer.write(data[i:i + 8192])
+        writer.close()
+
+        out.seek(0)
+        self.assertEqual(data, gzip.GzipFile(fileobj=out).read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import click
+import os
+import shutil
+import tempfile
+import unittest
+import esbckp
+import esbckp.config
+from esbckp.config import load_config
+
+CONFIG = """
+[DEFAULT]
+backup_storage_dir: {path}
+dir:
+db:
+shipper_ssh_port: 22
+shipper_user: u
+shipper_dir: /srv/backups
+
+[g1]
+dir: ~/a, ~/b
+shipper_host: h1, h2
+
+[g10]
+db: postgres:db:user
+compression: zstd
+volume_size: 4G
+cleaner_days_to_keep: 7
+cleaner_weeks_to_keep: 4
+cleaner_months_to_keep: 12
+cleaner_day_of_week_to_keep: 4
+cleaner_day_of_month_to_keep: 15
+cleaner_threads: 32
+
+[broken]
+mode: sometimes
+"""
+
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.conf = os.path.join(self.path, 'conf.ini')
+        self.cache = os.path.join(self.path, 'cache')
+        with open(self.conf, 'w') as f:
+            f.write(CONFIG.format(path=self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_compile(self):
+        """Options are typed, invalid groups only fail when selected."""
+        config = load_config(self.conf, self.cache)
+        g1, g10 = config.group('g1'), config.group('g10')
+        self.assertEqual(['~/a', '~/b'], g1.dirs)
+        self.assertEqual(['h1', 'h2'], g1.shipper.hosts)
+        self.assertEqual(2, g1.shipper.retries)
+        self.assertIsNone(g1.cleaner)
+        self.assertEqual([], g10.dirs)
+        self.assertEqual('zstd', g10.compression)
+        self.assertEqual(4 * 1024 ** 3, g10.volume_size)
+        self.assertIsNone(g10.shipper)
+        self.assertEqual((7, 32), (g10.cleaner.days_to_keep,
+                                   g10.cleaner.threads))
+
+        with self.assertRaises(click.ClickException):
+            config.group('broken')
+        self.assertEqual(['g1'], config.select('g1'))
+        self.assertEqual(['g1', 'g10'], config.select(' g10,g1 '))
+        with self.assertRaises(click.ClickException):
+            config.select('g')
+
+    def test_cache(self):
+        """The cache is used until the file changes."""
+        config = load_config(self.conf, self.cache)
+        compile_config = esbckp.config.compile_config
+        esbckp.config.compile_config = None
+        try:
+            cached = load_config(self.conf, self.cache)
+            self.assertEqual(config.group('g10'), cached.group('g10'))
+            self.assertEqual(list(config.groups), list(cached.groups))
+
+            with open(self.conf, 'a') as f:
+                f.write('[g2]\n')
+            with self.assertRaises(TypeError):
+                load_config(self.conf, self.cache)
+        finally:
+            esbckp.config.compile_config = compile_config
+        self.assertIn('g2', load_config(self.conf, self.cache).groups)
+
+    def test_cache_writable_by_others(self):
+        """Caches others could have written are compiled again."""
+        load_config(self.conf, self.cache)
+        [name] = os.listdir(self.cache)
+        os.chmod(os.path.join(self.cache, name), 0o620)
+        compile_config = esbckp.config.compile_config
+        esbckp.config.compile_config = None
+        try:
+            with self.assertRaises(TypeError):
+                load_config(self.conf, self.cache)
+        finally:
+            esbckp.config.compile_config = compile_config
+        load_config(self.conf, self.cache)
+        self.assertEqual(0o600, os.stat(os.path.join(self.cache, name))
+                         .st_mode & 0o777)
+
+    def test_backup_builds_selected_groups(self):
+        """Only the selected groups are built, names match exactly."""
+        environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = self.cache
+        try:
+            backup = esbckp.Backup(self.conf, 'g1')
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        [group] = backup.backup_groups
+        self.assertEqual('g1', group.group_title)
+        self.assertEqual(['h1', 'h2'], [s.host for s in group.shippers])
+        self.assertEqual(['~/a', '~/b'], [item.dir for item in group.dirs])
+
+
+if __name__ == '__main__':
+    unittest.main()
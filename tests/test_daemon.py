@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import click
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from esbckp.daemon import Daemon, send_request
+from esbckp.locks import group_lock
+from esbckp.scheduler import CronSchedule
+
+CONFIG = """
+[DEFAULT]
+backup_storage_dir: {path}/store
+dir:
+db:
+
+[g1]
+dir: {path}/source
+schedule: 30 3 * * *
+pipeline: start, clean
+
+[g2]
+dir: {path}/source
+"""
+
+
+class TestCronSchedule(unittest.TestCase):
+    def test_next_after(self):
+        """Runs follow crontab, days match by day of month or weekday."""
+        now = datetime(2026, 10, 17, 15, 30, 20)
+        cases = [
+            ('30 3 * * *', datetime(2026, 10, 18, 3, 30)),
+            ('*/15 * * * *', datetime(2026, 10, 17, 15, 45)),
+            ('0 12 * * 1-5', datetime(2026, 10, 19, 12, 0)),
+            ('0 0 13 * 5', datetime(2026, 10, 23, 0, 0)),
+            ('0 0 29 2 *', datetime(2028, 2, 29, 0, 0)),
+            ('0 8 * * 7', datetime(2026, 10, 18, 8, 0)),
+        ]
+        for expr, expected in cases:
+            self.assertEqual(expected, CronSchedule(expr).next_after(now),
+                             expr)
+
+        for expr in ('0 0 31 2 *', '60 * * * *', '* * *', 'a * * * *'):
+            with self.assertRaises(ValueError):
+                CronSchedule(expr).next_after(now)
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.path, 'store'))
+        os.makedirs(os.path.join(self.path, 'source'))
+        with open(os.path.join(self.path, 'source', 'a'), 'w') as f:
+            f.write('a' * 1000)
+        self.conf = os.path.join(self.path, 'conf.ini')
+        with open(self.conf, 'w') as f:
+            f.write(CONFIG.format(path=self.path))
+
+        self.environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.path, 'cache')
+        self.daemon = Daemon(self.conf)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.path)
+
+    def run_queued(self):
+        title, stages = self.daemon.queue.get_nowait()
+        self.daemon.run_pipeline(title, stages)
+
+    def test_schedules(self):
+        """Groups keep their pipeline, only scheduled ones have a run."""
+        g1, g2 = self.daemon.status()
+        self.assertEqual('30 3 * * *', g1['schedule'])
+        self.assertEqual(['start', 'clean'], g1['pipeline'])
+        self.assertTrue(g1['next_run'].endswith('03:30:00'))
+        self.assertIsNone(g2['next_run'])
+
+    def test_pipeline(self):
+        """Triggers coalesce, a group locked elsewhere fails its run."""
+        self.assertTrue(self.daemon.trigger('g2'))
+        self.assertFalse(self.daemon.trigger('g2'))
+        with self.assertRaises(click.ClickException):
+            self.daemon.trigger('g2', ['backup'])
+        self.run_queued()
+
+        [g1, g2] = self.daemon.status()
+        self.assertEqual(('idle', True, 1), (g2['state'], g2['ok'],
+                                             g2['runs']))
+        self.assertEqual(1, len([name for name in os.listdir(os.path.join(
+            self.path, 'store', 'g2')) if not name.startswith('.')]))
+
+        with group_lock(self.daemon.backup.backup_storage_dir, 'g2'):
+            self.assertTrue(self.daemon.trigger('g2'))
+            self.run_queued()
+        g2 = self.daemon.status()[1]
+        self.assertFalse(g2['ok'])
+        self.assertIn('busy', g2['error'])
+
+    def test_control_socket(self):
+        """Clients get the status and errors through the socket."""
+        server = self.daemon._bind()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            path = self.daemon.socket_path
+            status = send_request(path, {'command': 'status'})
+            self.assertEqual(['g1', 'g2'], [s['group'] for s in status])
+            self.assertTrue(send_request(path, {'command': 'trigger',
+                                                'group': 'g1'}))
+            with self.assertRaises(click.ClickException):
+                send_request(path, {'command': 'trigger', 'group': 'g3'})
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual('queued', self.daemon.status()[0]['state'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import click
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import esbckp
+from esbckp.backups import BackupGroup
+from esbckp.restore import restore_chain
+from esbckp.seekindex import read_index, sidecar_path
+from esbckp.utils import do_file_backup
+
+try:
+    import cryptography
+    from esbckp.encryption import EncryptingWriter, DecryptingReader
+except ImportError:
+    cryptography = None
+
+KEY = b'k' * 32
+
+
+def encrypt(data, key=KEY, chunk_size=1000):
+    out = io.BytesIO()
+    writer = EncryptingWriter(out, key, chunk_size)
+    for x in range(0, len(data), 777):
+        writer.write(data[x:x + 777])
+    writer.close()
+    return out.getvalue()
+
+
+@unittest.skipIf(cryptography is None, 'cryptography is not installed')
+class TestEncryption(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(1)
+        self.data = b''.join(chr(rnd.randint(0, 255)) for _ in range(10500))
+
+    def test_read_and_seek(self):
+        """Any range of the plaintext can be read, at chunk edges too."""
+        for size in (0, 1000, 3000, 10500):
+            reader = DecryptingReader(io.BytesIO(encrypt(self.data[:size])),
+                                      KEY)
+            self.assertEqual(size, reader.size)
+            self.assertEqual(self.data[:size], reader.read())
+            for pos in (size - 1, 0, 999, 1000, 4321):
+                reader.seek(pos)
+                self.assertEqual(self.data[pos:min(pos + 1500, size)],
+                                 reader.read(1500))
+
+    def test_modified_file_fails(self):
+        """Changed, truncated and wrongly keyed files are refused."""
+        encrypted = encrypt(self.data)
+        changed = bytearray(encrypted)
+        changed[3000] ^= 1
+        reader = DecryptingReader(io.BytesIO(bytes(changed)), KEY)
+        with self.assertRaises(click.ClickException):
+            reader.read()
+
+        # Ends after a complete chunk, which is not marked as the last.
+        truncated = encrypted[:len(encrypted) - len(encrypted) % 1016]
+        with self.assertRaises(click.ClickException):
+            DecryptingReader(io.BytesIO(truncated), KEY)
+
+        with self.assertRaises(click.ClickException):
+            DecryptingReader(io.BytesIO(encrypted), b'x' * 32)
+
+
+@unittest.skipIf(cryptography is None, 'cryptography is not installed')
+class TestEncryptedBackup(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source = os.path.join(self.path, 'source')
+        os.makedirs(os.path.join(self.source, 'docs'))
+        for name in ('docs/a.txt', 'docs/b.md', 'c'):
+            with open(os.path.join(self.source, name), 'wb') as f:
+                f.write(os.urandom(150000))
+
+        self.group = BackupGroup()
+        self.group.group_title = 'test'
+        self.group.base_path = os.path.join(self.path, 'backups')
+        self.group.filename_prefix = '2020-01-01--00-00-00'
+        self.group.encryption_key = KEY
+        self.group.check_or_create_base_path()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def restored(self, path, pattern):
+        target = os.path.join(self.path, 'target')
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        restore_chain(self.group, [path], target, self.source, pattern, 2)
+        root = os.path.join(target, self.source.lstrip('/'))
+        return sorted(os.path.relpath(os.path.join(dp, f), root)
+                      for dp, _, fn in os.walk(root) for f in fn)
+
+    def test_backup_and_restore(self):
+        """Encrypted archives and their index restore with the key only."""
+        item = esbckp.FileBackupItem()
+        item.dir = self.source
+        path = do_file_backup(self.group, item, progress=False)
+        self.assertTrue(path.endswith('.tar.gz.enc'))
+        self.assertIsNone(read_index(path))
+        self.assertTrue(read_index(path, KEY)['members'])
+
+        self.assertEqual(['c', 'docs/a.txt', 'docs/b.md'],
+                         self.restored(path, None))
+        self.assertEqual(['docs/a.txt'], self.restored(path, 'docs/*.txt'))
+
+        # Without the index the archive is decrypted as one stream.
+        os.remove(sidecar_path(path))
+        self.assertEqual(['docs/b.md'], self.restored(path, '*.md'))
+
+        self.group.encryption_key = None
+        with self.assertRaises(click.ClickException):
+            self.restored(path, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+import click
+from esbckp.archiver import walk_tree
+from esbckp.filters import PathFilter, parse_size
+
+
+class TestPathFilter(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        for d in ('app/node_modules/pkg', 'app/src', 'var/cache', 'var/log'):
+            os.makedirs(os.path.join(self.top, d))
+        for f in ('app/node_modules/pkg/index.js', 'app/src/main.js',
+                  'app/src/debug.log', 'var/cache/x', 'var/log/a.log',
+                  'var/log/keep.log'):
+            self.write(f, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def write(self, name, data):
+        with open(os.path.join(self.top, name), 'w') as f:
+            f.write(data)
+
+    def walk(self, path_filter):
+        return [os.path.relpath(p, self.top)
+                for p, _ in walk_tree(self.top, path_filter)][1:]
+
+    def test_globs_and_regex(self):
+        """Name globs match at any depth, path globs and regexes below top."""
+        path_filter = PathFilter(
+            exclude=['node_modules', '*.log', 'var/cache', 're:app/s.c/m.*'],
+            include=['keep.log'])
+        self.assertEqual(['app', 'app/src', 'var', 'var/log',
+                          'var/log/keep.log'], self.walk(path_filter))
+
+    def test_excluded_directories_are_not_listed(self):
+        """Pruned subtrees are never descended into."""
+        os.chmod(os.path.join(self.top, 'var/cache'), 0)
+        try:
+            walked = self.walk(PathFilter(exclude=['cache']))
+        finally:
+            os.chmod(os.path.join(self.top, 'var/cache'), 0o755)
+        self.assertNotIn('var/cache/x', walked)
+
+    def test_ignore_files(self):
+        """Ignore files apply to their directory and everything below."""
+        self.write('app/.esbckpignore', '# deps\nnode_modules\nsrc/*.log\n')
+        walked = self.walk(PathFilter())
+        self.assertIn('var/log/a.log', walked)
+        self.assertIn('app/.esbckpignore', walked)
+        self.assertNotIn('app/node_modules', walked)
+        self.assertNotIn('app/src/debug.log', walked)
+        self.assertIn('app/src/main.js', walked)
+
+    def test_sizes(self):
+        self.assertEqual(100 * 1024 * 1024, parse_size('100M'))
+        self.assertEqual(512, parse_size('512'))
+        self.assertEqual(2 * 1024 ** 3, parse_size('2gb'))
+        self.assertRaises(click.ClickException, parse_size, 'lots')
+        self.assertTrue(PathFilter(max_file_size=10).allows_size(10))
+        self.assertFalse(PathFilter(max_file_size=10).allows_size(11))
+
+
+if __name__ == '__main__':
+    unittest.main()
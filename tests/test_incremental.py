@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import esbckp
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from esbckp.backups import BackupGroup
+from esbckp.compression import Compression
+from esbckp.incremental import (ChangeDetector, DELETED_MEMBER, FileIndex,
+                                FingerprintStore, tree_fingerprint)
+from esbckp.utils import do_file_backup
+
+
+class TestTreeFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.top = os.path.join(self.path, 'top')
+        os.makedirs(os.path.join(self.top, 'sub'))
+        self.write('sub/a', 'aaaa')
+        self.write('b', 'bb')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, data, mtime=1000000000):
+        path = os.path.join(self.top, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+
+    def test_counts_files_and_bytes(self):
+        fingerprint = tree_fingerprint(self.top)
+        self.assertEqual(2, fingerprint['files'])
+        self.assertEqual(6, fingerprint['bytes'])
+        self.assertEqual(fingerprint, tree_fingerprint(self.top))
+
+    def test_changes_with_content_metadata(self):
+        """Modified, resized and added files change the digest."""
+        digests = [tree_fingerprint(self.top)['digest']]
+
+        self.write('sub/a', 'aaab', mtime=1000000001)
+        digests.append(tree_fingerprint(self.top)['digest'])
+
+        self.write('b', 'bbb', mtime=1000000001)
+        digests.append(tree_fingerprint(self.top)['digest'])
+
+        self.write('c', '')
+        digests.append(tree_fingerprint(self.top)['digest'])
+
+        self.assertEqual(len(digests), len(set(digests)))
+
+    def test_store(self):
+        store = FingerprintStore(os.path.join(self.path, '.index'), '#top')
+        self.assertIsNone(store.read())
+
+        fingerprint = tree_fingerprint(self.top)
+        store.write(fingerprint, 'backup.tar.gz')
+        self.assertEqual(dict(fingerprint, name='backup.tar.gz'), store.read())
+
+
+class TestChangeDetector(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.top = os.path.join(self.path, 'top')
+        os.makedirs(os.path.join(self.top, 'sub'))
+        self.write('sub/a', 'aaaa')
+        self.write('b', 'bb')
+        self.write('c', 'c')
+
+        self.group = BackupGroup()
+        self.group.group_title = 'test'
+        self.group.base_path = os.path.join(self.path, 'backups')
+        self.group.compression = Compression('none')
+        self.group.mode = 'incremental'
+        self.group.check_or_create_base_path()
+        self.item = esbckp.FileBackupItem(self.top)
+        self.runs = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, data, mtime=1000000000):
+        path = os.path.join(self.top, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+
+    def backup(self):
+        """Returns name and members with their content of a new backup."""
+        self.runs += 1
+        self.group.filename_prefix = '2020-01-{:02d}--00-00-00'.format(
+            self.runs)
+        path = do_file_backup(self.group, self.item, progress=False)
+        with tarfile.open(path) as tar:
+            members = dict((m.name, tar.extractfile(m).read())
+                           for m in tar.getmembers() if m.isfile())
+        return os.path.basename(path), members
+
+    def file_index(self):
+        return FileIndex(self.group.index_path,
+                         self.top.replace(os.sep, '#'))
+
+    def test_incremental_backups(self):
+        """New and changed files are archived, deleted ones listed."""
+        name, members = self.backup()
+        self.assertNotIn('.incr-', name)
+        self.assertEqual(3, len(members))
+        self.assertNotIn(DELETED_MEMBER, members)
+
+        self.write('b', 'bbb', mtime=1000000001)
+        self.write('sub/d', 'dd')
+        os.remove(os.path.join(self.top, 'c'))
+        name, members = self.backup()
+        self.assertIn('.incr-2020-01-01--00-00-00', name)
+
+        top = self.top.lstrip(os.sep)
+        self.assertEqual({
+            top + '/b': b'bbb',
+            top + '/sub/d': b'dd',
+            DELETED_MEMBER: top.encode('utf-8') + b'/c',
+        }, members)
+
+        name, members = self.backup()
+        self.assertEqual({DELETED_MEMBER: b''}, members)
+
+    def test_same_second(self):
+        """Files rewritten within the second of the last run at the same
+        size are archived again."""
+        self.write('b', 'bb', mtime=1000000000.25)
+        self.backup()
+        self.write('b', 'xx', mtime=1000000000.75)
+        name, members = self.backup()
+        self.assertEqual(b'xx', members[self.top.lstrip(os.sep) + '/b'])
+
+    def test_full_every(self):
+        """A full backup starts a new chain after ``full_every`` runs."""
+        self.group.full_every = 2
+        file_index = self.file_index()
+        self.assertTrue(file_index.needs_full(2))
+
+        names = [self.backup()[0] for _ in range(3)]
+        self.assertEqual([False, True, False],
+                         ['.incr-' in name for name in names])
+        self.assertEqual({'base': '2020-01-03--00-00-00', 'count': 0},
+                         file_index.read_chain())
+        self.assertFalse(file_index.needs_full(2))
+
+        _, members = self.backup()
+        self.assertEqual([DELETED_MEMBER], list(members))
+        self.assertEqual({'base': '2020-01-03--00-00-00', 'count': 1},
+                         file_index.read_chain())
+        self.assertTrue(file_index.needs_full(2))
+
+    def test_abort(self):
+        """A failed backup leaves the index of the last run in place."""
+        self.backup()
+        file_index = self.file_index()
+        entries = list(file_index.entries())
+
+        detector = ChangeDetector(file_index)
+        path = os.path.join(self.top, 'b')
+        with tarfile.open(os.path.join(self.path, 'x.tar'), 'w') as tar:
+            self.assertFalse(detector(path, tar.gettarinfo(path)))
+        self.assertTrue(os.path.exists(detector.new_index_path))
+
+        detector.abort()
+        self.assertFalse(os.path.exists(detector.new_index_path))
+        self.assertEqual(entries, list(file_index.entries()))
+
+
+if __name__ == '__main__':
+    unittest.main()
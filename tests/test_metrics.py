@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from esbckp.metrics import Metrics, Timings, measure
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.metrics = Metrics(os.path.join(self.path, 'metrics.jsonl'),
+                               self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_measure_records_failures(self):
+        """Records are written for failing blocks and marked as failed."""
+        with measure(self.metrics, 'file', 'g1', '/srv') as m:
+            m['bytes_in'] = 10
+            m['stages'] = {'walk': 0.5}
+
+        with self.assertRaises(ValueError):
+            with measure(self.metrics, 'dump', 'g1', 'postgres/db'):
+                raise ValueError()
+
+        records = self.metrics.records()
+        self.assertEqual(['file', 'dump'], [r['operation'] for r in records])
+        self.assertEqual([True, False], [r['ok'] for r in records])
+        self.assertEqual(10, records[0]['bytes_in'])
+        self.assertEqual({'walk': 0.5}, records[0]['stages'])
+
+    def test_cpu_time_of_parallel_items(self):
+        """CPU time is left out for items measured in parallel threads."""
+        started, done = threading.Event(), threading.Event()
+
+        def other():
+            with measure(self.metrics, 'dump', 'g1', 'postgres/db'):
+                started.set()
+                done.wait(5)
+
+        with measure(self.metrics, 'pipeline', 'g1', 'g1'):
+            with measure(self.metrics, 'file', 'g1', '/a'):
+                pass
+            thread = threading.Thread(target=other)
+            thread.start()
+            started.wait(5)
+            with measure(self.metrics, 'file', 'g1', '/b'):
+                done.set()
+            thread.join()
+        with measure(self.metrics, 'file', 'g1', '/c'):
+            pass
+
+        cpu = dict((r['item'], r['cpu_seconds'])
+                   for r in self.metrics.records())
+        self.assertIsNotNone(cpu['/a'])
+        self.assertIsNotNone(cpu['/c'])
+        self.assertEqual([None] * 3, [cpu[i] for i in ('g1', '/b',
+                                                       'postgres/db')])
+
+    def test_records_of_this_run_only(self):
+        """Earlier runs in the same file are not part of this run."""
+        self.metrics.record('file', 'g1', '/old', 1.0)
+        metrics = Metrics(self.metrics.path)
+        metrics.run_id = 'other'
+        metrics.record('file', 'g1', '/new', 2.0)
+        self.assertEqual(['/new'], [r['item'] for r in metrics.records()])
+
+    def test_textfile(self):
+        """Records are written as labelled Prometheus gauges."""
+        self.metrics.record('file', 'g1', '/srv', 1.5, bytes_out=42,
+                            stages={'write': 0.25})
+        self.metrics.write_textfile('start')
+
+        with open(os.path.join(self.path, 'esbckp_start.prom')) as f:
+            lines = f.read().splitlines()
+
+        labels = 'operation="file",group="g1",item="/srv"'
+        self.assertIn('esbckp_seconds{%s} 1.5' % labels, lines)
+        self.assertIn('esbckp_bytes_out{%s} 42' % labels, lines)
+        self.assertIn('esbckp_stage_seconds{%s,stage="write"} 0.25' % labels,
+                      lines)
+        self.assertIn('esbckp_success{%s} 1' % labels, lines)
+        self.assertFalse(any(l.startswith('esbckp_bytes_in{') for l in lines))
+
+    def test_timings_take_write_out_of_compress(self):
+        """In process codecs write from within compress."""
+        timings = Timings()
+        timings.add('compress', 2.0)
+        timings.add('write', 0.5)
+        timings.add('write', 0.5)
+        self.assertEqual({'compress': 1.0, 'write': 1.0}, timings.stages())
+
+
+if __name__ == '__main__':
+    unittest.main()
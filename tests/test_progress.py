@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import tarfile
+import unittest
+from esbckp.progress import (Progress, SharedProgress, format_duration,
+                             init_worker, worker_counter)
+
+
+class RecordingProgress(Progress):
+    def __init__(self, *args, **kwargs):
+        super(RecordingProgress, self).__init__(*args, **kwargs)
+        self.lines = []
+
+    def _draw(self, line):
+        self.lines.append(line)
+
+
+def file_info(size):
+    tarinfo = tarfile.TarInfo('f')
+    tarinfo.size = size
+    return tarinfo
+
+
+def archive_files(count):
+    counter = worker_counter()
+    for _ in range(count):
+        counter(file_info(100))
+    counter.finish()
+    return count
+
+
+class TestProgress(unittest.TestCase):
+    def test_counts_without_drawing_when_disabled(self):
+        """Files and bytes are counted even if nothing is shown."""
+        progress = RecordingProgress(enabled=False, interval=0)
+        for _ in range(3):
+            progress(file_info(10))
+        directory = tarfile.TarInfo('d')
+        directory.type = tarfile.DIRTYPE
+        progress(directory)
+        progress.finish()
+
+        self.assertEqual((3, 30), (progress.files, progress.bytes))
+        self.assertEqual([], progress.lines)
+
+    def test_throttles_updates(self):
+        """The line is drawn at most once per interval."""
+        progress = RecordingProgress(enabled=True, interval=3600)
+        progress._next_update = 0
+        for _ in range(1000):
+            progress(file_info(1))
+        self.assertEqual(1, len(progress.lines))
+
+    def test_eta_prefers_bytes(self):
+        """The ETA is based on bytes if the total is known."""
+        progress = Progress('/srv', total_files=100, total_bytes=1000,
+                            enabled=False)
+        progress(file_info(250))
+        self.assertEqual(30, progress.eta(10))
+
+        progress = Progress(total_files=4, enabled=False)
+        progress(file_info(250))
+        self.assertEqual(30, progress.eta(10))
+        self.assertIsNone(Progress(enabled=False).eta(10))
+
+        line = progress.format_line(progress.start + 10)
+        self.assertEqual('1/~4 files, 0.0 MB, 0.0 MB/s, ETA 0:00:30', line)
+
+    def test_shared_progress(self):
+        """Worker processes count into one line of the parent."""
+        progress = SharedProgress('all', interval=0.01, enabled=False)
+        pool = multiprocessing.Pool(3, init_worker, (progress.counters,))
+        try:
+            with progress.drawing():
+                done = pool.map(archive_files, [5, 10, 1000])
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual((1015, 101500), (progress.files, progress.bytes))
+        self.assertEqual(sum(done), progress.files)
+        self.assertIsNone(worker_counter())
+
+    def test_format_duration(self):
+        self.assertEqual('1:01:05', format_duration(3665.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+from esbckp.scheduler import Job, Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peaks = {}
+
+    def work(self, key):
+        with self.lock:
+            self.active[key] = self.active.get(key, 0) + 1
+            self.peaks[key] = max(self.peaks.get(key, 0), self.active[key])
+        time.sleep(0.02)
+        with self.lock:
+            self.active[key] -= 1
+        return key
+
+    def test_limits(self):
+        """Slots are capped per kind, per (kind, key) limits override it."""
+        scheduler = Scheduler(8, limits={'host': 2, ('host', 'b'): 1})
+        for x in range(6):
+            for host in ('a', 'b'):
+                scheduler.add(Job('{}{}'.format(host, x), self.work, (host,),
+                                  [('host', host)]))
+        finished = scheduler.run()
+
+        self.assertEqual(12, len(finished))
+        self.assertEqual({'a': 2, 'b': 1}, self.peaks)
+        self.assertTrue(all(job.error is None and job.traceback is None
+                            for job in finished))
+
+    def test_errors(self):
+        """Failing jobs keep their error, the other jobs still run."""
+        def fail():
+            raise OSError('boom')
+
+        scheduler = Scheduler(2)
+        scheduler.add(Job('fail', fail))
+        scheduler.add(Job('ok', self.work, ('a',)))
+        done = []
+        jobs = dict((job.title, job) for job in scheduler.run(done.append))
+
+        self.assertEqual(2, len(done))
+        self.assertIsInstance(jobs['fail'].error, OSError)
+        self.assertIn('boom', jobs['fail'].traceback)
+        self.assertEqual('a', jobs['ok'].result)
+        self.assertIsNotNone(jobs['ok'].duration)
+
+
+if __name__ == '__main__':
+    unittest.main()
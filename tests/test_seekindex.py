@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import esbckp
+from esbckp.backups import BackupGroup
+from esbckp.compression import ParallelGzipWriter
+from esbckp.restore import restore_chain
+from esbckp.seekindex import GzipSeekReader, read_index, sidecar_path
+from esbckp.utils import do_file_backup
+
+
+class TestGzipSeekReader(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        rnd = random.Random(1)
+        self.data = b''.join(chr(rnd.randint(0, 15)) for _ in range(300000))
+        self.gz = os.path.join(self.path, 'data.gz')
+        self.seek_points = list()
+        with open(self.gz, 'wb') as f:
+            writer = ParallelGzipWriter(f, threads=2, block_size=50000,
+                                        seek_points=self.seek_points)
+            for x in range(0, len(self.data), 7000):
+                writer.write(self.data[x:x + 7000])
+            writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_seek_and_read(self):
+        """Reads match the data at any position, forward and backward."""
+        self.assertGreater(len(self.seek_points), 5)
+        reader = GzipSeekReader(self.gz, self.seek_points)
+        for pos in (0, 120000, 120100, 49999, 299990, 5, 250000):
+            reader.seek(pos)
+            self.assertEqual(self.data[pos:pos + 100], reader.read(100))
+            self.assertEqual(min(pos + 100, len(self.data)), reader.tell())
+        reader.close()
+
+    def test_without_seek_points(self):
+        """Without seek points the stream is read from the start."""
+        reader = GzipSeekReader(self.gz)
+        reader.seek(200000)
+        self.assertEqual(self.data[200000:], reader.read())
+        reader.close()
+
+
+class TestSelectiveRestore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source = os.path.join(self.path, 'source')
+        for d in ('docs/sub', 'data'):
+            os.makedirs(os.path.join(self.source, d))
+        for name in ('docs/a.txt', 'docs/b.md', 'docs/sub/c.txt', 'data/d'):
+            with open(os.path.join(self.source, name), 'wb') as f:
+                f.write(os.urandom(200000))
+
+        self.group = BackupGroup()
+        self.group.group_title = 'test'
+        self.group.base_path = os.path.join(self.path, 'backups')
+        self.group.filename_prefix = '2020-01-01--00-00-00'
+        self.group.check_or_create_base_path()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def restored(self, pattern, jobs, index=True):
+        item = esbckp.FileBackupItem()
+        item.dir = self.source
+        path = do_file_backup(self.group, item, progress=False)
+        self.assertTrue(read_index(path)['members'])
+        if not index:
+            os.remove(sidecar_path(path))
+
+        target = os.path.join(self.path, 'target')
+        restore_chain(self.group, [path], target, self.source, pattern, jobs)
+        root = os.path.join(target, self.source.lstrip('/'))
+        return sorted(os.path.relpath(os.path.join(dp, f), root)
+                      for dp, _, fn in os.walk(root) for f in fn)
+
+    def test_restore_glob(self):
+        """Only matching files and everything below matching dirs return."""
+        self.assertEqual(['docs/a.txt', 'docs/sub/c.txt'],
+                         self.restored('docs/*.txt', 2))
+        shutil.rmtree(os.path.join(self.path, 'target'))
+        self.assertEqual(['docs/sub/c.txt'], self.restored('docs/sub', 1))
+
+    def test_restore_everything_in_parallel(self):
+        """Threads extracting slices of one archive restore all data."""
+        restored = self.restored(None, 3)
+        self.assertEqual(['data/d', 'docs/a.txt', 'docs/b.md',
+                          'docs/sub/c.txt'], restored)
+        for name in restored:
+            with open(os.path.join(self.source, name), 'rb') as f:
+                expected = f.read()
+            with open(os.path.join(self.path, 'target',
+                                   self.source.lstrip('/'), name), 'rb') as f:
+                self.assertEqual(expected, f.read())
+
+    def test_restore_without_index(self):
+        """Archives of many gzip members restore fully without their
+        index, as shipped copies have none."""
+        with open(os.path.join(self.source, 'data', 'e'), 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024))
+        restored = self.restored(None, 2, index=False)
+        self.assertEqual(['data/d', 'data/e', 'docs/a.txt', 'docs/b.md',
+                          'docs/sub/c.txt'], restored)
+        with open(os.path.join(self.source, 'data', 'e'), 'rb') as f:
+            expected = f.read()
+        with open(os.path.join(self.path, 'target', self.source.lstrip('/'),
+                               'data', 'e'), 'rb') as f:
+            self.assertEqual(expected, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import click
+import tempfile
+import threading
+import unittest
+from esbckp.backups import BackupGroup
+from esbckp.catalog import Catalog
+from esbckp.commands import ship_groups
+from esbckp.shipper import Shipper, ShipQueue
+
+NAMES = ('2020-01-01--00-00-00__#srv.tar.gz',
+         '2020-01-02--00-00-00__#srv.tar.gz')
+
+
+class TestShipper(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.group_dir = os.path.join(self.path, 'group')
+        os.makedirs(os.path.join(self.group_dir, '.index'))
+        for name in NAMES:
+            with open(os.path.join(self.group_dir, name), 'w') as f:
+                f.write(name)
+
+        shipper = Shipper()
+        shipper.user = 'user'
+        shipper.host = 'host'
+        shipper.source_dir = self.group_dir
+        shipper.target_dir = '/remote'
+        shipper.catalog = Catalog(self.path)
+        shipper.group_title = 'group'
+        self.shipper = shipper
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_rsync_cmd(self):
+        """Compressed files skip transport compression, limits are set."""
+        cmd = self.shipper.get_rsync_cmd(bwlimit=100, files_from='/tmp/x')
+        self.assertIn('--bwlimit=100', cmd)
+        self.assertIn('--files-from=/tmp/x', cmd)
+        self.assertIn('-z', cmd)
+        self.assertTrue(any(c.startswith('--skip-compress=gz/') for c in cmd))
+        self.assertEqual('user@host:/remote', cmd[-1])
+        self.assertNotIn('-z', self.shipper.get_rsync_cmd(compress=False))
+
+    def test_control_path(self):
+        """rsync and ssh share the master connection of a control path."""
+        self.shipper.control_path = '/tmp/cm dir/%r@%h:%p'
+        cmd = self.shipper.get_rsync_cmd()
+        self.assertIn("-o 'ControlPath=/tmp/cm dir/%r@%h:%p'", cmd[3])
+        ssh = self.shipper.get_ssh_cmd('true')
+        self.assertIn('ControlMaster=auto', ssh)
+        self.assertEqual(['user@host', 'true'], ssh[-2:])
+
+    def test_ship_queue(self):
+        """Backups are shipped while others are written, errors of the
+        last transfer are reported."""
+        group = BackupGroup()
+        group.group_title = 'group'
+        group.shippers = [self.shipper]
+        shipped = threading.Event()
+        calls = list()
+
+        def ship():
+            calls.append(threading.current_thread())
+            shipped.set()
+            if len(calls) > 1:
+                raise click.ClickException('failed')
+            return ['x']
+
+        self.shipper.ship = ship
+        queue = ShipQueue([group])
+        queue.notify(group)
+        self.assertTrue(shipped.wait(5))
+        errors = queue.close()
+        self.assertEqual(2, len(calls))
+        self.assertNotEqual(threading.current_thread(), calls[0])
+        self.assertEqual([('group', self.shipper.target)], list(errors))
+
+    def test_ship_queue_survives_other_errors(self):
+        """Unexpected errors are reported and keep the host shipping."""
+        group = BackupGroup()
+        group.group_title = 'group'
+        group.shippers = [self.shipper]
+        shipped = threading.Event()
+        calls = list()
+
+        def ship():
+            calls.append(None)
+            shipped.set()
+            if len(calls) == 1:
+                raise OSError(2, 'No such file or directory')
+            return []
+
+        self.shipper.ship = ship
+        queue = ShipQueue([group])
+        queue.notify(group)
+        self.assertTrue(shipped.wait(5))
+        self.assertEqual({}, queue.close())
+        self.assertEqual(2, len(calls))
+
+        self.shipper.ship = lambda: 1 / 0
+        queue = ShipQueue([group])
+        errors = queue.close()
+        self.assertIsInstance(errors[('group', self.shipper.target)],
+                              ZeroDivisionError)
+
+    def test_bwlimit_split(self):
+        """Limits are split between transfers at once, never down to 0."""
+        limits = dict()
+
+        def ship(host, bwlimit, rescan):
+            limits[host] = bwlimit
+            return []
+
+        group = BackupGroup()
+        group.group_title = 'group'
+        for host in ('h1', 'h2'):
+            shipper = Shipper()
+            shipper.host = host
+            shipper.ship = lambda bwlimit, rescan, host=host: ship(
+                host, bwlimit, rescan)
+            group.shippers.append(shipper)
+
+        class Backup(object):
+            backup_groups = [group]
+
+        ship_groups(Backup(), 4, None, 2, False)
+        self.assertEqual({'h1': 1, 'h2': 1}, limits)
+        group.shippers[0].bwlimit = 300
+        ship_groups(Backup(), 2, 1, 1000, False)
+        self.assertEqual({'h1': 300, 'h2': 500}, limits)
+        group.shippers[1].bwlimit = 3
+        ship_groups(Backup(), 8, None, 0, False)
+        self.assertEqual({'h1': 37, 'h2': 1}, limits)
+
+    def test_catalog_limits_shipping_to_new_entries(self):
+        """Shipped entries are not shipped to the same target again."""
+        self.assertEqual(list(NAMES), self.shipper.get_new_entries())
+
+        catalog = self.shipper.catalog
+        catalog.record_shipment('group', self.shipper.target, [NAMES[0]])
+        catalog.record_shipment('group', 'other:/remote', [NAMES[1]])
+        self.assertEqual([NAMES[1]], self.shipper.get_new_entries())
+
+    def test_volumes_are_shipped_in_parallel_batches(self):
+        """Volumes are split over volume_jobs runs, volumes.json goes last."""
+        name = '2020-01-03--00-00-00__#srv.volumes'
+        os.makedirs(os.path.join(self.group_dir, name))
+        with open(os.path.join(self.group_dir, name, 'volumes.json'), 'w') as f:
+            json.dump({'volumes': [{'name': 'vol-{:05d}.tar.gz'.format(x)}
+                                   for x in range(3)]}, f)
+
+        batches = list()
+        self.shipper._ship_batch = lambda s, t, names, b: batches.append(
+            (sorted(names), b))
+        self.shipper.volume_jobs = 2
+        self.shipper._ship_entries('/remote/group', list(NAMES) + [name], 100)
+
+        self.assertEqual((list(NAMES), 100), batches[0])
+        self.assertEqual(
+            [([name + '/vol-00000.tar.gz', name + '/vol-00002.tar.gz'], 50),
+             ([name + '/vol-00001.tar.gz'], 50)], sorted(batches[1:3]))
+        self.assertEqual(([name + '/volumes.json'], 100), batches[3])
+
+        del batches[:]
+        self.shipper._ship_entries('/remote/group', [name], 1)
+        self.assertEqual([1, 1], [b for _, b in batches[0:2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
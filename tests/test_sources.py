@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import click
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import esbckp
+import esbckp.sources
+from esbckp.backups import BackupGroup
+from esbckp.catalog import Catalog
+from esbckp.checksums import read_checksums
+from esbckp.compression import Compression
+from esbckp.dumps import dump_postgres, get_pg_dump_cmd
+from esbckp.sources import CommandSource, SqliteSource, get_source
+from esbckp.utils import do_database_backup
+from esbckp.verify import verify_backup
+
+
+class TestSources(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.group = BackupGroup()
+        self.group.group_title = 'test'
+        self.group.base_path = os.path.join(self.path, 'backups')
+        self.group.filename_prefix = '2020-01-01--00-00-00'
+        self.group.check_or_create_base_path()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_db_strings(self):
+        """Db strings are parsed by the driver of their type."""
+        item = esbckp.DatabaseBackupItem('mariadb:shop:admin')
+        self.assertEqual(('shop', 'admin'), (item.db_name, item.db_user))
+        item = esbckp.DatabaseBackupItem('redis:cache')
+        self.assertEqual('cache-6379', item.db_name)
+        self.assertEqual(['redis-cli', '-h', 'cache', '-p', '6379', '--rdb',
+                          '-'], item.source.get_cmd(item))
+        item = esbckp.DatabaseBackupItem('sqlite:~/data/app.db')
+        self.assertIsInstance(item.source, SqliteSource)
+        self.assertEqual('app', item.db_name)
+
+        for db_string in ('postgres:db', 'mysql::user', 'redis:h:port',
+                          'command:x', 'sqlite:~/my app.db', 'oracle:db:u'):
+            with self.assertRaises(ValueError):
+                esbckp.DatabaseBackupItem(db_string)
+        with self.assertRaises(ValueError):
+            get_source('oracle')
+
+    def test_sqlite(self):
+        """sqlite dumps are streamed into a compressed, verified file."""
+        db = os.path.join(self.path, 'app.db')
+        conn = sqlite3.connect(db)
+        conn.execute('CREATE TABLE t (x TEXT)')
+        conn.executemany('INSERT INTO t VALUES (?)',
+                         [('row {}'.format(x),) for x in range(5000)])
+        conn.commit()
+        conn.close()
+
+        item = esbckp.DatabaseBackupItem('sqlite:' + db)
+        path = do_database_backup(self.group, item)
+        self.assertTrue(path.endswith('__sqlite_app.sql.gz'))
+        self.assertEqual([os.path.basename(path)],
+                         [name for name, _ in read_checksums(path)])
+        with gzip.open(path) as f:
+            sql = f.read()
+        self.assertIn(b"INSERT INTO \"t\" VALUES('row 4999');", sql)
+        verify_backup(self.group, path)
+        self.assertEqual([os.path.basename(path)], [
+            name for name in os.listdir(self.group.base_path)
+            if not name.startswith('.') and not name.endswith('.sha256')])
+
+    def test_command(self):
+        """Commands are dumped as they are, failures leave no file."""
+        self.group.compression = Compression('none')
+        item = esbckp.DatabaseBackupItem('command:greeting:printf hello')
+        path = do_database_backup(self.group, item)
+        self.assertTrue(path.endswith('__command_greeting.out'))
+        with open(path, 'rb') as f:
+            self.assertEqual(b'hello', f.read())
+
+        item = esbckp.DatabaseBackupItem('command:broken:echo no >&2; exit 3')
+        with self.assertRaises(click.ClickException) as cm:
+            do_database_backup(self.group, item)
+        self.assertIn('no', cm.exception.message)
+        self.assertEqual([], [name for name in os.listdir(
+            self.group.base_path) if 'broken' in name])
+
+    def test_compressed_driver(self):
+        """Dumps of drivers that compress themselves are written as they
+        are and recorded with the tool as codec."""
+        class PackedSource(CommandSource):
+            extension = '.pack'
+            compressed = True
+            tool = 'packer'
+
+        self.group.catalog = Catalog(self.path)
+        esbckp.sources.SOURCES['packed'] = PackedSource
+        try:
+            item = esbckp.DatabaseBackupItem('packed:data:printf packed')
+            path = do_database_backup(self.group, item)
+        finally:
+            del esbckp.sources.SOURCES['packed']
+
+        self.assertTrue(path.endswith('__packed_data.pack'))
+        with open(path, 'rb') as f:
+            self.assertEqual(b'packed', f.read())
+        self.assertEqual('packer', self.group.catalog.find(
+            'test', os.path.basename(path))['codec'])
+        verify_backup(self.group, path)
+
+
+# Stand-in for pg_dump that records its arguments, leaves some output
+# behind and fails.
+FAILING_PG_DUMP = '''#!/bin/sh
+printf '%s\\n' "$@" > "{args}"
+prev=
+for arg; do
+    if [ "$prev" = -f ]; then mkdir -p "$arg" && echo x > "$arg/toc.dat"; fi
+    prev="$arg"
+done
+printf partial
+echo "pg_dump: connection refused" >&2
+exit 1
+'''
+
+
+class TestPostgresDumps(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.bin_path = os.path.join(self.path, 'bin')
+        self.dump_path = os.path.join(self.path, 'dumps')
+        os.makedirs(self.bin_path)
+        os.makedirs(self.dump_path)
+        self.args_path = os.path.join(self.path, 'args')
+
+        pg_dump = os.path.join(self.bin_path, 'pg_dump')
+        with open(pg_dump, 'w') as f:
+            f.write(FAILING_PG_DUMP.format(args=self.args_path))
+        os.chmod(pg_dump, 0o755)
+
+        self.env_path = os.environ['PATH']
+        os.environ['PATH'] = self.bin_path + os.pathsep + self.env_path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.env_path
+        shutil.rmtree(self.path)
+
+    def dump_args(self):
+        with open(self.args_path) as f:
+            return f.read().splitlines()
+
+    def test_failures_leave_no_files(self):
+        """Neither the dump nor its partial file remain after pg_dump
+        failed, in both formats."""
+        item = esbckp.DatabaseBackupItem('postgres:shop:admin')
+        for dump_format in ('custom', 'directory'):
+            target_path = os.path.join(self.dump_path, 'shop.dump')
+            with self.assertRaises(click.ClickException) as cm:
+                dump_postgres(item, target_path, dump_format, jobs=2)
+            self.assertIn('connection refused', cm.exception.message)
+            self.assertEqual([], os.listdir(self.dump_path))
+
+        self.assertEqual(['-U', 'admin', '-Fd', '-f',
+                          os.path.join(self.dump_path, '.shop.dump.partial'),
+                          '-j', '2', 'shop'], self.dump_args())
+
+    def test_no_shell(self):
+        """Names are passed to pg_dump as single arguments, not through a
+        shell, even if they got past the checks of db strings."""
+        item = esbckp.DatabaseBackupItem('postgres:shop:admin')
+        item.db_name, item.db_user = 'shop; touch x', '$(id)'
+        cmd = get_pg_dump_cmd(item)
+        self.assertEqual(['pg_dump', '-U', '$(id)', '-Fc', 'shop; touch x'],
+                         cmd)
+
+        with self.assertRaises(click.ClickException):
+            dump_postgres(item, os.path.join(self.dump_path, 'x.dump'))
+        self.assertEqual(cmd[1:], self.dump_args())
+        self.assertEqual([], os.listdir(self.dump_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
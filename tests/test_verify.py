@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import click
+import os
+import shutil
+import tempfile
+import unittest
+import esbckp
+from esbckp.backups import BackupGroup
+from esbckp.checksums import checksum_path, read_checksums, write_checksums
+from esbckp.compression import Compression
+from esbckp.streams import open_backup_stream
+from esbckp.utils import do_file_backup
+from esbckp.verify import backup_files, verify_backup
+
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source = os.path.join(self.path, 'source')
+        os.makedirs(self.source)
+        for x in range(6):
+            with open(os.path.join(self.source, str(x)), 'wb') as f:
+                f.write(os.urandom(300000))
+
+        self.group = BackupGroup()
+        self.group.group_title = 'test'
+        self.group.base_path = os.path.join(self.path, 'backups')
+        self.group.filename_prefix = '2020-01-01--00-00-00'
+        self.group.check_or_create_base_path()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def backup(self):
+        item = esbckp.FileBackupItem()
+        item.dir = self.source
+        return do_file_backup(self.group, item, progress=False)
+
+    def damage(self, path, offset):
+        os.chmod(path, 0o644)
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            byte = f.read(1)
+            f.seek(offset)
+            f.write(chr(ord(byte) ^ 1))
+
+    def test_archive(self):
+        """Archives pass until a byte or their checksum changes."""
+        path = self.backup()
+        [(name, digest)] = read_checksums(path)
+        self.assertEqual(os.path.basename(path), name)
+        verify_backup(self.group, path)
+
+        write_checksums(path, [(name, '0' * 64)])
+        with self.assertRaises(click.ClickException):
+            verify_backup(self.group, path)
+        # The digest of the catalog wins over the checksum file.
+        verify_backup(self.group, path, digest)
+
+        self.damage(path, os.path.getsize(path) // 2)
+        with self.assertRaises(click.ClickException):
+            verify_backup(self.group, path)
+
+    def test_volumes(self):
+        """Every volume is verified, a modified checksum file is noticed."""
+        self.group.compression = Compression('none')
+        self.group.volume_size = 500000
+        path = self.backup()
+        files = backup_files(path)
+        self.assertTrue(len(files) > 1)
+        verify_backup(self.group, path)
+
+        with self.assertRaises(click.ClickException):
+            backup_files(path, '0' * 64)
+        os.remove(checksum_path(path))
+        self.assertEqual(files, backup_files(path))
+
+        self.damage(files[-1][0], 100)
+        with self.assertRaises(click.ClickException):
+            verify_backup(self.group, path)
+
+    def test_parallel_gzip_stream(self):
+        """Archives of several gzip members are read as one stream."""
+        self.group.compression = Compression('gzip', threads=4)
+        path = self.backup()
+        with open_backup_stream(self.group, path) as tar:
+            names = sorted(os.path.basename(m.name) for m in tar
+                           if m.isfile())
+        self.assertEqual([str(x) for x in range(6)], names)
+
+
+if __name__ == '__main__':
+    unittest.main()
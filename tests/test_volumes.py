@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import click
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from esbckp.archiver import add_tree
+from esbckp.backups import BackupGroup
+from esbckp.compression import Compression
+from esbckp.volumes import (VOLUMES_FILE, VolumeTar, find_volumes,
+                            read_checkpoint, resume_point)
+
+try:
+    import cryptography
+except ImportError:
+    cryptography = None
+
+
+class TestVolumeTar(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.top = os.path.join(self.path, 'top')
+        self.volumes = os.path.join(self.path, 'backup.volumes')
+        os.makedirs(self.volumes)
+        for d in ('a', 'b'):
+            os.makedirs(os.path.join(self.top, d))
+            for x in range(5):
+                with open(os.path.join(self.top, d, str(x)), 'wb') as f:
+                    f.write(os.urandom(64 * 1024))
+
+        self.group = BackupGroup()
+        self.group.compression = Compression('none')
+        self.group.volume_size = 64 * 1024
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def members(self, checkpoint):
+        names = list()
+        for volume in checkpoint['volumes']:
+            path = os.path.join(self.volumes, volume['name'])
+            with tarfile.open(path) as tar:
+                names.extend(tar.getnames())
+        return names
+
+    def test_rotates_volumes(self):
+        """Every volume is a complete archive and holds whole members."""
+        tar = VolumeTar(self.group, self.volumes, self.group.volume_size)
+        num_files, _ = add_tree(tar, self.top)
+        tar.close()
+
+        checkpoint = read_checkpoint(self.volumes)
+        self.assertTrue(checkpoint['complete'])
+        self.assertEqual(10, num_files)
+        self.assertGreater(len(checkpoint['volumes']), 3)
+        self.assertEqual(13, len(self.members(checkpoint)))
+
+    def test_resume_after_last_volume(self):
+        """An interrupted run continues after the last finished volume."""
+        tar = VolumeTar(self.group, self.volumes, self.group.volume_size)
+        on_add = lambda tarinfo: tar.volumes[2:] and 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            add_tree(tar, self.top, on_add)
+        tar.abort()
+
+        checkpoint = read_checkpoint(self.volumes)
+        self.assertFalse(checkpoint['complete'])
+        self.assertEqual(3, len(checkpoint['volumes']))
+        self.assertEqual(checkpoint['volumes'][-1]['last'],
+                         resume_point(checkpoint, self.top))
+
+        tar = VolumeTar(self.group, self.volumes, self.group.volume_size,
+                        checkpoint=checkpoint)
+        add_tree(tar, self.top, start_after=resume_point(checkpoint, self.top))
+        tar.close()
+
+        checkpoint = read_checkpoint(self.volumes)
+        names = self.members(checkpoint)
+        self.assertEqual(10, sum(v['files'] for v in checkpoint['volumes']))
+        self.assertEqual(13, len(names))
+        self.assertEqual(len(names), len(set(names)))
+
+    def test_find_volumes(self):
+        """Only the volumes holding a file or directory are returned."""
+        tar = VolumeTar(self.group, self.volumes, self.group.volume_size)
+        add_tree(tar, self.top)
+        tar.close()
+
+        for member in ('a/3', 'b', 'b/0', ''):
+            path = os.path.join(self.top, member).rstrip(os.sep)
+            expected = [v['name'] for v in tar.volumes if any(
+                n == path.lstrip('/') or n.startswith(path.lstrip('/') + '/')
+                for n in self.members({'volumes': [v]}))]
+            found = find_volumes(self.volumes, self.top, path)
+            self.assertEqual(expected, [os.path.basename(p) for p in found])
+            self.assertTrue(found)
+
+    @unittest.skipIf(cryptography is None, 'cryptography is not installed')
+    def test_encrypted_member_paths(self):
+        """Encrypted groups keep member paths out of the checkpoint."""
+        key = b'k' * 32
+        self.group.encryption_key = key
+        tar = VolumeTar(self.group, self.volumes, self.group.volume_size)
+        add_tree(tar, self.top)
+        tar.close()
+
+        with open(os.path.join(self.volumes, VOLUMES_FILE)) as f:
+            self.assertNotIn(self.top.lstrip('/'), f.read())
+        checkpoint = read_checkpoint(self.volumes)
+        self.assertEqual(os.path.join(self.top, 'b', '4'),
+                         resume_point(checkpoint, self.top, key))
+
+        path = os.path.join(self.top, 'b')
+        found = find_volumes(self.volumes, self.top, path, key)
+        self.assertTrue(0 < len(found) < len(checkpoint['volumes']))
+        with self.assertRaises(click.ClickException):
+            find_volumes(self.volumes, self.top, path)
+
+
+if __name__ == '__main__':
+    unittest.main()